@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# Crunchyroll
+# Copyright (C) 2018 MrKrabat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Responses of a given number of items, built from the samples in data/. The samples have the shape of the api's
+# responses (watchlist, episodes of a season, browse), recorded responses saved under the same names can be
+# used instead with run.py --fixtures.
+
+import json
+import os
+from typing import Dict
+
+DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+# name of the fixture => key of its items
+ITEMS_KEYS = {
+    "watchlist": "items",
+    "episodes": "items",
+    "browse": "items"
+}
+
+
+def load(name: str, size: int, directory: str = DIRECTORY) -> Dict:
+    """ a response with size items, the items of the sample repeated with unique ids """
+
+    with open(os.path.join(directory, name + ".json"), "r", encoding="utf-8") as file:
+        sample = json.load(file)
+
+    items_key = ITEMS_KEYS[name]
+    templates = [json.dumps(item) for item in sample[items_key]]
+
+    response = dict(sample)
+    response["total"] = size
+    response[items_key] = [
+        json.loads(_make_unique(templates[index % len(templates)], index))
+        for index in range(size)
+    ]
+
+    return response
+
+
+def _make_unique(template: str, index: int) -> str:
+    """ suffix every id and stream link of an item, so no two items share them """
+
+    for prefix in ['"id": "', "/videos/", '_id": "']:
+        template = template.replace(prefix, "%s%05d" % (prefix, index))
+
+    return template
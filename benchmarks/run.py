@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+# Crunchyroll
+# Copyright (C) 2018 MrKrabat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Micro-benchmarks of the code run for every item of a listing
+
+Runs outside of kodi, the kodi modules are replaced by the stubs in stubs/. Every benchmark processes a whole listing
+of 50, 1000 and 10000 items, the result is the time per item of the best of several repeats. The download benchmark
+fetches segments of SEGMENT_SIZE bytes from a local HLS server instead, its time per segment is the throughput.
+
+    python benchmarks/run.py                 compare with baseline.json, exit code 1 on regressions
+    python benchmarks/run.py --save          write the results as new baseline
+    python benchmarks/run.py -k image        only benchmarks with "image" in their name
+    python benchmarks/run.py --fixtures DIR  use recorded responses instead of the samples in data/
+
+The baseline depends on the machine it was taken on, take a new one before comparing on another machine.
+"""
+
+import argparse
+import atexit
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+from typing import Callable, Dict, List
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[0:0] = [os.path.join(BENCHMARKS_DIR, "stubs"), os.path.dirname(BENCHMARKS_DIR)]
+
+import requests  # noqa: E402
+import xbmcaddon  # noqa: E402
+
+import fixtures  # noqa: E402
+from resources.lib import codec, utils, view  # noqa: E402
+from resources.lib.downloader import SegmentDownloader  # noqa: E402
+from resources.lib.model import EpisodeData, MovieData  # noqa: E402
+
+SIZES = [50, 1000, 10000]
+BASELINE_FILE = os.path.join(BENCHMARKS_DIR, "baseline.json")
+# relative slowdown per item reported as regression, timings of the small benchmarks vary by a third on busy machines
+THRESHOLD = 0.5
+# seconds each benchmark runs at least per repeat
+MIN_TIME = 0.1
+REPEAT = 5
+# benchmarks too slow for the larger sizes => largest size they run with
+MAX_SIZES = {
+    "SegmentDownloader.download": 1000
+}
+# bytes per segment of the download benchmark, a few seconds of low quality video are far more
+SEGMENT_SIZE = 16 * 1024
+
+
+def create_args():
+    args = utils.parse(["plugin://plugin.video.crunchyroll/", "1", "?mode=queue"])
+    args._subtitle = "en-US"
+    args._subtitle_fallback = "de-DE"
+
+    return args
+
+
+def bench_build_url(args, fixture_dir: str, size: int) -> Callable:
+    infos = _get_infos(fixture_dir, size)
+
+    return lambda: [view.build_url(args, info) for info in infos]
+
+
+def bench_make_info_label(args, fixture_dir: str, size: int) -> Callable:
+    infos = _get_infos(fixture_dir, size)
+
+    return lambda: [view.make_info_label(args, info) for info in infos]
+
+
+def bench_add_item(args, fixture_dir: str, size: int) -> Callable:
+    infos = _get_infos(fixture_dir, size)
+
+    def run():
+        for info in infos:
+            view.add_item(args, info, is_folder=False)
+        # what end_of_directory would hand to the artwork warmer
+        del view._artwork[:]
+
+    return run
+
+
+def bench_get_image_from_struct(args, fixture_dir: str, size: int) -> Callable:
+    series = fixtures.load("browse", size, fixture_dir)["items"]
+
+    return lambda: [
+        (utils.get_image_from_struct(item, "poster_tall", 2), utils.get_image_from_struct(item, "poster_wide", 2))
+        for item in series
+    ]
+
+
+def bench_get_stream_id_from_url(args, fixture_dir: str, size: int) -> Callable:
+    urls = [
+        item["__links__"]["streams"]["href"] for item in fixtures.load("episodes", size, fixture_dir)["items"]
+    ]
+
+    return lambda: [utils.get_stream_id_from_url(url) for url in urls]
+
+
+def bench_filter_series(args, fixture_dir: str, size: int) -> Callable:
+    series = fixtures.load("browse", size, fixture_dir)["items"]
+
+    return lambda: [utils.filter_series(args, item) for item in series]
+
+
+def bench_episode_data(args, fixture_dir: str, size: int) -> Callable:
+    items = _get_episode_items(fixture_dir, size)
+
+    return lambda: [EpisodeData(item) for item in items]
+
+
+def bench_movie_data(args, fixture_dir: str, size: int) -> Callable:
+    items = [
+        item for item in fixtures.load("watchlist", size, fixture_dir)["items"]
+        if item["panel"]["type"] == "movie"
+    ]
+
+    return lambda: [MovieData(item) for item in items]
+
+
+def bench_get_json_from_response(args, fixture_dir: str, size: int) -> Callable:
+    response = requests.Response()
+    response.status_code = 200
+    response.headers["Content-Type"] = "application/json; charset=utf-8"
+    response.encoding = "utf-8"
+    response._content = json.dumps(fixtures.load("watchlist", size, fixture_dir)).encode("utf-8")
+
+    return lambda: utils.get_json_from_response(response)
+
+
+def bench_codec_encode(args, fixture_dir: str, size: int) -> Callable:
+    episodes = [EpisodeData(item) for item in _get_episode_items(fixture_dir, size)]
+
+    return lambda: [codec.encode(episode) for episode in episodes]
+
+
+def bench_codec_decode(args, fixture_dir: str, size: int) -> Callable:
+    raws = [codec.encode(EpisodeData(item)) for item in _get_episode_items(fixture_dir, size)]
+
+    return lambda: [codec.decode(EpisodeData, raw) for raw in raws]
+
+
+def bench_segment_downloader(args, fixture_dir: str, size: int) -> Callable:
+    """ a download of size segments from a static HLS tree on localhost, including the final concatenation """
+
+    from tests.hlsserver import StaticHlsServer
+
+    server = StaticHlsServer(segments=size, segment_size=SEGMENT_SIZE)
+    atexit.register(server.stop)
+    downloader = SegmentDownloader(concurrency=4)
+
+    def run():
+        # a fresh directory every time, otherwise the download would resume the finished one
+        target_dir = tempfile.mkdtemp(prefix="crunchyroll-benchmark-")
+        try:
+            downloader.download(server.url("low/index.m3u8"), target_dir)
+        finally:
+            shutil.rmtree(target_dir, ignore_errors=True)
+
+    return run
+
+
+BENCHMARKS = {
+    "build_url": bench_build_url,
+    "make_info_label": bench_make_info_label,
+    "add_item": bench_add_item,
+    "get_image_from_struct": bench_get_image_from_struct,
+    "get_stream_id_from_url": bench_get_stream_id_from_url,
+    "filter_series": bench_filter_series,
+    "EpisodeData": bench_episode_data,
+    "MovieData": bench_movie_data,
+    "get_json_from_response": bench_get_json_from_response,
+    "codec.encode": bench_codec_encode,
+    "codec.decode": bench_codec_decode,
+    "SegmentDownloader.download": bench_segment_downloader
+}
+
+
+def _get_infos(fixture_dir: str, size: int) -> List[Dict]:
+    """ info dicts as the queue view builds them """
+
+    infos = []
+    for item in fixtures.load("watchlist", size, fixture_dir)["items"]:
+        entry = EpisodeData(item) if item["panel"]["type"] == "episode" else MovieData(item)
+        info = entry.to_info()
+        info["mode"] = "videoplay"
+        infos.append(info)
+
+    return infos
+
+
+def _get_episode_items(fixture_dir: str, size: int) -> List[Dict]:
+    return [
+        item for item in fixtures.load("watchlist", size, fixture_dir)["items"]
+        if item["panel"]["type"] == "episode"
+    ]
+
+
+def measure(func: Callable, size: int) -> float:
+    """ microseconds per item, best of REPEAT """
+
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * MIN_TIME / max(elapsed, 1e-9)))
+    best = min(timer.repeat(repeat=REPEAT, number=number)) / number
+
+    return best / size * 1e6
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the per-item code paths")
+    parser.add_argument("-k", dest="keyword", default="", help="only run benchmarks containing this")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in SIZES), help="comma separated item counts")
+    parser.add_argument("--fixtures", default=fixtures.DIRECTORY, help="directory of the fixture responses")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="baseline file to compare with or save to")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD, help="relative slowdown reported as regression")
+    parser.add_argument("--save", action="store_true", help="save the results as baseline")
+    options = parser.parse_args()
+
+    # a fresh profile, so state stored by one run doesn't change the next
+    shutil.rmtree(xbmcaddon.PROFILE, ignore_errors=True)
+    os.makedirs(xbmcaddon.PROFILE)
+
+    baseline = {}
+    if not options.save and os.path.exists(options.baseline):
+        with open(options.baseline, "r", encoding="utf-8") as file:
+            baseline = json.load(file)
+        if baseline.get("python") != platform.python_version():
+            print("Baseline was taken with python %s, comparing anyway" % baseline.get("python"))
+
+    args = create_args()
+    results = {}
+    regressions = []
+
+    print("%-40s %12s %12s %9s" % ("benchmark", "us/item", "baseline", "change"))
+    for name, setup in BENCHMARKS.items():
+        if options.keyword.lower() not in name.lower():
+            continue
+
+        for size in [int(size) for size in options.sizes.split(",")]:
+            if size > MAX_SIZES.get(name, size):
+                continue
+
+            key = "%s/%d" % (name, size)
+            results[key] = round(measure(setup(args, options.fixtures, size), size), 4)
+
+            previous = baseline.get("results", {}).get(key)
+            change = results[key] / previous - 1 if previous else None
+            if change is not None and change > options.threshold:
+                regressions.append(key)
+
+            print("%-40s %12.3f %12s %9s%s" % (
+                key,
+                results[key],
+                "%.3f" % previous if previous else "-",
+                "%+.1f%%" % (change * 100) if change is not None else "-",
+                "  REGRESSION" if key in regressions else ""
+            ))
+
+    if options.save:
+        with open(options.baseline, "w", encoding="utf-8") as file:
+            json.dump({
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "results": results
+            }, file, indent=2, sort_keys=True)
+            file.write("\n")
+        print("Baseline saved to %s" % options.baseline)
+        return 0
+
+    if regressions:
+        print("%d regression(s) beyond %d%%" % (len(regressions), options.threshold * 100))
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,33 @@
+# Minimal stand-in for kodi's xbmc module, only what the benchmarked code paths touch.
+
+LOGDEBUG, LOGINFO, LOGWARNING, LOGERROR = 0, 1, 2, 3
+
+
+def log(msg, level=LOGINFO):
+    pass
+
+
+def getInfoLabel(label):
+    return {"System.ScreenWidth": "1920", "System.ScreenHeight": "1080"}.get(label, "")
+
+
+def getCondVisibility(condition):
+    return False
+
+
+def executebuiltin(function, wait=False):
+    pass
+
+
+def executeJSONRPC(request):
+    return '{"result": {}}'
+
+
+class Monitor:
+    def abortRequested(self):
+        return False
+
+
+class Player:
+    def isPlayingVideo(self):
+        return False
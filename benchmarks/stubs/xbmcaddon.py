@@ -0,0 +1,26 @@
+# Minimal stand-in for kodi's xbmcaddon module. The profile directory is set by the benchmark runner.
+
+import os
+import tempfile
+
+PROFILE = os.path.join(tempfile.gettempdir(), "crunchyroll-benchmarks") + os.sep
+SETTINGS = {}
+
+
+class Addon:
+    def __init__(self, id=None):
+        pass
+
+    def getSetting(self, key):
+        return SETTINGS.get(key, "")
+
+    def getAddonInfo(self, key):
+        return {
+            "id": "plugin.video.crunchyroll",
+            "name": "Crunchyroll",
+            "profile": PROFILE,
+            "fanart": "fanart.jpg"
+        }.get(key, "")
+
+    def getLocalizedString(self, string_id):
+        return "#%d" % string_id
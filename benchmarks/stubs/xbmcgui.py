@@ -0,0 +1,41 @@
+# Minimal stand-in for kodi's xbmcgui module. ListItem keeps what it is given, like kodi it costs a little per call.
+
+
+class ListItem:
+    def __init__(self, label="", label2="", path=""):
+        self.label = label
+        self.path = path
+        self.info = None
+        self.art = None
+        self.properties = {}
+        self.context_menu = None
+
+    def setInfo(self, media_type, info_labels):
+        self.info = info_labels
+
+    def setProperty(self, key, value):
+        self.properties[key] = value
+
+    def setArt(self, art):
+        self.art = art
+
+    def addContextMenuItems(self, items):
+        self.context_menu = items
+
+
+class Dialog:
+    def notification(self, *args, **kwargs):
+        pass
+
+
+class Window:
+    properties = {}
+
+    def __init__(self, window_id):
+        pass
+
+    def getProperty(self, key):
+        return self.properties.get(key, "")
+
+    def setProperty(self, key, value):
+        self.properties[key] = value
@@ -0,0 +1,19 @@
+# Minimal stand-in for kodi's xbmcplugin module.
+
+SORT_METHOD_NONE = 0
+
+
+def addDirectoryItem(handle, url, listitem, isFolder=False, totalItems=0):
+    return True
+
+
+def addSortMethod(handle, sortMethod):
+    pass
+
+
+def endOfDirectory(handle, succeeded=True):
+    pass
+
+
+def setContent(handle, content):
+    pass
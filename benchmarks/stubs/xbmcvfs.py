@@ -0,0 +1,29 @@
+# Minimal stand-in for kodi's xbmcvfs module, paths are used as they are.
+
+import os
+
+
+def translatePath(path):
+    return path
+
+
+def exists(path):
+    return os.path.exists(path)
+
+
+def mkdirs(path):
+    os.makedirs(path, exist_ok=True)
+    return True
+
+
+def listdir(path):
+    names = os.listdir(path)
+    return (
+        [name for name in names if os.path.isdir(os.path.join(path, name))],
+        [name for name in names if not os.path.isdir(os.path.join(path, name))]
+    )
+
+
+def delete(path):
+    os.remove(path)
+    return True
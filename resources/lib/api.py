@@ -15,7 +15,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import json as JSON
+import threading
 from datetime import timedelta
 from typing import Optional, Dict
 
@@ -23,7 +23,9 @@ import requests
 import xbmc
 import xbmcvfs
 
+from . import codec
 from . import utils
+from .jsonstream import JsonItemStream
 from .model import AccountData, Args
 
 
@@ -45,6 +47,7 @@ class API:
     SERIES_ENDPOINT = "https://beta-api.crunchyroll.com/cms/v2{}/series/{}"
     SEASONS_ENDPOINT = "https://beta-api.crunchyroll.com/cms/v2{}/seasons"
     EPISODES_ENDPOINT = "https://beta-api.crunchyroll.com/cms/v2{}/episodes"
+    MOVIES_ENDPOINT = "https://beta-api.crunchyroll.com/cms/v2{}/movies"
     SIMILAR_ENDPOINT = "https://beta-api.crunchyroll.com/content/v1/{}/similar_to"
     NEWSFEED_ENDPOINT = "https://beta-api.crunchyroll.com/content/v1/news_feed"
     BROWSE_ENDPOINT = "https://beta-api.crunchyroll.com/content/v1/browse"
@@ -72,14 +75,16 @@ class API:
         self.api_headers: Dict = utils.headers()
         self.args = args
         self.retry_counter = 0
+        # background jobs share one instance across threads, only one of them may refresh the session
+        self.session_lock = threading.Lock()
 
     def start(self) -> bool:
         session_restart = getattr(self.args, "session_restart", False)
 
         # restore account data from file
-        session_data = self.load_from_storage()
-        if session_data and not session_restart:
-            self.account_data = AccountData(session_data)
+        account_data = self.load_from_storage()
+        if account_data and not session_restart:
+            self.account_data = account_data
             account_auth = {"Authorization": f"{self.account_data.token_type} {self.account_data.access_token}"}
             self.api_headers.update(account_auth)
 
@@ -167,6 +172,40 @@ class API:
         self.write_to_storage(self.account_data)
         self.retry_counter = 0
 
+    def refresh_access_token(self) -> bool:
+        """ exchange the refresh token for a new access token, keeping all other account data
+
+        much cheaper than create_session, which also fetches the index and profile again
+        """
+
+        r = self.http.request(
+            method="POST",
+            url=API.TOKEN_ENDPOINT,
+            headers={"Authorization": API.AUTHORIZATION},
+            data={
+                "refresh_token": self.account_data.refresh_token,
+                "grant_type": "refresh_token",
+                "scope": "offline_access",
+            },
+            timeout=API.TIMEOUT
+        )
+
+        if r.status_code != 200:
+            utils.crunchy_log(self.args, "Refreshing access token failed with %d" % r.status_code, xbmc.LOGERROR)
+            return False
+
+        r_json = r.json()
+        self.account_data.access_token = r_json["access_token"]
+        self.account_data.token_type = r_json["token_type"]
+        self.account_data.refresh_token = r_json.get("refresh_token") or self.account_data.refresh_token
+        self.account_data.expires = utils.date_to_str(
+            utils.get_date() + timedelta(seconds=float(r_json["expires_in"])))
+        self.api_headers.update({"Authorization": f"{self.account_data.token_type} {self.account_data.access_token}"})
+
+        self.write_to_storage(self.account_data)
+
+        return True
+
     def close(self) -> None:
         """Saves cookies and session
         """
@@ -184,17 +223,85 @@ class API:
             headers=None,
             params=None,
             data=None,
-            json=None
+            json=None,
+            auth_retried=False
     ) -> Optional[Dict]:
+        return utils.get_json_from_response(self.send_request(method, url, headers, params, data, json, auth_retried))
+
+    def send_request(
+            self,
+            method: str,
+            url: str,
+            headers=None,
+            params=None,
+            data=None,
+            json=None,
+            auth_retried=False
+    ) -> requests.Response:
+        """ like make_request, but returns the response itself, for callers that need to know its status """
+
+        r = self._send(method, url, headers, params, data, json)
+
+        # the access token can be rejected before it expired, e.g. if another device refreshed it. a new token
+        # is all we need then, once.
+        if r.status_code == 401 and not auth_retried and self.account_data.refresh_token:
+            utils.crunchy_log(self.args, "Access token rejected, refreshing it", xbmc.LOGDEBUG)
+            with self.session_lock:
+                refreshed = self.refresh_access_token()
+            if refreshed:
+                return self.send_request(method, url, headers, params, data, json, auth_retried=True)
+
+        return r
+
+    def make_list_request(
+            self,
+            method: str,
+            url: str,
+            items_key: str,
+            fields: Optional[Dict] = None,
+            headers=None,
+            params=None
+    ) -> JsonItemStream:
+        """ like make_request, for responses with a long list under items_key
+
+        the list is decoded item by item while the body arrives, each item pruned to fields. a conditional request
+        answered with "not modified" gives an empty list. anything else but a plain success goes through make_request
+        and its error handling.
+        """
+
+        if self.args.addon.getSetting("stream_lists") != "false":
+            r = self._send(method, url, headers, params, stream=True)
+            if r.status_code == 200 and "json" in r.headers.get("Content-Type", ""):
+                return JsonItemStream(r.iter_content(chunk_size=16 * 1024), items_key, fields)
+            r.close()
+
+            # there is no body to decode, asking again would only get the same answer
+            if r.status_code == 304:
+                return JsonItemStream.from_data(None, items_key, fields)
+
+        return JsonItemStream.from_data(self.make_request(method, url, headers, params), items_key, fields)
+
+    def _send(
+            self,
+            method: str,
+            url: str,
+            headers=None,
+            params=None,
+            data=None,
+            json=None,
+            stream=False
+    ) -> requests.Response:
         if params is None:
             params = dict()
         if headers is None:
             headers = dict()
         if self.account_data:
-            if expiration := self.account_data.expires:
-                current_time = utils.get_date()
-                if current_time > utils.str_to_date(expiration):
-                    self.create_session(refresh=True)
+            if self.account_data.expires:
+                with self.session_lock:
+                    # re-check inside the lock, another thread might have refreshed the session meanwhile
+                    current_time = utils.get_date()
+                    if current_time > utils.str_to_date(self.account_data.expires):
+                        self.create_session(refresh=True)
             params.update({
                 "Policy": self.account_data.cms.policy,
                 "Signature": self.account_data.cms.signature,
@@ -202,15 +309,15 @@ class API:
             })
         headers.update(self.api_headers)
 
-        r = self.http.request(
+        return self.http.request(
             method,
             url,
             headers=headers,
             params=params,
             data=data,
-            json=json
+            json=json,
+            stream=stream
         )
-        return utils.get_json_from_response(r)
 
     def get_storage_path(self) -> str:
         """Get cookie file path
@@ -219,19 +326,14 @@ class API:
 
         return profile_path
 
-    def load_from_storage(self) -> Optional[Dict]:
+    def load_from_storage(self) -> Optional[AccountData]:
         storage_file = self.get_storage_path() + "session_data.json"
 
         if not xbmcvfs.exists(storage_file):
             return None
 
-        with xbmcvfs.File(storage_file) as file:
-            data = JSON.load(file)
-
-        d = dict()
-        d.update(data)
-
-        return d
+        with open(storage_file, "rb") as file:
+            return codec.decode(AccountData, file.read())
 
     def delete_storage(self) -> None:
         storage_file = self.get_storage_path() + "session_data.json"
@@ -244,10 +346,8 @@ class API:
     def write_to_storage(self, account: AccountData) -> bool:
         storage_file = self.get_storage_path() + "session_data.json"
 
-        # serialize (Object has a to_str serializer)
-        json_string = str(account)
-
-        with xbmcvfs.File(storage_file, 'w') as file:
-            result = file.write(json_string)
+        # plugin and service both write it, never leave a half written file
+        xbmcvfs.mkdirs(self.get_storage_path())
+        utils.write_file(storage_file, codec.encode(account))
 
-        return result
+        return True
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# Crunchyroll
+# Copyright (C) 2018 MrKrabat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import requests
+import xbmc
+import xbmcgui
+
+from . import utils
+
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+# window property holding the artwork of the last listing, shared between plugin and service
+ARTWORK_PROPERTY = "crunchyroll.artwork"
+# NotifyAll message telling the service a new listing has been published
+ARTWORK_MESSAGE = "artwork"
+
+
+def publish(folder_path: str, urls: List[str], extra_urls: List[str]) -> None:
+    """ hand the artwork of a listing to the service, which warms kodi's texture cache with it
+
+    urls is the artwork of the listing itself, extra_urls of what is likely to be opened from it. publishing a new
+    listing cancels warming the previous one.
+    """
+
+    xbmcgui.Window(10000).setProperty(ARTWORK_PROPERTY, json.dumps({
+        "id": time.time(),
+        "path": folder_path,
+        "urls": urls,
+        "extra": extra_urls
+    }))
+    xbmc.executebuiltin("NotifyAll(%s,%s)" % (utils.ADDON_ID, ARTWORK_MESSAGE))
+
+
+def get_published() -> Optional[Dict]:
+    try:
+        return json.loads(xbmcgui.Window(10000).getProperty(ARTWORK_PROPERTY) or "null")
+    except ValueError:
+        return None
+
+
+class ArtworkWarmer:
+    """
+    Load artwork into kodi's texture cache before it scrolls into view
+
+    Kodi only caches an image when it is first displayed. Requesting it as image:// url from kodi's own webserver
+    makes kodi download and cache it right away, so this only works while the webserver is enabled. Listings are
+    warmed with a few threads, extra artwork after the listing itself, each listing up to a byte budget. Artwork
+    warmed before is skipped, and a listing is dropped as soon as another one is published or the user leaves the
+    addon.
+    """
+
+    CONCURRENCY = 4
+    # number of warmed urls remembered to skip them next time
+    MAX_WARMED = 5000
+    TIMEOUT = 30
+
+    def __init__(self, budget_bytes: int, log: Callable[[str], None]):
+        self.budget_bytes: int = budget_bytes
+        self.log: Callable[[str], None] = log
+        self.lock = threading.Lock()
+        self.warmed: "OrderedDict[str, bool]" = OrderedDict()
+        self.listing_id: Optional[float] = None
+        self.listing_path: str = ""
+        self.listing_bytes: int = 0
+        self.http = requests.Session()
+        self.executor = ThreadPoolExecutor(max_workers=self.CONCURRENCY)
+
+    def warm(self, listing: Dict) -> int:
+        """ queue the artwork of a published listing, returns the number of queued urls """
+
+        webserver = get_webserver()
+        if not webserver:
+            self.log("Artwork warmer: kodi's webserver is disabled, nothing to do")
+            return 0
+
+        with self.lock:
+            self.listing_id = listing.get("id")
+            self.listing_path = listing.get("path") or ""
+            self.listing_bytes = 0
+            urls = [
+                url for url in OrderedDict.fromkeys((listing.get("urls") or []) + (listing.get("extra") or []))
+                if url and url.startswith("http") and url not in self.warmed
+            ]
+
+        for url in urls:
+            self.executor.submit(self._warm_url, self.listing_id, url, webserver)
+
+        return len(urls)
+
+    def stop(self) -> None:
+        with self.lock:
+            self.listing_id = None
+
+        self.executor.shutdown(wait=False)
+        self.http.close()
+
+    def _is_current(self, listing_id: float) -> bool:
+        with self.lock:
+            if listing_id != self.listing_id or self.listing_bytes >= self.budget_bytes:
+                return False
+
+        # the user navigated away from the addon, or started watching something
+        if not xbmc.getInfoLabel("Container.FolderPath").startswith("plugin://%s/" % utils.ADDON_ID):
+            return False
+
+        return not xbmc.Player().isPlayingVideo()
+
+    def _warm_url(self, listing_id: float, url: str, webserver: Dict) -> None:
+        if not self._is_current(listing_id):
+            return
+
+        texture_url = "%s/image/%s" % (webserver.get("address"), quote("image://%s/" % quote(url, safe=""), safe=""))
+        try:
+            r = self.http.get(texture_url, auth=webserver.get("auth"), timeout=self.TIMEOUT)
+            r.raise_for_status()
+        except requests.RequestException as e:
+            self.log("Artwork warmer: failed to warm %s: %s" % (url, e))
+            return
+
+        with self.lock:
+            self.listing_bytes = self.listing_bytes + len(r.content)
+            self.warmed[url] = True
+            while len(self.warmed) > self.MAX_WARMED:
+                self.warmed.popitem(last=False)
+
+
+def get_webserver() -> Optional[Dict]:
+    """ get address and credentials of kodi's webserver, None if it is disabled """
+
+    settings = {}
+    for setting in ["services.webserver", "services.webserverport", "services.webserverusername",
+                    "services.webserverpassword"]:
+        response = json.loads(xbmc.executeJSONRPC(json.dumps({
+            "jsonrpc": "2.0",
+            "id": 1,
+            "method": "Settings.GetSettingValue",
+            "params": {"setting": setting}
+        })))
+        settings[setting] = response.get("result", {}).get("value")
+
+    if not settings.get("services.webserver"):
+        return None
+
+    return {
+        "address": "http://127.0.0.1:%s" % settings.get("services.webserverport"),
+        "auth": (settings.get("services.webserverusername"), settings.get("services.webserverpassword"))
+        if settings.get("services.webserverpassword") else None
+    }
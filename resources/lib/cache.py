@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# Crunchyroll
+# Copyright (C) 2018 MrKrabat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Simple file based cache for json serializable data. Each entry is one file in a namespace directory
+# (cache_<namespace>) of the profile, holding the data and an absolute expiration timestamp. Plugin and service
+# share the cache, so files are written to a temporary file of the writer first and then moved into place.
+
+import json
+import os
+import re
+import time
+from typing import Any, Optional
+
+import xbmcvfs
+
+from . import utils
+from .model import Args
+
+# temporary files of writers are only cleaned up after this many seconds, they are left over by crashed ones then
+TMP_MAX_AGE = 60 * 60
+
+
+def get_cache_dir(args: Args, namespace: str) -> str:
+    """ return the directory of a cache namespace """
+
+    return xbmcvfs.translatePath(args.addon.getAddonInfo("profile") + "cache_" + namespace + "/")
+
+
+def get_cache_file(args: Args, namespace: str, key: str) -> str:
+    """ return the file name of a cache entry """
+
+    return get_cache_dir(args, namespace) + re.sub(r"[^A-Za-z0-9_.-]", "_", key) + ".json"
+
+
+def load(args: Args, namespace: str, key: str) -> Optional[Any]:
+    """ return the cached data for key or None if it does not exist or has expired """
+
+    entry = _read_entry(get_cache_file(args, namespace, key))
+    if entry is None:
+        return None
+
+    if entry.get("expires", 0) <= time.time():
+        delete(args, namespace, key)
+        return None
+
+    return entry.get("data")
+
+
+def store(args: Args, namespace: str, key: str, data: Any, expires: float) -> bool:
+    """ store data for key until the absolute timestamp expires """
+
+    if expires <= time.time():
+        return False
+
+    cache_file = get_cache_file(args, namespace, key)
+    xbmcvfs.mkdirs(get_cache_dir(args, namespace))
+
+    utils.write_file(cache_file, json.dumps({"expires": expires, "stored": time.time(), "data": data},
+                                            separators=(",", ":")))
+
+    return True
+
+
+def delete(args: Args, namespace: str, key: str) -> None:
+    """ remove a single cache entry """
+
+    cache_file = get_cache_file(args, namespace, key)
+    if xbmcvfs.exists(cache_file):
+        xbmcvfs.delete(cache_file)
+
+
+def clear(args: Args, namespace: str) -> None:
+    """ remove all entries of a namespace """
+
+    cache_dir = get_cache_dir(args, namespace)
+    if xbmcvfs.exists(cache_dir):
+        xbmcvfs.rmdir(cache_dir, force=True)
+
+
+def clean(args: Args, namespace: str) -> int:
+    """ remove all expired entries of a namespace, returns the number of removed entries """
+
+    cache_dir = get_cache_dir(args, namespace)
+    if not xbmcvfs.exists(cache_dir):
+        return 0
+
+    removed = 0
+    dirs, files = xbmcvfs.listdir(cache_dir)
+    for cache_file in files:
+        # another process may still be writing it
+        if cache_file.endswith(utils.TMP_SUFFIX):
+            if os.path.getmtime(cache_dir + cache_file) < time.time() - TMP_MAX_AGE:
+                xbmcvfs.delete(cache_dir + cache_file)
+            continue
+
+        entry = _read_entry(cache_dir + cache_file)
+        if entry is None or entry.get("expires", 0) <= time.time():
+            xbmcvfs.delete(cache_dir + cache_file)
+            removed = removed + 1
+
+    return removed
+
+
+def _read_entry(cache_file: str) -> Optional[dict]:
+    if not os.path.exists(cache_file):
+        return None
+
+    try:
+        with open(cache_file, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
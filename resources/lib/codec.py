@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Crunchyroll
+# Copyright (C) 2018 MrKrabat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Serialization of model objects for storage. Objects are wrapped with their class name and format version and
+# written as compact json. Data written by the previous Object.__str__ serializer is read as version 0.
+
+import json
+from typing import Optional, Type, TypeVar
+
+from .model import Object
+
+T = TypeVar("T", bound=Object)
+
+
+def encode(obj: Object) -> bytes:
+    envelope = {"_": obj.__class__.__name__, "v": obj.VERSION, "data": obj.to_dict()}
+
+    return json.dumps(envelope, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def decode(cls: Type[T], raw: bytes) -> Optional[T]:
+    """ restore an object of class cls, None if raw is unreadable, of another class or of an unknown version """
+
+    try:
+        envelope = json.loads(raw.decode("utf-8"))
+    except ValueError:
+        return None
+
+    if not isinstance(envelope, dict) or envelope.get("_") != cls.__name__:
+        return None
+
+    if "v" not in envelope:
+        # written by Object.__str__, the attributes are at top level
+        return cls.from_dict(envelope, 0)
+
+    return cls.from_dict(envelope.get("data") or {}, envelope.get("v"))
@@ -15,45 +15,80 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import json
-import math
+import os
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import inputstreamhelper
 import xbmc
 import xbmcgui
 import xbmcplugin
-from requests import ConnectionError
+import xbmcvfs
 
+from . import cache
+from . import listwarmer
+from . import playback
 from . import utils
 from . import view
+from . import watched
+from . import widgets
 from .api import API
-from .model import EpisodeData, MovieData
+from .downloader import DownloadCancelled, DownloadError, DownloadQuotaError, DownloadStore, SegmentDownloader
+from .history import HistoryStore
+from .jsonstream import JsonItemStream
+from .model import CrunchyrollError, EpisodeData, MediaData, MovieData
+from .nextup import NextUp
+from .upnext import UpNext
 from .videostream import VideoStream
 
+# number of streams resolved at the same time for "play all from here"
+PLAYLIST_CONCURRENCY = 4
+# days the recently watched view of the history goes back
+HISTORY_RECENT_DAYS = 7
+# searchable types and the label of their folder
+SEARCH_TYPES = {"series": 30124, "movie_listing": 30125, "episode": 30126}
+SEARCH_PAGE_SIZE = 50
+# seconds search results are cached
+SEARCH_CACHE_TTL = 15 * 60
+# seconds a widget may take to list, only logged, as nothing in it waits for the network
+WIDGET_TIME_BUDGET = 0.1
+
 
 def show_queue(args, api: API):
     """ shows anime queue/playlist
     """
-    # api request
-    req = api.make_request(
-        method="GET",
-        url=api.WATCHLIST_LIST_ENDPOINT.format(api.account_data.account_id),
-        params={
-            "n": 1024,
-            "locale": args.subtitle
-        }
-    )
+    # the service keeps the watchlist warm, ask the api only if it didn't yet
+    warm = listwarmer.load(args, listwarmer.WATCHLIST)
+    if warm is not None:
+        req = JsonItemStream.from_data(warm, "items")
+    else:
+        req = api.make_list_request(
+            method="GET",
+            url=api.WATCHLIST_LIST_ENDPOINT.format(api.account_data.account_id),
+            items_key="items",
+            fields=MediaData.API_FIELDS,
+            params={
+                "n": 1024,
+                "locale": args.subtitle
+            }
+        )
 
-    # check for error
-    if "error" in req:
+    # check for error, as far as known before reading the items
+    if "error" in req.meta:
         view.add_item(args, {"title": args.addon.getLocalizedString(30061)})
         view.end_of_directory(args)
         return False
 
+    # a fresh watchlist renews the watched state of its items, before they are listed
+    store = watched.get_store(args) if warm is None else None
+
     # display media
-    for item in req.get("items"):
+    for item in req:
+        if store:
+            store.update_from_items([item])
+
         # video no longer available
         # @TODO: re-add filtering of non-available items / premium content
         # if not ("most_likely_media" in item and "series" in item and item["most_likely_media"]["available"] and item["most_likely_media"]["premium_available"]):
@@ -69,29 +104,12 @@ def show_queue(args, api: API):
                                   xbmc.LOGERROR)
                 continue
 
+            info = entry.to_info()
+            info["mode"] = "videoplay"
+
             view.add_item(
                 args,
-                {
-                    "title": entry.title,
-                    "tvshowtitle": entry.tvshowtitle,
-                    "duration": entry.duration,
-                    "playcount": entry.playcount,
-                    "episode": entry.episode,
-                    "episode_id": entry.episode_id,
-                    "collection_id": entry.collection_id,
-                    "series_id": entry.series_id,
-                    "plot": entry.plot,
-                    "plotoutline": entry.plotoutline,
-                    "genre": "",  # no longer available
-                    "year": entry.year,
-                    "aired": entry.aired,
-                    "premiered": entry.premiered,
-                    "thumb": entry.thumb,
-                    "fanart": entry.fanart,
-                    "stream_id": entry.stream_id,
-                    "playhead": entry.playhead,
-                    "mode": "videoplay"
-                },
+                info,
                 is_folder=False
                 # potentially unsafe, it can possibly delete the whole playlist if something goes really wrong
                 # callback=lambda li:
@@ -100,7 +118,59 @@ def show_queue(args, api: API):
         except Exception:
             utils.log_error_with_trace(args, "Failed to add item to queue view: %s" % (json.dumps(item, indent=4)))
 
+    if store:
+        store.save()
+
+    # a streamed body tells about errors only once it has been read
+    if "error" in req.meta:
+        utils.crunchy_log(args, "Failed to read the watchlist: %s" % req.meta.get("error"), xbmc.LOGERROR)
+        view.add_item(args, {"title": args.addon.getLocalizedString(30061)})
+        view.end_of_directory(args)
+        return False
+
+    view.end_of_directory(args)
+    return True
+
+
+def show_next_up(args, api: API):
+    """ shows the next episode to watch of recently watched series
+    """
+    for info in NextUp(args, api).get_items():
+        info["mode"] = "videoplay"
+
+        view.add_item(
+            args,
+            info,
+            is_folder=False
+        )
+
+    view.end_of_directory(args)
+    return True
+
+
+def show_widget(args):
+    """ shows a widget from its snapshot, without logging in or touching the network
+    """
+    started = time.time()
+    source = getattr(args, "source", "")
+
+    snapshot = widgets.load_snapshot(args, source) if source in widgets.SOURCES else None
+    age = int(time.time() - snapshot.get("created", 0)) if snapshot else -1
+
+    # the service answers with fresh snapshots, skins can pick them up through widgets.UPDATED_PROPERTY
+    if not snapshot or age > widgets.MAX_AGE:
+        widgets.request_refresh()
+
+    for info in (snapshot or {}).get("items", [])[:widgets.get_limit(args)]:
+        view.add_item(args, info, is_folder=info.get("mode") != "videoplay")
+
+    xbmcplugin.setProperty(int(args.argv[1]), "snapshot_age", str(age))
     view.end_of_directory(args)
+
+    elapsed = time.time() - started
+    if elapsed > WIDGET_TIME_BUDGET:
+        utils.crunchy_log(args, "Widget %s took %.3fs" % (source, elapsed), xbmc.LOGWARNING)
+
     return True
 
 
@@ -115,68 +185,54 @@ def search_anime(args, api: API):
     else:
         d = args.search
 
-    # api request
-    # available types seem to be: music,series,episode,top_results,movie_listing
-    # @todo: we could search for all types, then first present a listing of the types we have search results for
-    #        the user then could pick one of these types and get presented with a filtered search result for that
-    #        type only.
-    req = api.make_request(
-        method="GET",
-        url=api.SEARCH_ENDPOINT,
-        params={
-            "n": 50,
-            "q": d,
-            "locale": args.subtitle,
-            "start": int(getattr(args, "offset", 0)),
-            "type": "series"
-        }
-    )
+    search_type = getattr(args, "search_type", None)
+    offset = int(getattr(args, "offset", 0))
+
+    # without a type, all types are searched with a single request and a folder per type is shown. its first page is
+    # cached by that request, so opening the folder needs no further request.
+    buckets = _get_search_results(args, api, d, search_type, offset)
 
     # check for error
-    if "error" in req:
+    if buckets is None:
         view.add_item(args, {"title": args.addon.getLocalizedString(30061)})
         view.end_of_directory(args)
         return False
 
-    items_left = 0
+    if not search_type:
+        for bucket_type in SEARCH_TYPES:
+            bucket = buckets.get(bucket_type)
+            if not bucket or not bucket.get("items"):
+                continue
 
-    for types in req["items"]:
-        for item in types["items"]:
-            # add to view
             view.add_item(
                 args,
                 {
-                    "title": item["title"],
-                    "tvshowtitle": item["title"],
-                    "series_id": item["id"],
-                    "plot": item["description"],
-                    "plotoutline": item["description"],
-                    "genre": "",  # requires fetch from api endpoint
-                    "year": item["series_metadata"]["series_launch_year"],
-                    "studio": "",
-                    "thumb": utils.get_image_from_struct(item, "poster_tall", 2),
-                    "fanart": utils.get_image_from_struct(item, "poster_wide", 2),
-                    "rating": 0,
-                    "mode": "series"
+                    "title": "%s (%d)" % (args.addon.getLocalizedString(SEARCH_TYPES[bucket_type]),
+                                          bucket.get("total") or len(bucket.get("items"))),
+                    "search": d,
+                    "search_type": bucket_type,
+                    "mode": args.mode
                 },
-                is_folder=True,
-                # for yet unknown reason, adding an item to the watchlist requires a session restart
-                callback=lambda li:
-                li.addContextMenuItems([(args.addon.getLocalizedString(30067),
-                                         'RunPlugin(%s?mode=add_to_queue&content_id=%s&session_restart=True)' % (
-                                             sys.argv[0], item["id"]))])
+                is_folder=True
             )
 
-        # for now break as we only support one type
-        items_left = types["total"] - (int(getattr(args, "offset", 0)) * 50) - len(types["items"])
-        break
+        view.end_of_directory(args)
+        return True
+
+    bucket = buckets.get(search_type) or {}
+    for item in bucket.get("items", []):
+        try:
+            _add_search_item(args, search_type, item)
+        except Exception:
+            utils.log_error_with_trace(args, "Failed to add item to search view: %s" % (json.dumps(item, indent=4)))
 
     # show next page button
-    if items_left > 0:
+    if bucket.get("total", 0) - offset - len(bucket.get("items", [])) > 0:
         view.add_item(args,
                       {"title": args.addon.getLocalizedString(30044),
-                       "offset": int(getattr(args, "offset", 0)) + 50,
+                       "offset": offset + SEARCH_PAGE_SIZE,
                        "search": d,
+                       "search_type": search_type,
                        "mode": args.mode},
                       is_folder=True)
 
@@ -185,31 +241,180 @@ def search_anime(args, api: API):
     return True
 
 
-def show_history(args, api: API):
-    """ shows history of watched anime
+def _get_search_results(args, api: API, query: str, search_type, offset: int):
+    """ get the search results by type as {type: {"total", "items"}}, cached per query, type and page
     """
-    items_per_page = 50
-    current_page = int(getattr(args, "offset", 1))
+    if search_type:
+        bucket = cache.load(args, "search", _get_search_cache_key(args, query, search_type, offset))
+        if bucket is not None:
+            return {search_type: bucket}
+
+    params = {
+        "n": SEARCH_PAGE_SIZE,
+        "q": query,
+        "locale": args.subtitle,
+        "start": offset
+    }
+    # the api answers with one bucket per type if no type is given
+    if search_type:
+        params["type"] = search_type
+
+    req = api.make_request(
+        method="GET",
+        url=api.SEARCH_ENDPOINT,
+        params=params
+    )
+
+    if not req or "error" in req:
+        return None
+
+    buckets = {}
+    for bucket in req.get("items", []):
+        bucket_type = bucket.get("type")
+        if bucket_type not in SEARCH_TYPES:
+            continue
+
+        buckets[bucket_type] = {"total": bucket.get("total", 0), "items": bucket.get("items", [])}
+        cache.store(
+            args,
+            "search",
+            _get_search_cache_key(args, query, bucket_type, offset),
+            buckets[bucket_type],
+            time.time() + SEARCH_CACHE_TTL
+        )
+
+    return buckets
+
+
+def _get_search_cache_key(args, query: str, search_type: str, offset: int) -> str:
+    return "%s_%s_%d_%d_%s" % (
+        hashlib.sha1(query.encode("utf-8")).hexdigest(), search_type, offset, SEARCH_PAGE_SIZE, args.subtitle
+    )
+
+
+def _add_search_item(args, search_type: str, item):
+    if search_type == "series":
+        view.add_item(
+            args,
+            {
+                "title": item["title"],
+                "tvshowtitle": item["title"],
+                "series_id": item["id"],
+                "plot": item["description"],
+                "plotoutline": item["description"],
+                "genre": "",  # requires fetch from api endpoint
+                "year": item["series_metadata"]["series_launch_year"],
+                "studio": "",
+                "thumb": utils.get_image_from_struct(item, "poster_tall", 2),
+                "fanart": utils.get_image_from_struct(item, "poster_wide", 2),
+                "rating": 0,
+                "mode": "series"
+            },
+            is_folder=True,
+            callback=lambda li:
+            li.addContextMenuItems([(args.addon.getLocalizedString(30067),
+                                     'RunPlugin(%s?mode=add_to_queue&content_id=%s)' % (
+                                         sys.argv[0], item["id"]))])
+        )
+    elif search_type == "movie_listing":
+        view.add_item(
+            args,
+            {
+                "title": item["title"],
+                "tvshowtitle": item["title"],
+                "movie_listing_id": item["id"],
+                "plot": item.get("description"),
+                "plotoutline": item.get("description"),
+                "year": (item.get("movie_listing_metadata") or {}).get("movie_release_year"),
+                "thumb": utils.get_image_from_struct(item, "poster_tall", 2),
+                "fanart": utils.get_image_from_struct(item, "poster_wide", 2),
+                "mode": "movies"
+            },
+            is_folder=True
+        )
+    elif search_type == "episode":
+        # search results are panels, just like watchlist and history items
+        info = EpisodeData({"panel": item}).to_info()
+        info["mode"] = "videoplay"
+        view.add_item(args, info, is_folder=False)
+
 
+def view_movies(args, api: API):
+    """ view all movies of a movie listing
+    """
     req = api.make_request(
         method="GET",
-        url=api.HISTORY_ENDPOINT.format(api.account_data.account_id),
+        url=api.MOVIES_ENDPOINT.format(api.account_data.cms.bucket),
         params={
-            "page_size": items_per_page,
-            "page": current_page,
             "locale": args.subtitle,
+            "movie_listing_id": args.movie_listing_id
         }
     )
 
     # check for error
-    if "error" in req:
+    if not req or "error" in req:
         view.add_item(args, {"title": args.addon.getLocalizedString(30061)})
         view.end_of_directory(args)
         return False
 
-    num_pages = int(math.ceil(req["total"] / items_per_page))
+    for item in req.get("items", []):
+        try:
+            stream_id = utils.get_stream_id_from_url(item.get("__links__", {}).get("streams", {}).get("href", ""))
+            if stream_id is None:
+                continue
+
+            view.add_item(
+                args,
+                {
+                    "title": item["title"],
+                    "tvshowtitle": item["title"],
+                    "duration": int(item.get("duration_ms", 0) / 1000),
+                    "episode_id": item["id"],
+                    "plot": item.get("description"),
+                    "plotoutline": item.get("description"),
+                    "thumb": utils.get_image_from_struct(item, "thumbnail", 2) or args.thumb,
+                    "fanart": args.fanart,
+                    "mode": "videoplay",
+                    "stream_id": stream_id
+                },
+                is_folder=False
+            )
+        except Exception:
+            utils.log_error_with_trace(args, "Failed to add item to view_movies view: %s" % (json.dumps(item, indent=4)))
+
+    view.end_of_directory(args)
+    return True
+
+
+def show_history(args, api: API):
+    """ shows history of watched anime
+    """
+    current_page = int(getattr(args, "offset", 1))
+    history_view = getattr(args, "history_view", None)
+
+    # browsing is local, only the first page of every view asks for what was played since the last visit
+    store = HistoryStore(args, api)
+    if current_page == 1:
+        store.sync()
+
+    if history_view == "series" and not getattr(args, "series_id", None):
+        entries = store.get_series()
+    elif history_view == "series":
+        entries = store.get_series_entries(args.series_id)
+    elif history_view == "recent":
+        entries = store.get_recent(HISTORY_RECENT_DAYS)
+    else:
+        entries = store.get_page(current_page)
+
+        if current_page == 1:
+            for view_name, label in [("series", 30127), ("recent", 30128)]:
+                view.add_item(args,
+                              {"title": args.addon.getLocalizedString(label),
+                               "history_view": view_name,
+                               "mode": args.mode},
+                              is_folder=True)
 
-    for item in req.get("data"):
+    for item in entries:
         try:
             # skip episodes completely that don't have at least the type information
             # @see https://github.com/smirgol/plugin.video.crunchyroll/issues/8
@@ -226,39 +431,35 @@ def show_history(args, api: API):
                 continue
 
             # add to view
+            info = entry.to_info()
+            info["mode"] = "videoplay"
+
+            if history_view == "series" and not getattr(args, "series_id", None) and entry.series_id:
+                # a folder per series, with the series' entries in it
+                view.add_item(args,
+                              {"title": entry.tvshowtitle,
+                               "tvshowtitle": entry.tvshowtitle,
+                               "thumb": entry.thumb,
+                               "fanart": entry.fanart,
+                               "series_id": entry.series_id,
+                               "history_view": "series",
+                               "mode": args.mode},
+                              is_folder=True)
+                continue
+
             view.add_item(
                 args,
-                {
-                    "title": entry.title,
-                    "tvshowtitle": entry.tvshowtitle,
-                    "duration": entry.duration,
-                    "playcount": entry.playcount,
-                    "episode": entry.episode,
-                    "episode_id": entry.episode_id,
-                    "collection_id": entry.collection_id,
-                    "series_id": entry.series_id,
-                    "plot": entry.plot,
-                    "plotoutline": entry.plotoutline,
-                    "genre": "",  # no longer available
-                    "year": entry.year,
-                    "aired": entry.aired,
-                    "premiered": entry.premiered,
-                    "thumb": entry.thumb,
-                    "fanart": entry.fanart,
-                    "stream_id": entry.stream_id,
-                    "playhead": entry.playhead,
-                    "mode": "videoplay"
-                },
+                info,
                 is_folder=False
             )
 
         except Exception:
             utils.log_error_with_trace(args, "Failed to add item to history view: %s" % (json.dumps(item, indent=4)))
 
-    if current_page < num_pages:
+    if not history_view and current_page < store.get_page_count():
         view.add_item(args,
                       {"title": args.addon.getLocalizedString(30044),
-                       "offset": int(getattr(args, "offset", 1)) + 1,
+                       "offset": current_page + 1,
                        "mode": args.mode},
                       is_folder=True)
 
@@ -274,7 +475,7 @@ def list_seasons(args, mode, api: API):
 
     # if no seasons filter applied, list all available seasons
     if not season_filter:
-        req = api.make_request(
+        req = listwarmer.load(args, listwarmer.SEASONAL_TAGS) or api.make_request(
             method="GET",
             url=api.SEASONAL_TAGS_ENDPOINT,
             params={
@@ -337,10 +538,9 @@ def list_seasons(args, mode, api: API):
                     "mode": "series"
                 },
                 is_folder=True,
-                # for yet unknown reason, adding an item to the watchlist requires a session restart
                 callback=lambda li:
                 li.addContextMenuItems([(args.addon.getLocalizedString(30067),
-                                         'RunPlugin(%s?mode=add_to_queue&content_id=%s&session_restart=True)' % (
+                                         'RunPlugin(%s?mode=add_to_queue&content_id=%s)' % (
                                              sys.argv[0], item["id"]))])
 
             )
@@ -414,7 +614,7 @@ def list_filter(args, mode, api: API):
     # if no category_filter filter applied, list all available categories
     if not category_filter and category_filter not in specials:
         # api request for category names / tags
-        req = api.make_request(
+        req = listwarmer.load(args, listwarmer.CATEGORIES) or api.make_request(
             method="GET",
             url=api.CATEGORIES_ENDPOINT,
             params={
@@ -501,10 +701,9 @@ def list_filter(args, mode, api: API):
                     "mode": "series"
                 },
                 is_folder=True,
-                # for yet unknown reason, adding an item to the watchlist requires a session restart
                 callback=lambda li:
                 li.addContextMenuItems([(args.addon.getLocalizedString(30067),
-                                         'RunPlugin(%s?mode=add_to_queue&content_id=%s&session_restart=True)' % (
+                                         'RunPlugin(%s?mode=add_to_queue&content_id=%s)' % (
                                              sys.argv[0], item["id"]))])
             )
 
@@ -614,6 +813,10 @@ def view_series(args, api: API):
                 },
                 is_folder=True
             )
+            # episode lists seen before tell which thumbnails are shown when the season is opened
+            episodes = UpNext(args, api).get_cached_season_episodes(item["id"])
+            if episodes:
+                view.add_extra_artwork(utils.get_image_from_struct(episode, "thumbnail", 2) for episode in episodes)
         except Exception:
             utils.log_error_with_trace(args,
                                        "Failed to add item to view_series view: %s" % (json.dumps(item, indent=4)))
@@ -635,30 +838,32 @@ def view_episodes(args, api: API):
         }
     )
 
-    # @TODO: collect all episodes ids and make a call to "playheads" api endpoint,
-    #        to find out if and which we haven't seen fully yet.
-
     # check for error
     if "error" in req:
         view.add_item(args, {"title": args.addon.getLocalizedString(30061)})
         view.end_of_directory(args)
         return False
 
-    # for the watched status, we need an extra call to api, providing it with all episode ids.
-    # this relies fully on the watched status from crunchyroll, the old approach with percentage was better,
-    # but it's much more effort to get the duration of the episodes at this point, as it's not provided by the endpoint
-    episode_ids = []
-    for item in req["items"]:
-        episode_ids.append(item.get('id'))
-
-    req_playheads = api.make_request(
-        method="GET",
-        url=api.PLAYHEADS_ENDPOINT.format(api.account_data.account_id),
-        params={
-            "locale": args.subtitle,
-            "content_ids": ','.join(episode_ids)
-        }
-    )
+    # the watched status relies fully on crunchyroll, as the endpoint doesn't provide playheads. only episodes the
+    # watched state store doesn't know recently are asked for.
+    store = watched.get_store(args)
+    episode_ids = store.get_missing(item.get("id") for item in req["items"])
+    if episode_ids:
+        req_playheads = api.make_request(
+            method="GET",
+            url=api.PLAYHEADS_ENDPOINT.format(api.account_data.account_id),
+            params={
+                "locale": args.subtitle,
+                "content_ids": ','.join(episode_ids)
+            }
+        )
+        if req_playheads and "error" not in req_playheads:
+            store.update_from_playheads(req_playheads)
+            # episodes without playhead haven't been watched at all
+            for episode_id in episode_ids:
+                if not store.get(episode_id, fresh=True):
+                    store.update(episode_id, 0, False)
+            store.save()
 
     # display media
     for item in req["items"]:
@@ -676,7 +881,7 @@ def view_episodes(args, api: API):
                     "title": item["series_title"] + " #" + str(item["episode_number"]) + " - " + item["title"],
                     "tvshowtitle": item["series_title"],
                     "duration": int(item["duration_ms"] / 1000),
-                    "playcount": utils.get_watched_status_from_playheads_data(req_playheads, item["id"]),
+                    "playcount": 0,
                     "episode": item["episode_number"],
                     "episode_id": item["id"],
                     "collection_id": args.collection_id,
@@ -692,7 +897,17 @@ def view_episodes(args, api: API):
                     "stream_id": stream_id,
                     "playhead": None
                 },
-                is_folder=False
+                is_folder=False,
+                callback=lambda li, episode_id=item["id"], series_id=item["series_id"], stream_id=stream_id,
+                title=item["series_title"] + " #" + str(item["episode_number"]) + " - " + item["title"]:
+                li.addContextMenuItems([
+                    (args.addon.getLocalizedString(30093),
+                     'RunPlugin(%s?mode=play_all&collection_id=%s&series_id=%s&episode_id=%s)' % (
+                         sys.argv[0], args.collection_id, series_id, episode_id)),
+                    (args.addon.getLocalizedString(30103),
+                     'RunPlugin(%s?mode=download&stream_id=%s&episode_id=%s&title=%s)' % (
+                         sys.argv[0], stream_id, episode_id, view.quote_value(title)))
+                ])
             )
         except Exception:
             utils.log_error_with_trace(args,
@@ -709,10 +924,9 @@ def start_playback(args, api: API):
     # get stream url
     ##############################
 
-    # there are tons of different stream types. not sure which one to pick...
-    # also, would be very interesting to make the streams switchable in kodi...
+    # there are tons of different stream types, the ones without drm are picked by the StreamSelector:
     # adaptive_dash
-    # adaptive_hls - I chose this, which works for me
+    # adaptive_hls
     # download_dash
     # download_hls
     # drm_adaptive_dash
@@ -736,6 +950,7 @@ def start_playback(args, api: API):
             item = xbmcgui.ListItem(getattr(args, "title", "Title not provided"))
             xbmcplugin.setResolvedUrl(int(args.argv[1]), False, item)
             xbmcgui.Dialog().ok(args.addonname, args.addon.getLocalizedString(30064))
+            return False
 
     except Exception:
         utils.log_error_with_trace(args, "Failed to prepare stream info data")
@@ -745,109 +960,255 @@ def start_playback(args, api: API):
         return False
 
     # prepare playback
-    item = xbmcgui.ListItem(getattr(args, "title", "Title not provided"), path=stream_info.stream_url)
-    item.setMimeType("application/vnd.apple.mpegurl")
-    item.setContentLookup(False)
+    item, use_inputstream = playback.create_play_item(args, stream_info, getattr(args, "title", "Title not provided"))
+
+    # the service takes over from here: it measures the startup time, offers to resume, syncs the playhead and
+    # falls back to playback without inputstream adaptive if necessary
+    playback.register_session({
+        "path": stream_info.stream_url,
+        "episode_id": getattr(args, "episode_id", None),
+        "collection_id": getattr(args, "collection_id", None),
+        "series_id": getattr(args, "series_id", None),
+        "stream_id": args.stream_id,
+        "stream_type": stream_info.stream_type,
+        "title": getattr(args, "title", "Title not provided"),
+        "duration": getattr(args, "duration", None),
+        "playhead": args.playhead,
+        "inputstream": use_inputstream,
+        "resolved_at": time.time()
+    })
+
+    # start playback
+    xbmcplugin.setResolvedUrl(int(args.argv[1]), True, item)
 
-    # inputstream adaptive
-    is_helper = inputstreamhelper.Helper("hls")
-    if is_helper.check_inputstream():
-        item.setProperty("inputstream", "inputstream.adaptive")
-        item.setProperty("inputstream.adaptive.manifest_type", "hls")
-        # add soft subtitles url for configured language
-        if stream_info.subtitle_urls:
-            item.setSubtitles(stream_info.subtitle_urls)
-
-        # start playback
-        xbmcplugin.setResolvedUrl(int(args.argv[1]), True, item)
-
-        # wait for playback
-        if wait_for_playback(10):
-            # if successful wait more
-            xbmc.sleep(3000)
-
-    # @TODO: fallbacks not tested
-
-    # start fallback
-    if not wait_for_playback(2):
-        # start without inputstream adaptive
-        utils.crunchy_log(args, "Inputstream Adaptive failed, trying directly with kodi", xbmc.LOGDEBUG)
-        item.setProperty("inputstream", "")
-        xbmc.Player().play(stream_info.stream_url, item)
-
-    # sync playtime with crunchyroll
-    if args.addon.getSetting("sync_playtime") == "true":
-        # fetch playhead info from api
-        if hasattr(args, 'playhead') is False or args.playhead is None:
-            args.playhead = 0
-
-            req_episode_data = api.make_request(
-                method="GET",
-                url=api.PLAYHEADS_ENDPOINT.format(api.account_data.account_id),
-                params={
-                    "locale": args.subtitle,
-                    "content_ids": args.episode_id
-                }
-            )
+    return True
 
-            if req_episode_data and req_episode_data["data"]:
-                args.playhead = int(req_episode_data["data"][0]["playhead"])
 
-        # wait for video to begin
-        player = xbmc.Player()
-        if not wait_for_playback(30):
-            utils.crunchy_log(args, "Timeout reached, video did not start in 30 seconds", xbmc.LOGERROR)
-            return
+def play_all(args, api: API) -> bool:
+    """ plays the episodes of a season starting at episode_id as playlist
+    """
+    try:
+        episodes = UpNext(args, api).get_season_episodes(args.collection_id)
+    except CrunchyrollError:
+        utils.log_error_with_trace(args, "Failed to load episodes for play all", False)
+        episodes = []
 
-        # ask if user want to continue playback
-        if args.playhead and args.duration:
-            resume = int(int(args.playhead) / float(args.duration) * 100)
-            if 5 <= resume <= 90:
-                player.pause()
-                if xbmcgui.Dialog().yesno(args.addonname, args.addon.getLocalizedString(30065) % int(resume)):
-                    player.seekTime(float(args.playhead) - 5)
-                player.pause()
+    start = next((index for index, episode in enumerate(episodes) if episode.get("id") == args.episode_id), None)
+    if start is None:
+        xbmcgui.Dialog().ok(args.addonname, args.addon.getLocalizedString(30064))
+        return False
 
-        # update playtime at crunchyroll
-        try:
-            while stream_info.stream_url == player.getPlayingFile():
-                # wait 10 seconds
-                xbmc.sleep(10000)
-
-                if stream_info.stream_url == player.getPlayingFile():
-                    # api request
-                    try:
-                        api.make_request(
-                            method="POST",
-                            url=api.PLAYHEADS_ENDPOINT.format(api.account_data.account_id),
-                            json={
-                                "playhead": int(player.getTime()),
-                                "content_id": args.episode_id
-                            },
-                            headers={
-                                'Content-Type': 'application/json'
-                            }
-                        )
-                    except ConnectionError:
-                        # catch timeout exception
-                        pass
-        except RuntimeError:
-            utils.crunchy_log(args, "Playback aborted", xbmc.LOGDEBUG)
-
-
-def wait_for_playback(timeout=30):
-    """ function that waits for playback
+    episodes = episodes[start:start + max(1, int(args.addon.getSetting("play_all_count") or 12))]
+
+    progress = xbmcgui.DialogProgressBG()
+    progress.create(args.addonname, args.addon.getLocalizedString(30094))
+
+    # resolving one after another takes far too long for a whole season, so do it in parallel
+    resolved = {}
+    with ThreadPoolExecutor(max_workers=PLAYLIST_CONCURRENCY) as pool:
+        futures = {pool.submit(_resolve_episode_stream, args, api, episode): episode for episode in episodes}
+        for done, future in enumerate(as_completed(futures), 1):
+            episode = futures[future]
+            try:
+                stream_info = future.result()
+                if stream_info and stream_info.stream_url:
+                    resolved[episode.get("id")] = stream_info
+                else:
+                    utils.crunchy_log(args, "No stream found for %s, skipping it" % episode.get("id"), xbmc.LOGERROR)
+            except Exception:
+                utils.log_error_with_trace(args, "Failed to resolve %s, skipping it" % episode.get("id"), False)
+
+            progress.update(int(done * 100 / len(episodes)), message=UpNext.get_episode_title(episode))
+
+    progress.close()
+
+    if not resolved:
+        xbmcgui.Dialog().ok(args.addonname, args.addon.getLocalizedString(30064))
+        return False
+
+    playlist = xbmc.PlayList(xbmc.PLAYLIST_VIDEO)
+    playlist.clear()
+
+    for episode in episodes:
+        stream_info = resolved.get(episode.get("id"))
+        if not stream_info:
+            continue
+
+        title = UpNext.get_episode_title(episode)
+        duration = int(episode.get("duration_ms", 0) / 1000)
+        item, use_inputstream = playback.create_play_item(args, stream_info, title)
+        item.setInfo("video", {
+            "title": title,
+            "tvshowtitle": episode.get("series_title"),
+            "episode": episode.get("episode_number"),
+            "duration": duration,
+            "plot": episode.get("description"),
+            "mediatype": "episode"
+        })
+        item.setArt({"thumb": utils.get_image_from_struct(episode, "thumbnail", 2)})
+
+        playback.register_session({
+            "path": stream_info.stream_url,
+            "episode_id": episode.get("id"),
+            "collection_id": episode.get("season_id"),
+            "series_id": episode.get("series_id"),
+            "stream_id": stream_info.stream_id,
+            "stream_type": stream_info.stream_type,
+            "title": title,
+            "duration": duration or None,
+            "playhead": None,
+            "inputstream": use_inputstream,
+            # only the first item starts now, the startup time of the others can't be measured
+            "resolved_at": time.time() if playlist.size() == 0 else None
+        })
+
+        playlist.add(stream_info.stream_url, item)
+
+    xbmc.Player().play(playlist)
+
+    return True
+
+
+def _resolve_episode_stream(args, api: API, episode: dict):
+    stream_id = utils.get_stream_id_from_url(episode.get("__links__", {}).get("streams", {}).get("href", ""))
+
+    return VideoStream(args, api, stream_id).get_player_stream_data()
+
+
+def play_download(args) -> bool:
+    """ plays the downloaded copy of an episode, returns False if there is none
     """
-    timer = time.time() + timeout
-    while not xbmc.getCondVisibility("Player.HasMedia"):
-        xbmc.sleep(50)
-        # timeout to prevent infinite loop
-        if time.time() > timer:
+    store = _get_download_store(args)
+    download = store.get(args.stream_id) if getattr(args, "stream_id", None) else None
+    if not download:
+        return False
+
+    store.touch(args.stream_id)
+
+    item = xbmcgui.ListItem(getattr(args, "title", "Title not provided"), path=download.get("file"))
+    item.setContentLookup(False)
+    if download.get("subtitles"):
+        item.setSubtitles(download.get("subtitles"))
+
+    playback.register_session({
+        "path": download.get("file"),
+        "episode_id": getattr(args, "episode_id", None),
+        "collection_id": getattr(args, "collection_id", None),
+        "series_id": getattr(args, "series_id", None),
+        "stream_id": args.stream_id,
+        "stream_type": None,
+        "title": getattr(args, "title", "Title not provided"),
+        "duration": getattr(args, "duration", None),
+        "playhead": args.playhead,
+        "inputstream": False,
+        "resolved_at": None
+    })
+
+    xbmcplugin.setResolvedUrl(int(args.argv[1]), True, item)
+
+    return True
+
+
+def download_episode(args, api: API) -> bool:
+    """ downloads an episode with its subtitles for offline playback
+    """
+    store = _get_download_store(args)
+    if store.get(args.stream_id):
+        xbmcgui.Dialog().notification(args.addonname, args.addon.getLocalizedString(30105), xbmcgui.NOTIFICATION_INFO)
+        return True
+
+    try:
+        stream_info = VideoStream(args, api).get_download_stream_data()
+        if not stream_info or not stream_info.stream_url:
+            utils.crunchy_log(args, "Failed to load stream info for download", xbmc.LOGERROR)
+            xbmcgui.Dialog().ok(args.addonname, args.addon.getLocalizedString(30064))
             return False
 
+    except Exception:
+        utils.log_error_with_trace(args, "Failed to prepare stream info data for download")
+        xbmcgui.Dialog().ok(args.addonname, args.addon.getLocalizedString(30064))
+        return False
+
+    title = getattr(args, "title", "Title not provided")
+    target_dir = store.get_target_dir(args.stream_id)
+    monitor = xbmc.Monitor()
+    progress = xbmcgui.DialogProgressBG()
+    progress.create(args.addonname, args.addon.getLocalizedString(30104))
+
+    downloader = SegmentDownloader(
+        headers={"User-Agent": utils.headers().get("User-Agent")},
+        concurrency=int(args.addon.getSetting("download_concurrency") or 4),
+        log=lambda message: utils.crunchy_log(args, message, xbmc.LOGDEBUG)
+    )
+
+    try:
+        result = downloader.download(
+            stream_info.stream_url,
+            target_dir,
+            VideoStream.MAX_RESOLUTIONS[int(args.addon.getSetting("hls_max_resolution") or 0)],
+            int(args.addon.getSetting("hls_max_bandwidth") or 0) * 1000,
+            reserve=lambda size: store.ensure_space(size, keep=args.stream_id),
+            progress=lambda done, total: progress.update(int(done * 100 / total), message=title),
+            cancelled=monitor.abortRequested
+        )
+    except DownloadCancelled:
+        # the parts stay, so the download continues next time
+        progress.close()
+        return False
+    except DownloadQuotaError:
+        progress.close()
+        xbmcgui.Dialog().ok(args.addonname, args.addon.getLocalizedString(30107))
+        return False
+    except DownloadError as e:
+        progress.close()
+        utils.crunchy_log(args, "Download of %s failed: %s" % (args.stream_id, e), xbmc.LOGERROR)
+        xbmcgui.Dialog().ok(args.addonname, args.addon.getLocalizedString(30106))
+        return False
+    except Exception:
+        progress.close()
+        utils.log_error_with_trace(args, "Download of %s failed" % args.stream_id)
+        return False
+
+    progress.close()
+
+    # subtitles are cached with names kodi shows as label, keep them
+    subtitles = []
+    for subtitle_url in stream_info.subtitle_urls or []:
+        subtitle_file = os.path.join(target_dir, os.path.basename(subtitle_url))
+        if xbmcvfs.copy(subtitle_url, subtitle_file):
+            subtitles.append(subtitle_file)
+            result["size"] = result["size"] + os.path.getsize(subtitle_file)
+
+    store.add(args.stream_id, {
+        "file": result["file"],
+        "subtitles": subtitles,
+        "size": result["size"],
+        "sha256": result["sha256"],
+        "title": title,
+        "episode_id": getattr(args, "episode_id", None)
+    })
+    # the estimate might have been too low
+    store.ensure_space(0, keep=args.stream_id)
+
+    utils.crunchy_log(
+        args,
+        "Downloaded %s: %d bytes at %d KiB/s" % (args.stream_id, result["size"], result["bytes_per_second"] / 1024),
+        xbmc.LOGINFO
+    )
+    xbmcgui.Dialog().notification(args.addonname, args.addon.getLocalizedString(30105), xbmcgui.NOTIFICATION_INFO)
+
     return True
 
 
+def _get_download_store(args) -> DownloadStore:
+    path = args.addon.getSetting("download_path") or args.addon.getAddonInfo("profile") + "downloads/"
+
+    return DownloadStore(
+        xbmcvfs.translatePath(path),
+        int(args.addon.getSetting("download_quota") or 0) * 1024 * 1024 * 1024
+    )
+
+
 def add_to_queue(args, api: API) -> bool:
     # api request
     req = api.make_request(
@@ -885,6 +1246,11 @@ def add_to_queue(args, api: API) -> bool:
         False
     )
 
+    # only the watchlist itself is outdated now
+    listwarmer.invalidate(args, listwarmer.WATCHLIST)
+    if "mode=queue" in xbmc.getInfoLabel("Container.FolderPath"):
+        xbmc.executebuiltin("Container.Refresh")
+
     return True
 
 
@@ -16,6 +16,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import random
+import re
 
 import inputstreamhelper
 import xbmc
@@ -24,6 +25,8 @@ import xbmcgui
 import xbmcplugin
 
 from . import controller
+from . import library
+from . import profiler
 from . import utils
 from . import view
 from .api import API
@@ -32,6 +35,16 @@ from .api import API
 def main(argv):
     """Main function for the addon
     """
+    addon = xbmcaddon.Addon()
+    profiling = profiler.get_mode(addon)
+    if profiling:
+        mode = re.search(r"(?:^\?|&)mode=([^&]*)", argv[2] if len(argv) > 2 else "")
+        return profiler.run(addon, profiling, mode[1] if mode else "main", _main, argv)
+
+    return _main(argv)
+
+
+def _main(argv):
     args = utils.parse(argv)
 
     # inputstream adaptive settings
@@ -44,24 +57,27 @@ def main(argv):
     # get account information
     username = args.addon.getSetting("crunchyroll_username")
     password = args.addon.getSetting("crunchyroll_password")
-    args._device_id = args.addon.getSetting("device_id")
-    if not args.device_id:
-        char_set = "0123456789abcdefghijklmnopqrstuvwxyz0123456789"
-        args._device_id = (
-                "".join(random.sample(char_set, 8)) +
-                "-KODI-" +
-                "".join(random.sample(char_set, 4)) +
-                "-" +
-                "".join(random.sample(char_set, 4)) +
-                "-" +
-                "".join(random.sample(char_set, 12))
-        )
-        args.addon.setSetting("device_id", args.device_id)
+    setup_args(args)
 
-    # get subtitle language
-    args._subtitle = utils.convert_subtitle_index_to_string(args.addon.getSetting("subtitle_language"))
-    args._subtitle_fallback = utils.convert_subtitle_index_to_string(
-        args.addon.getSetting("subtitle_language_fallback"))
+    # widgets are served from snapshots, they must never wait for a login
+    if getattr(args, "mode", None) == "widget":
+        xbmcplugin.setContent(int(args.argv[1]), "episodes")
+        return controller.show_widget(args)
+
+    if getattr(args, "mode", None) == "profiles":
+        archive = profiler.package(args.addon)
+        xbmcgui.Dialog().ok(args.addonname, args.addon.getLocalizedString(30130) % archive if archive
+                            else args.addon.getLocalizedString(30131))
+        return True
+
+    # the service does the export, even if it is disabled for the schedule
+    if getattr(args, "mode", None) == "library_export":
+        library.request_export()
+        return True
+
+    # downloaded episodes play without network, so don't even try to log in
+    if getattr(args, "mode", None) == "videoplay" and controller.play_download(args):
+        return True
 
     api = API(
         args=args,
@@ -89,6 +105,29 @@ def main(argv):
             return False
 
 
+def setup_args(args):
+    """Load device id and language settings into args
+    """
+    args._device_id = args.addon.getSetting("device_id")
+    if not args.device_id:
+        char_set = "0123456789abcdefghijklmnopqrstuvwxyz0123456789"
+        args._device_id = (
+                "".join(random.sample(char_set, 8)) +
+                "-KODI-" +
+                "".join(random.sample(char_set, 4)) +
+                "-" +
+                "".join(random.sample(char_set, 4)) +
+                "-" +
+                "".join(random.sample(char_set, 12))
+        )
+        args.addon.setSetting("device_id", args.device_id)
+
+    # get subtitle language
+    args._subtitle = utils.convert_subtitle_index_to_string(args.addon.getSetting("subtitle_language"))
+    args._subtitle_fallback = utils.convert_subtitle_index_to_string(
+        args.addon.getSetting("subtitle_language_fallback"))
+
+
 def check_mode(args, api: API):
     """Run mode-specific functions
     """
@@ -114,6 +153,8 @@ def check_mode(args, api: API):
         controller.search_anime(args, api)
     elif mode == "history":
         controller.show_history(args, api)
+    elif mode == "continue":
+        controller.show_next_up(args, api)
     # elif mode == "random":
     #     controller.showRandom(args, api)
 
@@ -143,8 +184,14 @@ def check_mode(args, api: API):
         controller.view_series(args, api)
     elif mode == "episodes":
         controller.view_episodes(args, api)
+    elif mode == "movies":
+        controller.view_movies(args, api)
     elif mode == "videoplay":
         controller.start_playback(args, api)
+    elif mode == "play_all":
+        controller.play_all(args, api)
+    elif mode == "download":
+        controller.download_episode(args, api)
     elif mode == "add_to_queue":
         controller.add_to_queue(args, api)
     elif mode == "remove_from_queue":
@@ -168,6 +215,9 @@ def show_main_menu(args):
     view.add_item(args,
                   {"title": args.addon.getLocalizedString(30042),
                    "mode": "history"})
+    view.add_item(args,
+                  {"title": args.addon.getLocalizedString(30118),
+                   "mode": "continue"})
     # #view.add_item(args,
     # #              {"title": args.addon.getLocalizedString(30043),
     # #               "mode":  "random"})
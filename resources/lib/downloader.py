@@ -0,0 +1,448 @@
+# -*- coding: utf-8 -*-
+# Crunchyroll
+# Copyright (C) 2018 MrKrabat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Downloading of HLS streams for offline playback. This module must not depend on kodi, so it can be used and tested
+# outside of it, e.g. against a static HLS fixture served by python's http.server.
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import hls
+
+try:
+    from urlparse import urljoin, urlparse
+except ImportError:
+    from urllib.parse import urljoin, urlparse
+
+PARTS_DIR = "parts"
+STATE_FILE = "state.json"
+PLAYLIST_FILE = "video.m3u8"
+INDEX_FILE = "downloads.json"
+
+
+class DownloadError(Exception):
+    pass
+
+
+class DownloadCancelled(DownloadError):
+    pass
+
+
+class DownloadQuotaError(DownloadError):
+    pass
+
+
+class MediaPlaylist:
+    """ Parsed media playlist, all uris are resolved against the playlist url """
+
+    def __init__(self, content: str, url: str):
+        self.url: str = url
+        # (line, index into uris) pairs, line is None for segments, index None for lines without uri
+        self.lines: List[Tuple[Optional[str], Optional[int]]] = []
+        # uris of segments, keys and init sections in order
+        self.uris: List[str] = []
+        self.segment_count: int = 0
+        self.duration: float = 0
+        self.encrypted: bool = False
+        self.init_section: bool = False
+
+        for line in content.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+
+            if line.startswith("#EXT-X-BYTERANGE"):
+                raise DownloadError("Byte range playlists are not supported")
+
+            if line.startswith("#EXTINF"):
+                self.duration = self.duration + float(line.split(":", 1)[1].split(",", 1)[0] or 0)
+            elif line.startswith("#EXT-X-KEY"):
+                self.encrypted = self.encrypted or hls.parse_attributes(line).get("METHOD", "NONE") != "NONE"
+            elif line.startswith("#EXT-X-MAP"):
+                self.init_section = True
+
+            if not line.startswith("#"):
+                self.lines.append((None, len(self.uris)))
+                self.uris.append(urljoin(url, line))
+                self.segment_count = self.segment_count + 1
+            elif hls.parse_attributes(line).get("URI"):
+                self.lines.append((line, len(self.uris)))
+                self.uris.append(urljoin(url, hls.parse_attributes(line).get("URI")))
+            else:
+                self.lines.append((line, None))
+
+    def get_fingerprint(self) -> List[str]:
+        """ identifies the rendition independent of the url signatures, which change with every request """
+
+        return [urlparse(uri).path for uri in self.uris]
+
+    def build(self, uri_mapper: Callable[[int], str]) -> str:
+        """ serialize the playlist, uri_mapper maps the index of an uri to the uri to use """
+
+        lines = []
+        for line, index in self.lines:
+            if index is None:
+                lines.append(line)
+            elif line is None:
+                lines.append(uri_mapper(index))
+            else:
+                lines.append(hls.URI_ATTRIBUTE_PATTERN.sub(lambda m: 'URI="%s"' % uri_mapper(index), line))
+
+        return "\n".join(lines) + "\n"
+
+
+class SegmentDownloader:
+    """
+    Download an HLS rendition with parallel segment requests
+
+    Every segment is saved as a part file and recorded with its size and sha256 in a state file, so an interrupted
+    download continues where it stopped and damaged parts are detected and fetched again. Unencrypted streams are
+    concatenated into a single file afterwards (segments of a transport stream or fragmented mp4 can simply be joined),
+    encrypted ones are kept as local playlist with their parts and keys.
+    """
+
+    TIMEOUT = 30
+    # attempts per segment before the download fails
+    RETRIES = 3
+    # seconds to wait before retrying a segment, doubled on every further attempt up to the maximum
+    BACKOFF_BASE = 1.0
+    BACKOFF_MAX = 10.0
+
+    def __init__(
+            self,
+            headers: Optional[Dict[str, str]] = None,
+            concurrency: int = 4,
+            log: Optional[Callable[[str], None]] = None
+    ):
+        self.headers: Dict[str, str] = headers or {}
+        self.concurrency: int = max(1, concurrency)
+        self.log: Callable[[str], None] = log or (lambda message: None)
+
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self.concurrency)
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
+
+        # guards the state, which is saved while holding it
+        self.lock = threading.RLock()
+
+    def download(
+            self,
+            url: str,
+            target_dir: str,
+            max_height: int = 0,
+            max_bandwidth: int = 0,
+            reserve: Optional[Callable[[int], bool]] = None,
+            progress: Optional[Callable[[int, int], None]] = None,
+            cancelled: Optional[Callable[[], bool]] = None
+    ) -> Dict:
+        """ download the stream at url (master or media playlist) into target_dir
+
+        reserve is called with the estimated size in bytes before downloading and may refuse it, progress is called
+        with the number of finished and total segments, cancelled is polled to stop the download. returns file, size,
+        sha256 and bytes_per_second of the result.
+        """
+
+        os.makedirs(os.path.join(target_dir, PARTS_DIR), exist_ok=True)
+        started = time.time()
+
+        playlist, bandwidth = self._get_media_playlist(url, max_height, max_bandwidth)
+        if reserve and not reserve(int(bandwidth * playlist.duration / 8)):
+            raise DownloadQuotaError("Not enough space")
+
+        state = self._load_state(target_dir)
+        if state.get("fingerprint") != playlist.get_fingerprint():
+            # a different rendition than last time, the parts don't fit anymore
+            state = {"fingerprint": playlist.get_fingerprint(), "parts": {}}
+
+        missing = [index for index in range(len(playlist.uris)) if not self._verify_part(target_dir, state, index)]
+        downloaded = 0
+        done = len(playlist.uris) - len(missing)
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                futures = [
+                    pool.submit(self._download_part, playlist.uris[index], target_dir, state, index, cancelled)
+                    for index in missing
+                ]
+                try:
+                    for future in as_completed(futures):
+                        downloaded = downloaded + future.result()
+                        done = done + 1
+                        if progress:
+                            progress(done, len(playlist.uris))
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            # after the running parts finished, so they are recorded as well
+            self._save_state(target_dir, state)
+
+        result = self._assemble(target_dir, playlist, state)
+        result["bytes_per_second"] = int(downloaded / max(0.001, time.time() - started))
+
+        self.log("Downloaded %d bytes at %d bytes/s" % (downloaded, result["bytes_per_second"]))
+
+        return result
+
+    def _get_media_playlist(self, url: str, max_height: int, max_bandwidth: int):
+        r = self._get(url)
+        master = hls.MasterPlaylist(r.text, r.url)
+        if not master.is_master():
+            return MediaPlaylist(r.text, r.url), 0
+
+        variants = hls.filter_variants(master.variants, max_height, max_bandwidth)
+        variant = max(variants, key=lambda v: v.bandwidth)
+
+        r = self._get(variant.uri)
+
+        return MediaPlaylist(r.text, r.url), variant.bandwidth
+
+    def _download_part(
+            self,
+            url: str,
+            target_dir: str,
+            state: Dict,
+            index: int,
+            cancelled: Optional[Callable[[], bool]]
+    ) -> int:
+        part_file = self._get_part_file(target_dir, index)
+
+        for attempt in range(self.RETRIES):
+            if attempt:
+                # a failing cdn or connection rarely recovers within milliseconds
+                self._wait(min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** (attempt - 1)), cancelled)
+
+            if cancelled and cancelled():
+                raise DownloadCancelled()
+
+            try:
+                r = self._get(url)
+                expected = r.headers.get("Content-Length")
+                if expected is not None and int(expected) != len(r.content):
+                    raise DownloadError("Incomplete segment %d" % index)
+            except (requests.RequestException, DownloadError) as e:
+                self.log("Segment %d failed (attempt %d): %s" % (index, attempt + 1, e))
+                continue
+
+            with open(part_file + ".tmp", "wb") as file:
+                file.write(r.content)
+            os.replace(part_file + ".tmp", part_file)
+
+            with self.lock:
+                state["parts"][str(index)] = {
+                    "size": len(r.content),
+                    "sha256": hashlib.sha256(r.content).hexdigest()
+                }
+                # save now and then, so a crash doesn't lose all progress
+                if len(state["parts"]) % 20 == 0:
+                    self._save_state(target_dir, state)
+
+            return len(r.content)
+
+        raise DownloadError("Segment %d failed %d times" % (index, self.RETRIES))
+
+    @staticmethod
+    def _wait(delay: float, cancelled: Optional[Callable[[], bool]]) -> None:
+        """ sleep for delay seconds, unless the download is cancelled meanwhile """
+
+        deadline = time.time() + delay
+        while time.time() < deadline:
+            if cancelled and cancelled():
+                raise DownloadCancelled()
+            time.sleep(min(0.2, max(0.0, deadline - time.time())))
+
+    def _verify_part(self, target_dir: str, state: Dict, index: int) -> bool:
+        part = state.get("parts", {}).get(str(index))
+        part_file = self._get_part_file(target_dir, index)
+        if not part or not os.path.exists(part_file) or os.path.getsize(part_file) != part.get("size"):
+            return False
+
+        return _hash_file(part_file) == part.get("sha256")
+
+    def _assemble(self, target_dir: str, playlist: MediaPlaylist, state: Dict) -> Dict:
+        """ join the parts into one file, or write a local playlist for encrypted streams """
+
+        parts_dir = os.path.join(target_dir, PARTS_DIR)
+
+        if playlist.encrypted:
+            with open(os.path.join(target_dir, PLAYLIST_FILE), "w", encoding="utf-8") as file:
+                file.write(playlist.build(lambda index: "%s/%05d" % (PARTS_DIR, index)))
+
+            return {
+                "file": os.path.join(target_dir, PLAYLIST_FILE),
+                "size": _get_dir_size(target_dir),
+                "sha256": None
+            }
+
+        video_file = os.path.join(target_dir, "video.mp4" if playlist.init_section else "video.ts")
+        digest = hashlib.sha256()
+        with open(video_file + ".tmp", "wb") as output:
+            for index in range(len(playlist.uris)):
+                with open(self._get_part_file(target_dir, index), "rb") as part:
+                    data = part.read()
+
+                if hashlib.sha256(data).hexdigest() != state["parts"][str(index)]["sha256"]:
+                    raise DownloadError("Part %d is corrupt" % index)
+
+                output.write(data)
+                digest.update(data)
+        os.replace(video_file + ".tmp", video_file)
+
+        shutil.rmtree(parts_dir, ignore_errors=True)
+        os.remove(os.path.join(target_dir, STATE_FILE))
+
+        return {
+            "file": video_file,
+            "size": os.path.getsize(video_file),
+            "sha256": digest.hexdigest()
+        }
+
+    def _get(self, url: str) -> requests.Response:
+        r = self.http.get(url, headers=self.headers, timeout=self.TIMEOUT)
+        r.raise_for_status()
+
+        return r
+
+    @staticmethod
+    def _get_part_file(target_dir: str, index: int) -> str:
+        return os.path.join(target_dir, PARTS_DIR, "%05d" % index)
+
+    @staticmethod
+    def _load_state(target_dir: str) -> Dict:
+        try:
+            with open(os.path.join(target_dir, STATE_FILE), "r", encoding="utf-8") as file:
+                return json.load(file)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_state(self, target_dir: str, state: Dict) -> None:
+        state_file = os.path.join(target_dir, STATE_FILE)
+        with self.lock:
+            data = json.dumps(state)
+
+        with open(state_file + ".tmp", "w", encoding="utf-8") as file:
+            file.write(data)
+        os.replace(state_file + ".tmp", state_file)
+
+
+class DownloadStore:
+    """
+    Index of the downloaded episodes in a directory, limited to a storage quota
+
+    Each download lives in a directory named after its stream id. When space is needed, the least recently used
+    downloads are removed first.
+    """
+
+    def __init__(self, path: str, quota_bytes: int = 0):
+        self.path: str = path
+        self.quota_bytes: int = quota_bytes
+        # stream_id => {"file", "subtitles", "size", "sha256", "title", "episode_id", "downloaded", "last_used"}
+        self.index: Dict[str, Dict] = self._load_index()
+
+    def get_target_dir(self, stream_id: str) -> str:
+        return os.path.join(self.path, stream_id)
+
+    def get(self, stream_id: str) -> Optional[Dict]:
+        """ get the entry of a complete download, None if there is none """
+
+        entry = self.index.get(stream_id)
+        if not entry or not os.path.exists(entry.get("file", "")):
+            return None
+
+        return entry
+
+    def add(self, stream_id: str, entry: Dict) -> None:
+        entry["downloaded"] = entry["last_used"] = time.time()
+        self.index[stream_id] = entry
+        self._save_index()
+
+    def touch(self, stream_id: str) -> None:
+        if stream_id in self.index:
+            self.index[stream_id]["last_used"] = time.time()
+            self._save_index()
+
+    def remove(self, stream_id: str) -> None:
+        shutil.rmtree(self.get_target_dir(stream_id), ignore_errors=True)
+        if self.index.pop(stream_id, None) is not None:
+            self._save_index()
+
+    def get_total_size(self) -> int:
+        return sum(entry.get("size", 0) for entry in self.index.values())
+
+    def ensure_space(self, required: int, keep: Optional[str] = None) -> bool:
+        """ evict least recently used downloads until required bytes fit into the quota (0 = no quota)
+
+        keep is a stream id that must not be evicted, e.g. the one being downloaded. returns False if the quota is
+        too small, even when everything else is evicted.
+        """
+
+        if not self.quota_bytes:
+            return True
+
+        if required > self.quota_bytes:
+            return False
+
+        candidates = sorted(
+            (stream_id for stream_id in self.index if stream_id != keep),
+            key=lambda stream_id: self.index[stream_id].get("last_used", 0)
+        )
+        while self.get_total_size() + required > self.quota_bytes and candidates:
+            self.remove(candidates.pop(0))
+
+        return self.get_total_size() + required <= self.quota_bytes
+
+    def _load_index(self) -> Dict:
+        try:
+            with open(os.path.join(self.path, INDEX_FILE), "r", encoding="utf-8") as file:
+                return json.load(file)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_index(self) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        index_file = os.path.join(self.path, INDEX_FILE)
+        with open(index_file + ".tmp", "w", encoding="utf-8") as file:
+            json.dump(self.index, file)
+        os.replace(index_file + ".tmp", index_file)
+
+
+def _hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def _get_dir_size(path: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, dirs, files in os.walk(path)
+        for name in files
+    )
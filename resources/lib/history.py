@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+# Crunchyroll
+# Copyright (C) 2018 MrKrabat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import time
+from typing import Dict, List, Optional
+
+import xbmc
+import xbmcvfs
+
+from . import listwarmer
+from . import utils
+from . import watched
+from .api import API
+from .model import Args, MediaData
+
+
+class HistoryStore:
+    """
+    Local mirror of the watch history, newest entry first
+
+    A sync only fetches pages until it reaches the newest entry known already, older pages are fetched once they are
+    first browsed. Every episode is kept once, with its latest play. Older entries continue after the oldest one
+    mirrored, found by its id or play date: the remote page to look at is only a hint, as the remote history may
+    drop or merge plays, so pages are stepped forward or back until the oldest entry is passed. Plugin and service
+    share the file, it is replaced atomically.
+    """
+
+    VERSION = 2
+    PAGE_SIZE = 50
+    # pages a single sync fetches at most, a longer gap is closed by browsing
+    MAX_SYNC_PAGES = 10
+    # pages a single backfill looks at at most, to find where the mirrored entries end
+    MAX_BACKFILL_PAGES = 5
+
+    def __init__(self, args: Args, api: Optional[API] = None):
+        self.args: Args = args
+        self.api: Optional[API] = api
+        self.data: Dict = self._load()
+
+    @property
+    def entries(self) -> List[Dict]:
+        return self.data["entries"]
+
+    def sync(self) -> int:
+        """ fetch the entries played since the last sync, returns the number of new entries """
+
+        newest = self.entries[0] if self.entries else None
+        fetched = []
+        total = self.data.get("total", 0)
+        reached_known = False
+        complete = False
+        page = 0
+
+        for page in range(1, self.MAX_SYNC_PAGES + 1):
+            items, total = self._fetch_page(page, allow_warm=page == 1)
+            if items is None:
+                return 0
+
+            for item in items:
+                if newest and (self._is_same_play(item, newest) or self._is_older(item, newest)):
+                    reached_known = True
+                    break
+                fetched.append(item)
+
+            if reached_known or len(items) < self.PAGE_SIZE:
+                complete = not reached_known
+                break
+
+        self.data["total"] = total
+        self.data["synced_at"] = time.time()
+
+        if reached_known or not newest:
+            # the new entries sit right on top of what we have, which moved down as many remote entries
+            self.data["entries"] = self._dedupe(fetched + self.entries)
+            self.data["backfill_page"] = self.data.get("backfill_page", 1) + len(fetched) // self.PAGE_SIZE
+            if not newest:
+                self.data["backfill_page"] = page + 1
+                self.data["complete"] = complete
+        else:
+            # the gap was too large to close, start over with what we got
+            self.data["entries"] = self._dedupe(fetched)
+            self.data["backfill_page"] = page + 1
+            self.data["complete"] = complete
+
+        self._save()
+
+        return len(fetched)
+
+    def get_page(self, page: int) -> List[Dict]:
+        """ get a page of the history, fetching older entries if they are not mirrored yet """
+
+        while len(self.entries) < page * self.PAGE_SIZE and not self.is_complete():
+            if not self._backfill():
+                break
+
+        return self.entries[(page - 1) * self.PAGE_SIZE:page * self.PAGE_SIZE]
+
+    def get_page_count(self) -> int:
+        """ number of pages, as far as known """
+
+        count = len(self.entries) if self.is_complete() else max(len(self.entries) + 1, self.data.get("total", 0))
+
+        return max(1, (count + self.PAGE_SIZE - 1) // self.PAGE_SIZE)
+
+    def is_complete(self) -> bool:
+        return bool(self.data.get("complete"))
+
+    def get_recent(self, days: int) -> List[Dict]:
+        """ entries played within the last days """
+
+        cutoff = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(time.time() - days * 24 * 60 * 60))
+
+        return [entry for entry in self.entries if (entry.get("date_played") or "") >= cutoff]
+
+    def get_series(self) -> List[Dict]:
+        """ the latest entry of every series (or movie), most recently played first """
+
+        series = {}
+        for entry in self.entries:
+            series.setdefault(self.get_series_id(entry), entry)
+
+        return list(series.values())
+
+    def get_series_entries(self, series_id: str) -> List[Dict]:
+        return [entry for entry in self.entries if self.get_series_id(entry) == series_id]
+
+    def get_playhead(self, episode_id: str) -> Optional[int]:
+        entry = next((entry for entry in self.entries if entry.get("panel", {}).get("id") == episode_id), None)
+
+        return entry.get("playhead") if entry else None
+
+    @staticmethod
+    def get_series_id(entry: Dict) -> Optional[str]:
+        panel = entry.get("panel", {})
+
+        return (panel.get("episode_metadata") or {}).get("series_id") or panel.get("id")
+
+    def _backfill(self) -> bool:
+        """ fetch the entries older than the oldest mirrored one, False if nothing could be added """
+
+        if not self.entries:
+            return self.sync() > 0
+
+        oldest = self.entries[-1]
+        page = max(1, self.data.get("backfill_page", 1))
+        # the page looked at before stepping back, it continues the one stepped back to
+        following = None
+
+        for _ in range(self.MAX_BACKFILL_PAGES):
+            items, total = self._fetch_page(page)
+            if items is None:
+                return False
+
+            position = next((index for index, item in enumerate(items) if self._is_same_play(item, oldest)), None)
+            if position is not None:
+                older = items[position + 1:]
+            else:
+                older = [item for item in items if self._is_older(item, oldest)]
+
+            if not older and following:
+                # nothing was missing before the page stepped back from
+                older = items = following
+                following = []
+                page = page + 1
+            elif not older:
+                if len(items) < self.PAGE_SIZE:
+                    # the remote history ends with what we have
+                    self.data["complete"] = True
+                    self._save()
+                    return False
+
+                page = page + 1
+                continue
+
+            if position is None and older[0] is items[0] and page > 1 and following is None:
+                # the page starts past the oldest entry already, make sure the previous one holds nothing missing
+                following = items
+                page = page - 1
+                continue
+
+            if following and len(items) == self.PAGE_SIZE:
+                older = older + following
+                items = following
+                page = page + 1
+
+            self.data["entries"] = self._dedupe(self.entries + older)
+            self.data["total"] = total
+            self.data["backfill_page"] = page + 1
+            self.data["complete"] = len(items) < self.PAGE_SIZE
+            self._save()
+
+            return True
+
+        # the end of the mirrored entries wasn't found, continue looking next time
+        self.data["backfill_page"] = page
+        self._save()
+
+        return False
+
+    def _fetch_page(self, page: int, allow_warm: bool = False) -> tuple:
+        """ get the items of a remote page and the remote total, (None, 0) on errors """
+
+        # the service keeps the first page warm
+        warm = listwarmer.load(self.args, listwarmer.HISTORY) if allow_warm else None
+        if warm is not None and all(item.get("date_played") for item in warm.get("data", [])):
+            return warm.get("data", []), warm.get("total", 0)
+
+        if not self.api:
+            return None, 0
+
+        req = self.api.make_list_request(
+            method="GET",
+            url=self.api.HISTORY_ENDPOINT.format(self.api.account_data.account_id),
+            items_key="data",
+            fields=MediaData.HISTORY_API_FIELDS,
+            params={
+                "page_size": self.PAGE_SIZE,
+                "page": page,
+                "locale": self.args.subtitle
+            }
+        )
+        items = list(req)
+        if "error" in req.meta:
+            utils.crunchy_log(self.args, "History: failed to fetch page %d" % page, xbmc.LOGERROR)
+            return None, 0
+
+        store = watched.get_store(self.args)
+        store.update_from_items(items)
+        store.save()
+
+        return items, req.meta.get("total", 0)
+
+    @staticmethod
+    def _is_same_play(item: Dict, entry: Dict) -> bool:
+        return (item.get("panel", {}).get("id") == entry.get("panel", {}).get("id")
+                and item.get("date_played") == entry.get("date_played"))
+
+    @staticmethod
+    def _is_older(item: Dict, entry: Dict) -> bool:
+        """ whether item was played before entry, False if either play date is unknown """
+
+        return bool(item.get("date_played") and entry.get("date_played")
+                    and item.get("date_played") < entry.get("date_played"))
+
+    @staticmethod
+    def _dedupe(entries: List[Dict]) -> List[Dict]:
+        """ keep the first, so the latest, entry of every episode """
+
+        seen = set()
+        result = []
+        for entry in entries:
+            episode_id = entry.get("panel", {}).get("id")
+            if episode_id in seen:
+                continue
+
+            seen.add(episode_id)
+            result.append(entry)
+
+        return result
+
+    def _get_file(self) -> str:
+        return xbmcvfs.translatePath(self.args.addon.getAddonInfo("profile") + "history_%s.json" % self.args.subtitle)
+
+    def _load(self) -> Dict:
+        data = {"version": self.VERSION, "entries": [], "backfill_page": 1, "complete": False, "total": 0,
+                "synced_at": 0}
+        if not os.path.exists(self._get_file()):
+            return data
+
+        try:
+            with open(self._get_file(), "r", encoding="utf-8") as file:
+                stored = json.load(file)
+        except (OSError, ValueError):
+            utils.crunchy_log(self.args, "History: resetting invalid store", xbmc.LOGWARNING)
+            return data
+
+        if stored.get("version") != self.VERSION:
+            return data
+
+        data.update(stored)
+        return data
+
+    def _save(self) -> None:
+        xbmcvfs.mkdirs(xbmcvfs.translatePath(self.args.addon.getAddonInfo("profile")))
+
+        utils.write_file(self._get_file(), json.dumps(self.data, separators=(",", ":")))
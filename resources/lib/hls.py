@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# Crunchyroll
+# Copyright (C) 2018 MrKrabat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# HLS playlist handling. This module must not depend on kodi, so it can be used and tested outside of it.
+
+import re
+from typing import Callable, Dict, List, Optional
+
+try:
+    from urlparse import urljoin
+except ImportError:
+    from urllib.parse import urljoin
+
+ATTRIBUTE_PATTERN = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+URI_ATTRIBUTE_PATTERN = re.compile(r'URI="([^"]*)"')
+
+
+def parse_attributes(line: str) -> Dict[str, str]:
+    """ parse the attribute list of a tag line into a dict, quotes of string values are removed """
+
+    attributes = line.split(":", 1)[1] if ":" in line else ""
+
+    return {key: value.strip('"') for key, value in ATTRIBUTE_PATTERN.findall(attributes)}
+
+
+class Variant:
+    """ A variant stream of a master playlist """
+
+    def __init__(self, tag: str, uri: str):
+        attributes = parse_attributes(tag)
+
+        # original tag line, so attributes we don't know are preserved
+        self.tag: str = tag
+        self.uri: str = uri
+        self.bandwidth: int = int(attributes.get("BANDWIDTH", 0) or 0)
+        self.width: int = 0
+        self.height: int = 0
+
+        resolution = attributes.get("RESOLUTION", "")
+        if "x" in resolution:
+            width, height = resolution.split("x", 1)
+            self.width = int(width) if width.isdigit() else 0
+            self.height = int(height) if height.isdigit() else 0
+
+
+class MasterPlaylist:
+    """ Parsed master playlist, all uris are resolved against the playlist url """
+
+    def __init__(self, content: str, url: str):
+        self.url: str = url
+        # all lines that are not variant streams (version, media renditions, session data, ...)
+        self.header: List[str] = []
+        self.variants: List[Variant] = []
+        self.iframe_variants: List[Variant] = []
+
+        tag = None
+        for line in content.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+
+            if line.startswith("#EXT-X-STREAM-INF"):
+                tag = line
+            elif line.startswith("#EXT-X-I-FRAME-STREAM-INF"):
+                uri = parse_attributes(line).get("URI", "")
+                self.iframe_variants.append(Variant(resolve_uri_attribute(line, url), urljoin(url, uri)))
+            elif line.startswith("#"):
+                self.header.append(resolve_uri_attribute(line, url))
+            elif tag:
+                self.variants.append(Variant(tag, urljoin(url, line)))
+                tag = None
+
+    def is_master(self) -> bool:
+        return len(self.variants) > 0
+
+    def build(self, uri_mapper: Optional[Callable[[str], str]] = None) -> str:
+        """ serialize the playlist, uri_mapper allows rewriting the uris of variants and renditions """
+
+        uri_mapper = uri_mapper or (lambda uri: uri)
+
+        # alternative renditions (audio, subtitles) are playlists as well
+        lines = [
+            URI_ATTRIBUTE_PATTERN.sub(lambda m: 'URI="%s"' % uri_mapper(m.group(1)), line)
+            if line.startswith("#EXT-X-MEDIA") else line
+            for line in self.header
+        ]
+        for variant in self.iframe_variants:
+            lines.append(URI_ATTRIBUTE_PATTERN.sub(lambda m: 'URI="%s"' % uri_mapper(variant.uri), variant.tag))
+        for variant in self.variants:
+            lines.append(variant.tag)
+            lines.append(uri_mapper(variant.uri))
+
+        return "\n".join(lines) + "\n"
+
+
+def resolve_uri_attribute(line: str, base_url: str) -> str:
+    """ make an URI="..." attribute of a tag line absolute """
+
+    return URI_ATTRIBUTE_PATTERN.sub(lambda m: 'URI="%s"' % urljoin(base_url, m.group(1)), line)
+
+
+def filter_variants(
+        variants: List[Variant],
+        max_height: int = 0,
+        max_bandwidth: int = 0,
+        keep_one: bool = True
+) -> List[Variant]:
+    """ drop all variants exceeding max_height or max_bandwidth (0 = no limit)
+
+    variants without resolution information are only filtered by bandwidth. if no variant is within the limits and
+    keep_one is set, the smallest one is kept, so there is always something to play.
+    """
+
+    result = [
+        variant for variant in variants
+        if (not max_height or not variant.height or variant.height <= max_height)
+        and (not max_bandwidth or variant.bandwidth <= max_bandwidth)
+    ]
+
+    if not result and variants and keep_one:
+        result = [min(variants, key=lambda variant: variant.bandwidth)]
+
+    return result
+
+
+def order_variants(variants: List[Variant]) -> List[Variant]:
+    """ order variants by descending bandwidth, but put a medium one first
+
+    players that start with the first variant will then start at a reasonable quality instead of the lowest or
+    highest one and adapt from there.
+    """
+
+    ordered = sorted(variants, key=lambda variant: variant.bandwidth, reverse=True)
+    if len(ordered) < 3:
+        return ordered
+
+    start = ordered.pop((len(ordered) - 1) // 2)
+
+    return [start] + ordered
+
+
+def trim_master_playlist(
+        content: str,
+        url: str,
+        max_height: int = 0,
+        max_bandwidth: int = 0,
+        uri_mapper: Optional[Callable[[str], str]] = None
+) -> Optional[str]:
+    """ build a master playlist limited to the given resolution and bandwidth
+
+    returns None if content is no master playlist
+    """
+
+    playlist = MasterPlaylist(content, url)
+    if not playlist.is_master():
+        return None
+
+    playlist.variants = order_variants(filter_variants(playlist.variants, max_height, max_bandwidth))
+    playlist.iframe_variants = filter_variants(playlist.iframe_variants, max_height, max_bandwidth, False)
+
+    return playlist.build(uri_mapper)
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+# Crunchyroll
+# Copyright (C) 2018 MrKrabat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Incremental decoding of json list responses. This module must not depend on kodi, so it can be used and tested
+# outside of it.
+
+import codecs
+import json
+from typing import Any, Dict, Iterable, Iterator, Optional, Union
+
+WHITESPACE = " \t\n\r"
+
+
+def prune(value: Any, fields: Union[Dict, bool, None]) -> Any:
+    """ keep only the given fields of value
+
+    fields is a dict of the keys to keep, with a nested dict for the keys to keep of their value or True to keep the
+    value as a whole. lists are pruned item by item.
+    """
+
+    if fields is None or fields is True:
+        return value
+
+    if isinstance(value, list):
+        return [prune(item, fields) for item in value]
+
+    if not isinstance(value, dict):
+        return value
+
+    return {key: prune(value[key], fields[key]) for key in fields if key in value}
+
+
+class JsonItemStream:
+    """
+    Items of the list under items_key of a json object, decoded one at a time while the body arrives
+
+    Each item is pruned to fields right away, so the full response never has to be in memory. The other top-level
+    values of the object (e.g. "total") are available in meta, completely only after iterating all items. So is an
+    error, be it one the api sent in the body or a body that couldn't be read or decoded.
+    """
+
+    def __init__(self, chunks: Iterable[bytes], items_key: str, fields: Optional[Dict] = None):
+        self.chunks: Iterator[bytes] = iter(chunks)
+        self.items_key: str = items_key
+        self.fields: Optional[Dict] = fields
+        self.meta: Dict = {}
+        self.items: Optional[list] = None
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer: str = ""
+        self.exhausted: bool = False
+
+    @classmethod
+    def from_data(cls, data: Optional[Dict], items_key: str, fields: Optional[Dict] = None) -> "JsonItemStream":
+        """ wrap an already decoded response, so callers handle both the same way """
+
+        stream = cls([], items_key, fields)
+        stream.meta = {key: value for key, value in (data or {}).items() if key != items_key}
+        stream.items = prune((data or {}).get(items_key) or [], fields)
+        stream.exhausted = True
+
+        return stream
+
+    def __iter__(self) -> Iterator[Dict]:
+        if self.items is not None:
+            yield from self.items
+            return
+
+        self.items = []
+
+        try:
+            yield from self._decode()
+        except (ValueError, OSError) as e:
+            # a truncated or broken body ends the list, callers see it in meta like any other failed request
+            self.meta["error"] = "invalid_response: %s" % e
+
+    def _decode(self) -> Iterator[Dict]:
+        head = self._read_head()
+        if head is None:
+            return
+
+        position = 0
+        while True:
+            position = self._skip(position, WHITESPACE + ",")
+            if position is None:
+                raise ValueError("Unexpected end of list")
+
+            if self.buffer[position] == "]":
+                break
+
+            try:
+                item, end = self.decoder.raw_decode(self.buffer, position)
+            except ValueError:
+                # most likely the item is incomplete, unless there is nothing more to read
+                if not self._read():
+                    raise
+                continue
+
+            # drop what has been decoded, so the buffer only holds the current item
+            self.buffer = self.buffer[end:]
+            position = 0
+
+            yield prune(item, self.fields)
+
+        # the rest of the object holds the remaining meta data
+        while self._read():
+            pass
+        self.meta.update(json.loads(head + "[]" + self.buffer[position + 1:]))
+        self.meta.pop(self.items_key, None)
+
+    def _read(self) -> bool:
+        """ append the next chunk to the buffer, False if the body is complete """
+
+        if self.exhausted:
+            return False
+
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.exhausted = True
+            self.buffer = self.buffer + self.text_decoder.decode(b"", final=True)
+            return False
+
+        self.buffer = self.buffer + self.text_decoder.decode(chunk)
+        return True
+
+    def _skip(self, position: int, characters: str) -> Optional[int]:
+        """ position of the next character not in characters, reading more if necessary """
+
+        while True:
+            while position < len(self.buffer) and self.buffer[position] in characters:
+                position = position + 1
+
+            if position < len(self.buffer):
+                return position
+
+            if not self._read():
+                return None
+
+    def _read_head(self) -> Optional[str]:
+        """ read until the opening bracket of the list and return everything before it
+
+        the buffer keeps what follows the bracket. returns None if the object has no such list, meta holds the
+        whole object then.
+        """
+
+        scanned = 0
+        depth = 0
+        in_string = False
+        string_start = 0
+        last_string = None
+
+        while True:
+            while scanned < len(self.buffer):
+                char = self.buffer[scanned]
+
+                if in_string:
+                    if char == "\\":
+                        scanned = scanned + 1
+                    elif char == '"':
+                        in_string = False
+                        last_string = self.buffer[string_start:scanned]
+                elif char == '"':
+                    in_string = True
+                    string_start = scanned + 1
+                elif char in "{[":
+                    if char == "[" and depth == 1 and last_string == self.items_key:
+                        head = self.buffer[:scanned]
+                        self.meta.update(json.loads(head + "[]}"))
+                        self.meta.pop(self.items_key, None)
+                        self.buffer = self.buffer[scanned + 1:]
+                        return head
+                    depth = depth + 1
+                elif char in "}]":
+                    depth = depth - 1
+                elif char not in WHITESPACE + ":":
+                    last_string = None
+
+                scanned = scanned + 1
+
+            if not self._read():
+                if self.buffer.strip():
+                    self.meta = json.loads(self.buffer)
+                return None
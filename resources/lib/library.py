@@ -0,0 +1,447 @@
+# -*- coding: utf-8 -*-
+# Crunchyroll
+# Copyright (C) 2018 MrKrabat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import re
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import xbmc
+import xbmcvfs
+
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
+from . import listwarmer
+from . import utils
+from . import watched
+from .api import API
+from .model import Args, MediaData
+from .upnext import UpNext
+
+# NotifyAll message asking the service to export right away
+EXPORT_MESSAGE = "library_export"
+
+
+def request_export() -> None:
+    xbmc.executebuiltin("NotifyAll(%s,%s)" % (utils.ADDON_ID, EXPORT_MESSAGE))
+
+
+class LibraryExporter:
+    """
+    Export the series and movies of the watchlist to kodi's video library as .strm and .nfo files
+
+    Every .strm file plays through the addon's videoplay mode. A manifest in the profile directory remembers the hash
+    of every written file, so repeated runs only write what changed and delete what left the watchlist, and only the
+    folders of changed shows are scanned. Shows and seasons that failed to load keep their files until a run loads
+    them again, a temporary api error must not remove them (and their watched state) from the library. Episode lists
+    come from UpNext and are cached per season. The watched state of exported items, as far as not known recently
+    fetched in batches, is written to the library entries kodi already knows, so items added by this run's scan are
+    reconciled by the next one.
+    """
+
+    CONCURRENCY = 4
+    # at most this many folders are scanned one by one, otherwise the whole export folder
+    MAX_TARGETED_SCANS = 10
+    # content ids per playheads request
+    PLAYHEADS_BATCH = 50
+
+    def __init__(self, args: Args, api: API, monitor: xbmc.Monitor):
+        self.args: Args = args
+        self.api: API = api
+        self.monitor: xbmc.Monitor = monitor
+        self.upnext: UpNext = UpNext(args, api)
+        self.path: str = args.addon.getSetting("library_path")
+        if self.path and not self.path.endswith("/"):
+            self.path = self.path + "/"
+
+    def run(self) -> Dict[str, int]:
+        """ sync the library folder with the watchlist, returns the number of written, removed and unchanged files """
+
+        stats = {"written": 0, "removed": 0, "unchanged": 0}
+        if not self.path:
+            return stats
+
+        watchlist = self._get_watchlist()
+        if watchlist is None:
+            return stats
+
+        files = {}
+        # folders of shows and seasons that failed to load, their files are kept as they are
+        failed_dirs = []
+        with ThreadPoolExecutor(max_workers=self.CONCURRENCY) as pool:
+            for show_files, show_failed_dirs in pool.map(self._get_show_files, self._get_series(watchlist)):
+                for path, entry in show_files.items():
+                    files.setdefault(path, entry)
+                failed_dirs.extend(show_failed_dirs)
+
+        for item in watchlist:
+            if item.get("panel", {}).get("type") == "movie":
+                files.update(self._get_movie_files(item))
+
+        manifest = self._load_manifest()
+        changed_dirs = set()
+
+        for path, entry in files.items():
+            if self.monitor.abortRequested():
+                break
+
+            if manifest.get(path, {}).get("hash") == entry.get("hash"):
+                stats["unchanged"] = stats["unchanged"] + 1
+                continue
+
+            self._write(path, entry.pop("content"))
+            manifest[path] = entry
+            changed_dirs.add(self._get_scan_dir(path))
+            stats["written"] = stats["written"] + 1
+
+        removed = [
+            path for path in manifest
+            if path not in files and not any(path.startswith(failed_dir) for failed_dir in failed_dirs)
+        ]
+        for path in removed:
+            xbmcvfs.delete(self.path + path)
+            manifest.pop(path)
+            changed_dirs.add(self._get_scan_dir(path))
+            stats["removed"] = stats["removed"] + 1
+
+        self._save_manifest(manifest)
+        self._scan(changed_dirs)
+        self._reconcile_playstate(manifest)
+
+        return stats
+
+    def _get_watchlist(self) -> Optional[List[Dict]]:
+        warm = listwarmer.load(self.args, listwarmer.WATCHLIST)
+        if warm is not None:
+            return warm.get("items", [])
+
+        req = self.api.make_list_request(
+            method="GET",
+            url=self.api.WATCHLIST_LIST_ENDPOINT.format(self.api.account_data.account_id),
+            items_key="items",
+            fields=MediaData.API_FIELDS,
+            params={
+                "n": 1024,
+                "locale": self.args.subtitle
+            }
+        )
+        items = list(req)
+
+        return None if "error" in req.meta else items
+
+    @staticmethod
+    def _get_series(watchlist: List[Dict]) -> List[Dict]:
+        """ the series of the queued episodes, once each """
+
+        series = {}
+        for item in watchlist:
+            panel = item.get("panel", {})
+            meta = panel.get("episode_metadata") or {}
+            if panel.get("type") == "episode" and meta.get("series_id"):
+                series.setdefault(meta.get("series_id"), {
+                    "id": meta.get("series_id"),
+                    "title": meta.get("series_title") or meta.get("series_id"),
+                    "thumb": utils.get_image_from_struct(panel, "thumbnail", 2)
+                })
+
+        return list(series.values())
+
+    def _get_show_files(self, series: Dict) -> Tuple[Dict[str, Dict], List[str]]:
+        """ all files of a series and the folders that failed to load
+
+        files are keyed by their path relative to the export folder, entries hold content and hash.
+        """
+
+        files = {}
+        failed_dirs = []
+        show_dir = "tvshows/%s/" % _clean_name(series.get("title"))
+
+        try:
+            seasons = self.upnext.get_seasons(series.get("id"))
+        except Exception:
+            utils.log_error_with_trace(self.args, "Library export: failed to load %s" % series.get("title"), False)
+            return files, [show_dir]
+
+        files[show_dir + "tvshow.nfo"] = self._create_entry(_create_nfo("tvshow", {
+            "title": series.get("title"),
+            "thumb": series.get("thumb"),
+            "uniqueid": series.get("id")
+        }))
+
+        # dubs of the same season end up at the same paths, the preferred audio language comes first and wins
+        preferred_audio = self.api.account_data.default_audio_language
+        seasons = sorted(seasons, key=lambda season: season.get("audio_locale") != preferred_audio)
+
+        for season in seasons:
+            season_number = season.get("season_number") or 0
+            season_dir = "%sSeason %02d/" % (show_dir, season_number)
+            try:
+                episodes = self.upnext.get_season_episodes(season.get("id"))
+            except Exception:
+                utils.log_error_with_trace(self.args, "Library export: failed to load %s" % season.get("id"), False)
+                failed_dirs.append(season_dir)
+                continue
+
+            for episode in episodes:
+                number = episode.get("episode_number") or episode.get("sequence_number") or 0
+                name = "%s%s S%02dE%s" % (season_dir, _clean_name(series.get("title")), season_number,
+                                          _format_episode_number(number))
+                if name + ".strm" in files:
+                    continue
+
+                files[name + ".strm"] = self._create_entry(self._get_play_url(episode), episode.get("id"))
+                files[name + ".nfo"] = self._create_entry(_create_nfo("episodedetails", {
+                    "title": episode.get("title"),
+                    "showtitle": series.get("title"),
+                    "season": season_number,
+                    "episode": number,
+                    "plot": episode.get("description"),
+                    "aired": (episode.get("episode_air_date") or "")[:10],
+                    "thumb": utils.get_image_from_struct(episode, "thumbnail", 2),
+                    "uniqueid": episode.get("id")
+                }))
+
+        return files, failed_dirs
+
+    def _get_movie_files(self, item: Dict) -> Dict[str, Dict]:
+        panel = item.get("panel", {})
+        meta = panel.get("movie_metadata") or {}
+        title = meta.get("movie_listing_title") or panel.get("title") or panel.get("id")
+        stream_id = utils.get_stream_id_from_url(
+            panel.get("__links__", {}).get("streams", {}).get("href") or panel.get("streams_link") or ""
+        )
+        if not stream_id:
+            return {}
+
+        name = "movies/%s/%s" % (_clean_name(title), _clean_name(title))
+
+        return {
+            name + ".strm": self._create_entry(self._get_play_url({
+                "id": panel.get("id"),
+                "title": title,
+                "duration_ms": meta.get("duration_ms", 0),
+                "stream_id": stream_id
+            }), panel.get("id"), "movie"),
+            name + ".nfo": self._create_entry(_create_nfo("movie", {
+                "title": title,
+                "plot": panel.get("description"),
+                "premiered": (meta.get("premium_available_date") or "")[:10],
+                "thumb": utils.get_image_from_struct(panel, "thumbnail", 2),
+                "uniqueid": panel.get("id")
+            }))
+        }
+
+    def _get_play_url(self, episode: Dict) -> str:
+        stream_id = episode.get("stream_id") or utils.get_stream_id_from_url(
+            episode.get("__links__", {}).get("streams", {}).get("href", "")
+        )
+        params = {
+            "mode": "videoplay",
+            "stream_id": stream_id,
+            "episode_id": episode.get("id"),
+            "collection_id": episode.get("season_id"),
+            "series_id": episode.get("series_id"),
+            "title": UpNext.get_episode_title(episode) if episode.get("series_title") else episode.get("title"),
+            "duration": int((episode.get("duration_ms") or 0) / 1000)
+        }
+
+        return "plugin://%s/?%s" % (utils.ADDON_ID, urlencode([(key, value) for key, value in params.items() if value]))
+
+    @staticmethod
+    def _create_entry(content: str, content_id: Optional[str] = None, kind: str = "episode") -> Dict:
+        entry = {"content": content, "hash": hashlib.sha1(content.encode("utf-8")).hexdigest()}
+        if content_id:
+            entry["content_id"] = content_id
+            entry["kind"] = kind
+
+        return entry
+
+    def _write(self, path: str, content: str) -> None:
+        xbmcvfs.mkdirs(self.path + path[:path.rfind("/") + 1])
+        with xbmcvfs.File(self.path + path, "w") as file:
+            file.write(content)
+
+    @staticmethod
+    def _get_scan_dir(path: str) -> str:
+        """ the folder of the show or movie a file belongs to """
+
+        return "/".join(path.split("/")[:2]) + "/"
+
+    def _scan(self, changed_dirs: set) -> None:
+        if not changed_dirs:
+            return
+
+        if len(changed_dirs) > self.MAX_TARGETED_SCANS:
+            xbmc.executebuiltin('UpdateLibrary(video,"%s")' % self.path)
+            return
+
+        for changed_dir in sorted(changed_dirs):
+            # removed shows are cleaned by kodi's library cleaning, scanning a missing folder would fail
+            if xbmcvfs.exists(self.path + changed_dir):
+                xbmc.executebuiltin('UpdateLibrary(video,"%s")' % (self.path + changed_dir))
+
+    def _reconcile_playstate(self, manifest: Dict) -> None:
+        """ write the playheads of exported items to their library entries, where they differ """
+
+        content_ids = {}
+        for path, entry in manifest.items():
+            if entry.get("content_id"):
+                content_ids[self.path + path] = entry
+
+        library_items = self._get_library_items("episode") + self._get_library_items("movie")
+        library_items = [item for item in library_items if item.get("file") in content_ids]
+        if not library_items:
+            return
+
+        playheads = self._get_playheads([content_ids[item.get("file")].get("content_id") for item in library_items])
+
+        for item in library_items:
+            entry = content_ids[item.get("file")]
+            info = playheads.get(entry.get("content_id")) or {}
+            playcount = 1 if info.get("watched") else 0
+            position = 0 if playcount else int(info.get("playhead") or 0)
+
+            resume = item.get("resume") or {}
+            if item.get("playcount", 0) == playcount and int(resume.get("position") or 0) == position:
+                continue
+
+            kind = entry.get("kind", "episode")
+            _call_jsonrpc("VideoLibrary.Set%sDetails" % kind.capitalize(), {
+                "%sid" % kind: item.get("%sid" % kind),
+                "playcount": playcount,
+                "resume": {"position": position, "total": resume.get("total") or 0}
+            })
+
+    def _get_library_items(self, kind: str) -> List[Dict]:
+        method = "VideoLibrary.GetEpisodes" if kind == "episode" else "VideoLibrary.GetMovies"
+        result = _call_jsonrpc(method, {
+            "properties": ["file", "playcount", "resume"],
+            "filter": {"field": "path", "operator": "startswith", "value": self.path}
+        })
+
+        return result.get("episodes" if kind == "episode" else "movies") or []
+
+    def _get_playheads(self, content_ids: List[str]) -> Dict[str, Dict]:
+        """ the watched state entries of the content ids, only those not known recently are fetched """
+
+        store = watched.get_store(self.args)
+        missing = store.get_missing(content_ids)
+        batches = [
+            missing[index:index + self.PLAYHEADS_BATCH]
+            for index in range(0, len(missing), self.PLAYHEADS_BATCH)
+        ]
+
+        def fetch(batch: List[str]) -> Optional[Dict]:
+            req = self.api.make_request(
+                method="GET",
+                url=self.api.PLAYHEADS_ENDPOINT.format(self.api.account_data.account_id),
+                params={
+                    "locale": self.args.subtitle,
+                    "content_ids": ",".join(batch)
+                }
+            )
+
+            return req if req and "error" not in req else None
+
+        with ThreadPoolExecutor(max_workers=self.CONCURRENCY) as pool:
+            for batch, data in zip(batches, pool.map(fetch, batches)):
+                if data is None:
+                    continue
+
+                store.update_from_playheads(data)
+                # content without playhead hasn't been watched at all
+                for content_id in batch:
+                    if not store.get(content_id, fresh=True):
+                        store.update(content_id, 0, False)
+        store.save()
+
+        return {content_id: store.get(content_id) for content_id in content_ids if store.get(content_id)}
+
+    def _get_manifest_file(self) -> str:
+        return xbmcvfs.translatePath(self.args.addon.getAddonInfo("profile") + "library_manifest.json")
+
+    def _load_manifest(self) -> Dict:
+        if not xbmcvfs.exists(self._get_manifest_file()):
+            return {}
+
+        try:
+            with xbmcvfs.File(self._get_manifest_file()) as file:
+                data = json.load(file)
+        except ValueError:
+            utils.crunchy_log(self.args, "Library export: resetting invalid manifest", xbmc.LOGWARNING)
+            return {}
+
+        # exported to another folder before, start over
+        if data.get("path") != self.path:
+            return {}
+
+        return data.get("files", {})
+
+    def _save_manifest(self, manifest: Dict) -> None:
+        with xbmcvfs.File(self._get_manifest_file(), "w") as file:
+            file.write(json.dumps({"path": self.path, "files": manifest}))
+
+
+def _clean_name(name: Optional[str]) -> str:
+    """ make a title usable as file name """
+
+    return re.sub(r'[\\/:*?"<>|]', "", name or "").strip().rstrip(".") or "Unknown"
+
+
+def _format_episode_number(number) -> str:
+    """ episode number as in S01E12, fractional ones like 12.5 keep their fraction, kodi reads them as E12.5 """
+
+    try:
+        number = float(number)
+    except (TypeError, ValueError):
+        return "00"
+
+    if number.is_integer():
+        return "%02d" % number
+
+    return ("%05.2f" % number).rstrip("0")
+
+
+def _create_nfo(root: str, values: Dict) -> str:
+    element = ElementTree.Element(root)
+    for key, value in values.items():
+        if value is None or value == "":
+            continue
+
+        child = ElementTree.SubElement(element, key)
+        child.text = str(value)
+        if key == "uniqueid":
+            child.set("type", "crunchyroll")
+            child.set("default", "true")
+
+    return '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n' + ElementTree.tostring(element, "unicode")
+
+
+def _call_jsonrpc(method: str, params: Dict) -> Dict:
+    response = json.loads(xbmc.executeJSONRPC(json.dumps({
+        "jsonrpc": "2.0",
+        "id": 1,
+        "method": method,
+        "params": params
+    })))
+
+    return response.get("result") or {}
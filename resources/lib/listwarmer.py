@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+# Crunchyroll
+# Copyright (C) 2018 MrKrabat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import time
+from typing import Any, Dict, List, Optional
+
+import requests
+import xbmc
+import xbmcvfs
+
+from . import cache
+from . import utils
+from . import watched
+from .api import API
+from .model import Args, MediaData
+
+# cache namespace of the warmed lists
+NAMESPACE = "lists"
+
+WATCHLIST = "watchlist"
+HISTORY = "history"
+PLAYHEADS = "playheads"
+SEASONAL_TAGS = "seasonal_tags"
+CATEGORIES = "categories"
+# derived from the history by NextUp
+NEXT_UP = "next_up"
+
+
+def load(args: Args, name: str) -> Optional[Any]:
+    """ get a warmed list, None if it is not cached """
+
+    entry = cache.load(args, NAMESPACE, _get_cache_key(args, name))
+
+    return entry.get("data") if entry else None
+
+
+def store(args: Args, name: str, data: Any, ttl: int) -> None:
+    """ cache a list built from warmed ones """
+
+    cache.store(args, NAMESPACE, _get_cache_key(args, name), {"data": data}, time.time() + ttl)
+
+
+def invalidate(args: Args, name: str) -> None:
+    """ drop a warmed list which is known to be outdated, so views fetch it live until the next run """
+
+    cache.delete(args, NAMESPACE, _get_cache_key(args, name))
+
+
+def _get_cache_key(args: Args, name: str) -> str:
+    return "%s_%s" % (name, args.subtitle)
+
+
+def _get_received_bytes(response: requests.Response) -> int:
+    """ size of a response as received, before decompression """
+
+    try:
+        return int(response.raw.tell())
+    except (AttributeError, TypeError, ValueError):
+        return len(response.content or b"")
+
+
+class ListWarmer:
+    """
+    Keep the lists shown first after opening the addon in the cache
+
+    Fetches the watchlist, the first page of the history, the playheads of the queued episodes, seasonal tags and
+    categories. Every list is stored with a hash of its content: if a refresh brings nothing new, lists derived from
+    it are left alone (the playheads are only fetched again when the watchlist changed or they expired). Where a
+    response carries an ETag or Last-Modified header, the next refresh asks conditionally and an unchanged list
+    costs no body; without them the full list is downloaded and the hash only spares re-deriving other lists. Tags
+    and categories rarely change and are only fetched once they expired. The bytes received count against a daily
+    budget, persisted in the profile directory, and the run stops as soon as a video starts playing.
+    """
+
+    # seconds seasonal tags and categories are kept
+    STATIC_TTL = 24 * 60 * 60
+
+    def __init__(self, args: Args, api: API, monitor: xbmc.Monitor, interval: int):
+        self.args: Args = args
+        self.api: API = api
+        self.monitor: xbmc.Monitor = monitor
+        # the watchlist and history are kept until two runs have been missed
+        self.ttl: int = 3 * interval
+        # MiB per day
+        self.daily_budget: int = int(args.addon.getSetting("warm_lists_budget") or 0) * 1024 * 1024
+        self.budget: Dict = {}
+        self.watched: watched.WatchedStore = watched.get_store(args)
+        # responses received since the last refresh, collected by a response hook of the api session
+        self.responses: List[requests.Response] = []
+
+    def run(self) -> List[str]:
+        """ refresh all lists, returns the names of the lists that changed """
+
+        self.budget = self._load_budget()
+
+        changed = []
+        self.api.http.hooks["response"].append(self._on_response)
+        try:
+            watchlist = self._refresh(WATCHLIST, self._fetch_watchlist, self.ttl)
+            if watchlist is not None:
+                changed.append(WATCHLIST)
+
+            # the playheads only need to be fetched again if other episodes are queued, or they are outdated
+            if watchlist is not None or load(self.args, PLAYHEADS) is None:
+                if self._refresh(PLAYHEADS, self._fetch_playheads, self.ttl) is not None:
+                    changed.append(PLAYHEADS)
+
+            if self._refresh(HISTORY, self._fetch_history, self.ttl) is not None:
+                changed.append(HISTORY)
+
+            for name, fetch in [(SEASONAL_TAGS, self._fetch_seasonal_tags), (CATEGORIES, self._fetch_categories)]:
+                if load(self.args, name) is None and self._refresh(name, fetch, self.STATIC_TTL) is not None:
+                    changed.append(name)
+        finally:
+            self.api.http.hooks["response"].remove(self._on_response)
+            self._save_budget()
+            self.watched.save()
+
+        return changed
+
+    def _refresh(self, name: str, fetch, ttl: int) -> Optional[Any]:
+        """ fetch and store a list, returns the data if it changed, None if unchanged or skipped """
+
+        if self._should_stop():
+            return None
+
+        cache_key = _get_cache_key(self.args, name)
+        entry = cache.load(self.args, NAMESPACE, cache_key)
+
+        del self.responses[:]
+        try:
+            data = fetch(self._get_conditional_headers(entry))
+        finally:
+            # bodies are read completely by now, streamed ones included
+            self.budget["bytes"] = self.budget.get("bytes", 0) + sum(map(_get_received_bytes, self.responses))
+
+        response = self.responses[-1] if self.responses else None
+        not_modified = response is not None and response.status_code == 304 and entry is not None
+        if not_modified:
+            data = entry.get("data")
+        elif data is None:
+            return None
+
+        # unchanged or not, the response renews the watched state
+        if name == PLAYHEADS:
+            self.watched.update_from_playheads(data)
+        elif name in (WATCHLIST, HISTORY):
+            self.watched.update_from_items(data.get("items" if name == WATCHLIST else "data") or [])
+
+        if not_modified:
+            content_hash = entry.get("hash")
+        else:
+            encoded = json.dumps(data, sort_keys=True, separators=(",", ":"))
+            content_hash = hashlib.sha1(encoded.encode("utf-8")).hexdigest()
+
+        # unchanged data is stored again all the same, to extend its lifetime
+        validators = entry or {}
+        if not not_modified and response is not None:
+            validators = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified")
+            }
+        cache.store(self.args, NAMESPACE, cache_key, {
+            "hash": content_hash,
+            "etag": validators.get("etag"),
+            "last_modified": validators.get("last_modified"),
+            "data": data
+        }, time.time() + ttl)
+
+        if entry and entry.get("hash") == content_hash:
+            return None
+
+        return data
+
+    def _on_response(self, response: requests.Response, *args, **kwargs) -> None:
+        self.responses.append(response)
+
+    @staticmethod
+    def _get_conditional_headers(entry: Optional[Dict]) -> Dict[str, str]:
+        """ validators of the cached list, so an unchanged one isn't sent again """
+
+        headers = {}
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry.get("etag")
+        if entry and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry.get("last_modified")
+
+        return headers
+
+    def _should_stop(self) -> bool:
+        if self.monitor.abortRequested():
+            return True
+
+        # don't compete with the stream for bandwidth
+        if xbmc.Player().isPlayingVideo():
+            utils.crunchy_log(self.args, "List warming: paused for playback", xbmc.LOGDEBUG)
+            return True
+
+        if 0 < self.daily_budget <= self.budget.get("bytes", 0):
+            utils.crunchy_log(self.args, "List warming: daily budget exhausted", xbmc.LOGDEBUG)
+            return True
+
+        return False
+
+    def _fetch_list(
+            self,
+            url: str,
+            items_key: str,
+            params: Dict,
+            headers: Dict[str, str],
+            fields: Dict = MediaData.API_FIELDS
+    ) -> Optional[Dict]:
+        req = self.api.make_list_request(
+            method="GET",
+            url=url,
+            items_key=items_key,
+            fields=fields,
+            headers=headers,
+            params=params
+        )
+
+        items = list(req)
+        if "error" in req.meta:
+            return None
+
+        data = dict(req.meta)
+        data[items_key] = items
+
+        return data
+
+    def _fetch_watchlist(self, headers: Dict[str, str]) -> Optional[Dict]:
+        return self._fetch_list(
+            self.api.WATCHLIST_LIST_ENDPOINT.format(self.api.account_data.account_id),
+            "items",
+            {
+                "n": 1024,
+                "locale": self.args.subtitle
+            },
+            headers
+        )
+
+    def _fetch_history(self, headers: Dict[str, str]) -> Optional[Dict]:
+        return self._fetch_list(
+            self.api.HISTORY_ENDPOINT.format(self.api.account_data.account_id),
+            "data",
+            {
+                "page_size": 50,
+                "page": 1,
+                "locale": self.args.subtitle
+            },
+            headers,
+            MediaData.HISTORY_API_FIELDS
+        )
+
+    def _fetch_playheads(self, headers: Dict[str, str]) -> Optional[Dict]:
+        watchlist = load(self.args, WATCHLIST) or {}
+        episode_ids = [
+            item.get("panel", {}).get("id") for item in watchlist.get("items", [])
+            if item.get("panel", {}).get("id")
+        ]
+        if not episode_ids:
+            return None
+
+        return self._fetch(
+            self.api.PLAYHEADS_ENDPOINT.format(self.api.account_data.account_id),
+            {
+                "locale": self.args.subtitle,
+                "content_ids": ",".join(episode_ids)
+            },
+            headers
+        )
+
+    def _fetch_seasonal_tags(self, headers: Dict[str, str]) -> Optional[Dict]:
+        return self._fetch(self.api.SEASONAL_TAGS_ENDPOINT, {"locale": self.args.subtitle}, headers)
+
+    def _fetch_categories(self, headers: Dict[str, str]) -> Optional[Dict]:
+        return self._fetch(self.api.CATEGORIES_ENDPOINT, {"locale": self.args.subtitle}, headers)
+
+    def _fetch(self, url: str, params: Dict, headers: Dict[str, str]) -> Optional[Dict]:
+        req = self.api.make_request(method="GET", url=url, headers=headers, params=params)
+        if not req or "error" in req:
+            return None
+
+        return req
+
+    def _get_budget_file(self) -> str:
+        return xbmcvfs.translatePath(self.args.addon.getAddonInfo("profile") + "warm_lists_budget.json")
+
+    def _load_budget(self) -> Dict:
+        today = time.strftime("%Y-%m-%d")
+        budget = {"date": today, "bytes": 0}
+
+        if xbmcvfs.exists(self._get_budget_file()):
+            try:
+                with xbmcvfs.File(self._get_budget_file()) as file:
+                    data = json.load(file)
+                if data.get("date") == today:
+                    budget.update(data)
+            except ValueError:
+                utils.crunchy_log(self.args, "List warming: resetting invalid budget file", xbmc.LOGWARNING)
+
+        return budget
+
+    def _save_budget(self) -> None:
+        with xbmcvfs.File(self._get_budget_file(), 'w') as file:
+            file.write(json.dumps(self.budget))
@@ -16,6 +16,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
+from typing import Optional
 
 try:
     from urllib import unquote_plus
@@ -91,16 +92,46 @@ class Meta(type, metaclass=type("", (type,), {"__str__": lambda _: "~hi"})):
 
 
 class Object(metaclass=Meta):
+    # no __dict__ of its own, so subclasses may use slots
+    __slots__ = ()
+
+    # version of the to_dict format, bump it on incompatible changes
+    VERSION = 1
+    # attributes written by to_dict
+    FIELDS = ()
+
+    def to_dict(self) -> dict:
+        """ plain dict of the object for the codec, restored by from_dict """
+
+        return {field: getattr(self, field, None) for field in self.FIELDS}
+
+    @classmethod
+    def from_dict(cls, data: dict, version: int = VERSION) -> Optional["Object"]:
+        """ restore an object written by to_dict, None if data has a newer version than we know """
+
+        if version > cls.VERSION:
+            return None
+
+        obj = cls.__new__(cls)
+        for field in cls.FIELDS:
+            setattr(obj, field, data.get(field))
+
+        return obj
+
     @staticmethod
     def default(obj: "Object"):
+        attributes = obj.__dict__ if hasattr(obj, "__dict__") else [
+            slot for cls in type(obj).__mro__ for slot in getattr(cls, "__slots__", ())
+        ]
+
         return {
             "_": obj.__class__.__name__,
             **{
                 attr: (
                     getattr(obj, attr)
                 )
-                for attr in filter(lambda x: not x.startswith("_"), obj.__dict__)
-                if getattr(obj, attr) is not None
+                for attr in filter(lambda x: not x.startswith("_"), attributes)
+                if getattr(obj, attr, None) is not None
             }
         }
 
@@ -109,6 +140,8 @@ class Object(metaclass=Meta):
 
 
 class CMS(Object):
+    FIELDS = ("bucket", "policy", "signature", "key_pair_id")
+
     def __init__(self, data: dict):
         self.bucket: str = data.get("bucket")
         self.policy: str = data.get("policy")
@@ -117,7 +150,13 @@ class CMS(Object):
 
 
 class AccountData(Object):
+    FIELDS = ("access_token", "refresh_token", "expires", "token_type", "scope", "country", "account_id", "cms",
+              "service_available", "avatar", "has_beta", "email_verified", "email", "maturity_rating",
+              "account_language", "default_subtitles_language", "default_audio_language", "username")
+
     def __init__(self, data: dict):
+        """ create from the merged token, index and profile api responses """
+
         self.access_token: str = data.get("access_token")
         self.refresh_token: str = data.get("refresh_token")
         self.expires: str = data.get("expires")
@@ -137,101 +176,161 @@ class AccountData(Object):
         self.default_audio_language: str = data.get("preferred_content_audio_language")
         self.username: str = data.get("username")
 
+    def to_dict(self) -> dict:
+        data = super().to_dict()
+        data["cms"] = self.cms.to_dict()
+
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict, version: int = Object.VERSION) -> Optional["AccountData"]:
+        account_data = super().from_dict(data, version)
+        if account_data is None:
+            return None
+
+        account_data.cms = CMS.from_dict(data.get("cms") or {}, version)
+
+        return account_data
+
+
+class MediaData(Object):
+    """ Playable item of the watchlist or history, parsed from its panel
+
+    EpisodeData and MovieData only differ in where their metadata lives, every field is computed once here. Lists of
+    hundreds of these are built for a single view, so they use slots instead of a dict per instance.
+    """
+
+    __slots__ = ("title", "tvshowtitle", "duration", "playhead", "episode", "episode_id", "collection_id",
+                 "series_id", "plot", "plotoutline", "year", "aired", "premiered", "thumb", "fanart", "playcount",
+                 "stream_id")
+    FIELDS = __slots__
+
+    # the parts of a watchlist or history item read here, for pruning api responses
+    API_FIELDS = {
+        "playhead": True,
+        "fully_watched": True,
+        "panel": {
+            "id": True,
+            "type": True,
+            "title": True,
+            "description": True,
+            "images": {"thumbnail": True},
+            "__links__": {"streams": True},
+            "streams_link": True,
+            "episode_metadata": {
+                "season_title": True,
+                "episode": True,
+                "series_title": True,
+                "duration_ms": True,
+                "season_id": True,
+                "series_id": True,
+                "episode_air_date": True
+            },
+            "movie_metadata": {
+                "movie_listing_title": True,
+                "duration_ms": True,
+                "premium_available_date": True
+            }
+        }
+    }
+
+    # history items also tell when they were played
+    HISTORY_API_FIELDS = dict(API_FIELDS, date_played=True)
+
+    # key of the metadata in the panel
+    METADATA_KEY = ""
+    # key of the release date in the metadata
+    DATE_KEY = ""
 
-class MovieData(Object):
     def __init__(self, data: dict):
         from . import utils
 
-        meta = data.get("panel").get("movie_metadata")
+        panel = data.get("panel") or {}
+        meta = panel.get(self.METADATA_KEY) or {}
+
+        self._parse_metadata(panel, meta)
 
-        self.title: str = meta.get("movie_listing_title", "")
-        self.tvshowtitle: str = meta.get("movie_listing_title", "")
         self.duration: int = int(meta.get("duration_ms", 0) / 1000)
         self.playhead: int = data.get("playhead", 0)
-        self.episode: str = "1"
-        self.episode_id: str | None = data.get("panel", {}).get("id")
-        self.collection_id: str | None = None
-        self.series_id: str | None = None
-        self.plot: str = data.get("panel", {}).get("description", "")
-        self.plotoutline: str = data.get("panel", {}).get("description", "")
-        self.year: str = meta.get("premium_available_date")[:10] if meta.get(
-            "premium_available_date") is not None else ""
-        self.aired: str = meta.get("premium_available_date")[:10] if meta.get(
-            "premium_available_date") is not None else ""
-        self.premiered: str = meta.get("premium_available_date")[:10] if meta.get(
-            "premium_available_date") is not None else ""
-        self.thumb: str | None = utils.get_image_from_struct(data.get("panel"), "thumbnail", 2)
-        self.fanart: str | None = utils.get_image_from_struct(data.get("panel"), "thumbnail", 2)
-        self.playcount: int = 0
-        self.stream_id: str | None = None
-
-        try:
-            # note that for fetching streams we need a special guid, not the episode_id
-            self.stream_id = utils.get_stream_id_from_url(
-                data.get("panel", {}).get("__links__", {}).get("streams", {}).get("href", "")
-            )
-
-            # history data has the stream_id at a different location
-            if self.stream_id is None:
-                self.stream_id = utils.get_stream_id_from_url(
-                    data.get("panel", {}).get("streams_link")
-                )
+        self.episode_id: str | None = panel.get("id")
+        self.plot: str = panel.get("description", "")
+        self.plotoutline: str = self.plot
+
+        date = meta.get(self.DATE_KEY)
+        self.year: str = date[:10] if date is not None else ""
+        self.aired: str = self.year
+        self.premiered: str = self.year
+
+        self.thumb: str | None = utils.get_image_from_struct(panel, "thumbnail", 2)
+        self.fanart: str | None = self.thumb
+
+        # note that for fetching streams we need a special guid, not the episode_id.
+        # history data has the stream_id at a different location
+        self.stream_id: str | None = utils.get_stream_id_from_url(
+            panel.get("__links__", {}).get("streams", {}).get("href") or panel.get("streams_link") or ""
+        )
+        if self.stream_id is None:
+            raise CrunchyrollError("Failed to get stream id for %s" % self.title)
 
-            if self.stream_id is None:
-                raise Exception("")
+        self.playcount: int = 1 if utils.is_watched(self.playhead, self.duration) else 0
 
-        except Exception:
-            raise CrunchyrollError("Failed to get stream id for %s" % self.title)
+    def _parse_metadata(self, panel: dict, meta: dict) -> None:
+        """ set title, tvshowtitle, episode, collection_id and series_id """
+
+        raise NotImplementedError
 
-        if self.playhead is not None and self.duration is not None:
-            self.playcount = 1 if (int(self.playhead / self.duration * 100)) > 90 else 0
+    def to_info(self) -> dict:
+        """ the item as info dict for view.add_item """
+
+        return {
+            "title": self.title,
+            "tvshowtitle": self.tvshowtitle,
+            "duration": self.duration,
+            "playcount": self.playcount,
+            "episode": self.episode,
+            "episode_id": self.episode_id,
+            "collection_id": self.collection_id,
+            "series_id": self.series_id,
+            "plot": self.plot,
+            "plotoutline": self.plotoutline,
+            "genre": "",  # no longer available
+            "year": self.year,
+            "aired": self.aired,
+            "premiered": self.premiered,
+            "thumb": self.thumb,
+            "fanart": self.fanart,
+            "stream_id": self.stream_id,
+            "playhead": self.playhead
+        }
+
+
+class MovieData(MediaData):
+    __slots__ = ()
+
+    METADATA_KEY = "movie_metadata"
+    DATE_KEY = "premium_available_date"
+
+    def _parse_metadata(self, panel: dict, meta: dict) -> None:
+        self.title: str = meta.get("movie_listing_title", "")
+        self.tvshowtitle: str = self.title
+        self.episode: str = "1"
+        self.collection_id: str | None = None
+        self.series_id: str | None = None
 
 
 # dto
-class EpisodeData(Object):
-    def __init__(self, data: dict):
-        from . import utils
+class EpisodeData(MediaData):
+    __slots__ = ()
 
-        meta = data.get("panel").get("episode_metadata")
+    METADATA_KEY = "episode_metadata"
+    DATE_KEY = "episode_air_date"
 
-        self.title: str = meta.get("season_title") + " #" + meta.get("episode") + " - " + data.get("panel").get("title")
+    def _parse_metadata(self, panel: dict, meta: dict) -> None:
+        self.title: str = meta.get("season_title") + " #" + meta.get("episode") + " - " + panel.get("title")
         self.tvshowtitle: str = meta.get("series_title", "")
-        self.duration: int = int(meta.get("duration_ms", 0) / 1000)
-        self.playhead: int = data.get("playhead", 0)
         self.episode: str = meta.get("episode", "")
-        self.episode_id: str | None = data.get("panel", {}).get("id")
         self.collection_id: str | None = meta.get("season_id")
         self.series_id: str | None = meta.get("series_id")
-        self.plot: str = data.get("panel", {}).get("description", "")
-        self.plotoutline: str = data.get("panel", {}).get("description", "")
-        self.year: str = meta.get("episode_air_date")[:10] if meta.get("episode_air_date") is not None else ""
-        self.aired: str = meta.get("episode_air_date")[:10] if meta.get("episode_air_date") is not None else ""
-        self.premiered: str = meta.get("episode_air_date")[:10] if meta.get("episode_air_date") is not None else ""
-        self.thumb: str | None = utils.get_image_from_struct(data.get("panel"), "thumbnail", 2)
-        self.fanart: str | None = utils.get_image_from_struct(data.get("panel"), "thumbnail", 2)
-        self.playcount: int = 0
-        self.stream_id: str | None = None
-
-        try:
-            # note that for fetching streams we need a special guid, not the episode_id
-            self.stream_id = utils.get_stream_id_from_url(
-                data.get("panel", {}).get("__links__", {}).get("streams", {}).get("href", "")
-            )
-
-            # history data has the stream_id at a different location
-            if self.stream_id is None:
-                self.stream_id = utils.get_stream_id_from_url(
-                    data.get("panel", {}).get("streams_link")
-                )
-
-            if self.stream_id is None:
-                raise Exception("")
-
-        except Exception:
-            raise CrunchyrollError("Failed to get stream id for %s" % self.title)
-
-        if self.playhead is not None and self.duration is not None:
-            self.playcount = 1 if (int(self.playhead / self.duration * 100)) > 90 else 0
 
 
 class CrunchyrollError(Exception):
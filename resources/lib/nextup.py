@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# Crunchyroll
+# Copyright (C) 2018 MrKrabat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import xbmc
+
+from . import listwarmer
+from . import utils
+from .api import API
+from .history import HistoryStore
+from .model import Args, EpisodeData, MediaData, MovieData
+from .upnext import UpNext
+
+
+class NextUp:
+    """
+    Continue watching: the episode to watch next for every recently watched series
+
+    Derived from the local history mirror, which already holds the playhead of every entry: the latest entry of a
+    series is resumed if it wasn't finished, otherwise its successor is looked up in the season's episode list. Each
+    season is fetched only once, all of them concurrently, and cached per season by UpNext, so the next run mostly
+    needs the new history entries. The result is cached as well, the service rebuilds it whenever the history changed.
+    """
+
+    HISTORY_PAGES = 6
+    MAX_SERIES = 50
+    CONCURRENCY = 4
+    # seconds the result is kept, unless the history changes before
+    CACHE_TTL = 60 * 60
+
+    def __init__(self, args: Args, api: API):
+        self.args: Args = args
+        self.api: API = api
+        self.upnext: UpNext = UpNext(args, api)
+
+    def get_items(self) -> List[Dict]:
+        """ get the info dicts of the next episodes, the most recently watched series first """
+
+        items = listwarmer.load(self.args, listwarmer.NEXT_UP)
+        if items is None:
+            items = self.refresh()
+
+        return items
+
+    def refresh(self) -> List[Dict]:
+        """ build the list from the history and cache it """
+
+        latest = self._get_latest_entries()
+
+        # every season is fetched once, no matter how many entries ask for it
+        season_ids = list(dict.fromkeys(
+            entry.collection_id for entry, item in latest if entry.collection_id and self._is_finished(entry, item)
+        ))
+        with ThreadPoolExecutor(max_workers=self.CONCURRENCY) as pool:
+            list(pool.map(self._load_season, season_ids))
+
+            # the episode lists are cached now, only episodes ending a season look up the next one
+            items = list(pool.map(lambda latest_entry: self._get_next(*latest_entry), latest))
+
+        items = [item for item in items if item]
+        listwarmer.store(self.args, listwarmer.NEXT_UP, items, self.CACHE_TTL)
+
+        utils.crunchy_log(
+            self.args,
+            "Continue watching: %d items from %d series, %d seasons" % (len(items), len(latest), len(season_ids)),
+            xbmc.LOGDEBUG
+        )
+
+        return items
+
+    def _get_latest_entries(self) -> List[tuple]:
+        """ the latest history entry of each series, as (parsed entry, item) """
+
+        store = HistoryStore(self.args, self.api)
+        store.sync()
+
+        # older pages are only mirrored as far as needed to find enough series
+        page = 1
+        while len(store.get_series()) < self.MAX_SERIES and page < self.HISTORY_PAGES and not store.is_complete():
+            page = page + 1
+            store.get_page(page)
+
+        latest = []
+        for item in store.get_series():
+            entry = self._parse_item(item)
+            if entry:
+                latest.append((entry, item))
+
+        return latest[:self.MAX_SERIES]
+
+    def _load_season(self, season_id: str) -> None:
+        try:
+            self.upnext.get_season_episodes(season_id)
+        except Exception:
+            utils.log_error_with_trace(self.args, "Continue watching: failed to load season %s" % season_id, False)
+
+    def _get_next(self, entry: MediaData, item: Dict) -> Optional[Dict]:
+        """ the info dict of what to watch next after a history entry, None if the series is done """
+
+        if not self._is_finished(entry, item):
+            return entry.to_info()
+
+        if not entry.collection_id:
+            return None
+
+        try:
+            episode = self.upnext.get_next_episode(entry.episode_id, entry.collection_id, entry.series_id)
+        except Exception:
+            utils.log_error_with_trace(self.args, "Continue watching: failed to find next episode", False)
+            return None
+
+        return self.get_episode_info(episode, entry.fanart) if episode else None
+
+    @staticmethod
+    def _is_finished(entry: MediaData, item: Dict) -> bool:
+        return bool(item.get("fully_watched") or entry.playcount)
+
+    @staticmethod
+    def get_episode_info(episode: Dict, fanart: Optional[str] = None) -> Dict:
+        """ build the info dict of an item of EPISODES_ENDPOINT """
+
+        return {
+            "title": UpNext.get_episode_title(episode),
+            "tvshowtitle": episode.get("series_title"),
+            "duration": int(episode.get("duration_ms", 0) / 1000),
+            "playcount": 0,
+            "episode": episode.get("episode_number"),
+            "episode_id": episode.get("id"),
+            "collection_id": episode.get("season_id"),
+            "series_id": episode.get("series_id"),
+            "plot": episode.get("description"),
+            "plotoutline": episode.get("description"),
+            "aired": (episode.get("episode_air_date") or "")[:10],
+            "thumb": utils.get_image_from_struct(episode, "thumbnail", 2),
+            "fanart": fanart,
+            "stream_id": utils.get_stream_id_from_url(
+                episode.get("__links__", {}).get("streams", {}).get("href", "")
+            ),
+            "playhead": 0
+        }
+
+    def _parse_item(self, item: Dict) -> Optional[MediaData]:
+        try:
+            if item.get("panel", {}).get("type") == "episode":
+                return EpisodeData(item)
+            elif item.get("panel", {}).get("type") == "movie":
+                return MovieData(item)
+        except Exception:
+            utils.crunchy_log(self.args, "Continue watching: skipping item", xbmc.LOGDEBUG)
+
+        return None
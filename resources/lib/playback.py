@@ -0,0 +1,461 @@
+# -*- coding: utf-8 -*-
+# Crunchyroll
+# Copyright (C) 2018 MrKrabat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import time
+from typing import Dict, Optional, Tuple
+
+import inputstreamhelper
+import xbmc
+import xbmcgui
+
+from . import listwarmer
+from . import utils
+from . import watched
+from .api import API
+from .model import Args
+from .playheads import PlayheadWriter
+from .streamselector import StreamSelector
+from .upnext import UpNext
+from .videostream import VideoPlayerStreamData, VideoStream
+
+# window property holding the playback sessions, shared between plugin and service
+SESSIONS_PROPERTY = "crunchyroll.playback_sessions"
+# sessions that never started playing are dropped after this many seconds
+SESSION_LIFETIME = 12 * 60 * 60
+
+
+def register_session(session: Dict) -> None:
+    """ announce a resolved stream to the service, which monitors its playback
+
+    the session is identified by the path handed to the player, it should hold episode_id, collection_id, series_id,
+    stream_id, stream_type, title, duration and playhead (if known)
+    """
+
+    sessions = _load_sessions()
+    session["registered_at"] = time.time()
+    sessions[session.get("path")] = session
+
+    _save_sessions(sessions)
+
+
+def get_session(path: str) -> Optional[Dict]:
+    return _load_sessions().get(path)
+
+
+def remove_session(path: str) -> None:
+    sessions = _load_sessions()
+    if sessions.pop(path, None) is not None:
+        _save_sessions(sessions)
+
+
+def create_play_item(args: Args, stream_info: VideoPlayerStreamData, title: str) -> Tuple[xbmcgui.ListItem, bool]:
+    """ create the list item to play a resolved stream, also returns if inputstream adaptive is used """
+
+    item = xbmcgui.ListItem(title, path=stream_info.stream_url)
+    if stream_info.manifest_type == "mpd":
+        item.setMimeType("application/dash+xml")
+    else:
+        item.setMimeType("application/vnd.apple.mpegurl")
+    item.setContentLookup(False)
+
+    # inputstream adaptive
+    is_helper = inputstreamhelper.Helper(stream_info.manifest_type)
+    use_inputstream = is_helper.check_inputstream()
+    if use_inputstream:
+        item.setProperty("inputstream", "inputstream.adaptive")
+        item.setProperty("inputstream.adaptive.manifest_type", stream_info.manifest_type)
+        # add soft subtitles url for configured language
+        if stream_info.subtitle_urls:
+            item.setSubtitles(stream_info.subtitle_urls)
+
+    return item, use_inputstream
+
+
+def _get_latest_pending_session() -> Optional[Dict]:
+    """ get the most recently resolved session which did not start playing yet """
+
+    pending = [session for session in _load_sessions().values() if session.get("resolved_at")]
+
+    return max(pending, key=lambda session: session.get("resolved_at")) if pending else None
+
+
+def _load_sessions() -> Dict:
+    try:
+        sessions = json.loads(xbmcgui.Window(10000).getProperty(SESSIONS_PROPERTY) or "{}")
+    except ValueError:
+        return {}
+
+    return {
+        path: session for path, session in sessions.items()
+        if session.get("registered_at", 0) > time.time() - SESSION_LIFETIME
+    }
+
+
+def _save_sessions(sessions: Dict) -> None:
+    xbmcgui.Window(10000).setProperty(SESSIONS_PROPERTY, json.dumps(sessions))
+
+
+class PlaybackMonitor(xbmc.Player):
+    """
+    Follow playback of streams resolved by the plugin, driven by player events
+
+    Runs inside the service, so the plugin can exit right after resolving the url. On start it records the startup
+    time of the stream type and offers to resume, while playing it feeds the playhead to the PlayheadWriter and if
+    inputstream adaptive fails, it retries with kodi's own player. The position is only sampled now and then and
+    extrapolated when playback stops, as the player can't be asked anymore at that point.
+
+    In binge mode the next episode is resolved shortly before the current one ends. It is queued in the video
+    playlist if one is playing, otherwise it is started as soon as the current episode ended.
+    """
+
+    # seconds before the end of an episode the next one is prepared in binge mode
+    BINGE_LEAD = 120
+
+    def __init__(self, service):
+        super().__init__()
+        self.service = service
+        self.args: Optional[Args] = None
+        self.api: Optional[API] = None
+        self.writer: PlayheadWriter = PlayheadWriter(service)
+        self.session: Optional[Dict] = None
+        # playhead updates must not be sent before the resume dialog has been answered
+        self.started: bool = False
+        self.paused: bool = False
+        self.position: float = 0
+        self.sampled_at: float = 0
+        # binge mode: path of the session the next episode was looked up for and the item to play after it, as
+        # (path of the session it follows, path, list item)
+        self.prepared_for: Optional[str] = None
+        self.next_item: Optional[Tuple[str, str, xbmcgui.ListItem]] = None
+
+    def get_tick_interval(self) -> Optional[float]:
+        """ seconds until the service should call tick again, None if there is nothing to do """
+
+        intervals = []
+        if self.session and self.started:
+            intervals.append(self.writer.interval)
+        if self.writer.has_pending():
+            intervals.append(max(1.0, self.writer.get_retry_delay()))
+
+        return min(intervals) if intervals else None
+
+    def onPlayBackStarted(self) -> None:
+        self._attach()
+
+    def onAVStarted(self) -> None:
+        session = self._attach()
+        if not session:
+            return
+
+        self._sample(0)
+        self.paused = False
+
+        if session.get("resolved_at") and session.get("stream_type"):
+            StreamSelector(self.args).record_startup(session.get("stream_type"), time.time() - session["resolved_at"])
+            # only measure the first start, not a restart with the fallback
+            session["resolved_at"] = None
+            register_session(session)
+
+        if self.args.addon.getSetting("sync_playtime") == "true" and self.api:
+            self._ask_resume()
+
+        self.started = True
+
+    def onPlayBackError(self) -> None:
+        # the error might occur before we learned about the playing file, use the most recent pending session then
+        session = self.session or _get_latest_pending_session()
+        self.session = None
+        if not session or not session.get("inputstream"):
+            return
+
+        if not self.args:
+            self.args = self.service.create_args()
+
+        utils.crunchy_log(self.args, "Inputstream Adaptive failed, trying directly with kodi", xbmc.LOGDEBUG)
+
+        if session.get("stream_type"):
+            StreamSelector(self.args).record_startup(session.get("stream_type"), None)
+
+        # the cached stream data might be the culprit, make sure the next attempt fetches fresh urls
+        video_stream = VideoStream(self.args, self.api, session.get("stream_id"))
+        video_stream.invalidate_stream_data()
+
+        # kodi itself only plays hls, a dash session needs an hls stream of the episode instead
+        if StreamSelector.get_manifest_type(session.get("stream_type") or "") != "hls":
+            if not self.api:
+                self.api = self.service.create_api(self.args)
+            try:
+                stream_info = video_stream.get_download_stream_data() if self.api else None
+            except Exception:
+                utils.log_error_with_trace(self.args, "Failed to resolve an hls stream for the fallback", False)
+                stream_info = None
+            if not stream_info or not stream_info.stream_url:
+                utils.crunchy_log(self.args, "No hls stream to fall back to", xbmc.LOGERROR)
+                return
+
+            remove_session(session.get("path"))
+            session["path"] = stream_info.stream_url
+            session["stream_type"] = stream_info.stream_type
+
+        session["inputstream"] = False
+        session["resolved_at"] = None
+        register_session(session)
+
+        item = xbmcgui.ListItem(session.get("title", "Title not provided"), path=session.get("path"))
+        item.setProperty("inputstream", "")
+        self.play(session.get("path"), item)
+
+    def onPlayBackPaused(self) -> None:
+        if self.session and self.started:
+            self._update_position()
+            self.paused = True
+            self._sync_playhead(force=True)
+
+    def onPlayBackResumed(self) -> None:
+        if self.session and self.started:
+            self.paused = False
+            self._sample(self.position)
+
+    def onPlayBackStopped(self) -> None:
+        self._finish()
+
+    def onPlayBackEnded(self) -> None:
+        ended = self.session.get("path") if self.session else None
+        if self.session and self.session.get("duration"):
+            self._sample(float(self.session.get("duration")))
+            self.paused = True
+
+        # binge mode without playlist, continue with the prepared episode ourselves. only if it was prepared for
+        # the episode that just ended, not for one stopped before.
+        next_item, self.next_item = self.next_item, None
+        self._finish()
+
+        if next_item and ended and next_item[0] == ended:
+            self.play(next_item[1], next_item[2])
+
+    def onPlayBackSeek(self, seek_time: int, seek_offset: int) -> None:
+        if self.session and self.started:
+            self._sample(seek_time / 1000.0)
+            self._sync_playhead(force=True)
+
+    def tick(self) -> None:
+        """ regular update, called from the service loop """
+
+        if self.session and self.started:
+            try:
+                if self.getPlayingFile() != self.session.get("path"):
+                    # another item started without us noticing
+                    self._finish()
+                else:
+                    self._update_position()
+                    self._sync_playhead()
+                    self._prepare_next()
+            except RuntimeError:
+                pass
+
+        # send what is due: coalesced updates once the sync interval passed, failed ones after their backoff
+        if self.writer.has_pending() and self.writer.get_retry_delay() == 0:
+            self.writer.flush()
+
+    def _sample(self, position: float) -> None:
+        self.position = position
+        self.sampled_at = time.time()
+
+    def _update_position(self) -> None:
+        try:
+            self._sample(self.getTime())
+        except RuntimeError:
+            pass
+
+    def _get_estimated_position(self) -> float:
+        """ last known position, advanced by the time passed since, unless paused """
+
+        if self.paused:
+            return self.position
+
+        return self.position + (time.time() - self.sampled_at)
+
+    def _attach(self) -> Optional[Dict]:
+        """ look up the session of the playing file and prepare monitoring it """
+
+        try:
+            path = self.getPlayingFile()
+        except RuntimeError:
+            return None
+
+        if self.session and self.session.get("path") == path:
+            return self.session
+
+        # playlists continue with the next item without an end event for the previous one
+        self._finish()
+
+        self.session = get_session(path)
+        self.started = False
+        if self.session:
+            self.args = self.service.create_args()
+            self.api = self.service.create_api(self.args)
+
+        return self.session
+
+    def _finish(self) -> None:
+        # the prepared episode only follows the session it was prepared for
+        if self.next_item:
+            remove_session(self.next_item[1])
+            self.next_item = None
+        self.prepared_for = None
+
+        if not self.session:
+            return
+
+        position = self._get_estimated_position()
+        if self.session.get("duration"):
+            position = min(position, float(self.session.get("duration")))
+
+        if self.started and position:
+            self._sample(position)
+            # the final position is always written, if necessary by a later retry
+            self._sync_playhead(force=True)
+
+        self.started = False
+        remove_session(self.session.get("path"))
+        self.session = None
+
+        # watching changed progress and history, refresh them as soon as playback is over
+        for name in [listwarmer.WATCHLIST, listwarmer.HISTORY, listwarmer.PLAYHEADS, listwarmer.NEXT_UP]:
+            listwarmer.invalidate(self.args, name)
+        self.service.request_job("list warming")
+
+    def _prepare_next(self) -> None:
+        """ in binge mode, resolve the next episode when the current one is about to end """
+
+        if self.args.addon.getSetting("binge_mode") != "true" or not self.api:
+            return
+
+        if self.prepared_for == self.session.get("path") or not self.session.get("collection_id"):
+            return
+
+        try:
+            duration = float(self.session.get("duration") or self.getTotalTime())
+        except RuntimeError:
+            return
+
+        if not duration or duration - self.position > self.BINGE_LEAD:
+            return
+
+        # only try once per episode, even if it fails
+        self.prepared_for = self.session.get("path")
+
+        try:
+            episode = UpNext(self.args, self.api).get_next_episode(
+                self.session.get("episode_id"),
+                self.session.get("collection_id"),
+                self.session.get("series_id")
+            )
+            if not episode:
+                utils.crunchy_log(self.args, "Binge mode: no next episode found", xbmc.LOGDEBUG)
+                return
+
+            stream_id = utils.get_stream_id_from_url(episode.get("__links__", {}).get("streams", {}).get("href", ""))
+            stream_info = VideoStream(self.args, self.api, stream_id).get_player_stream_data()
+            if not stream_info or not stream_info.stream_url:
+                utils.crunchy_log(self.args, "Binge mode: failed to resolve next episode", xbmc.LOGERROR)
+                return
+        except Exception:
+            utils.log_error_with_trace(self.args, "Binge mode: failed to prepare next episode", False)
+            return
+
+        title = UpNext.get_episode_title(episode)
+        item, use_inputstream = create_play_item(self.args, stream_info, title)
+
+        register_session({
+            "path": stream_info.stream_url,
+            "episode_id": episode.get("id"),
+            "collection_id": episode.get("season_id"),
+            "series_id": episode.get("series_id"),
+            "stream_id": stream_id,
+            "stream_type": stream_info.stream_type,
+            "title": title,
+            "duration": int(episode.get("duration_ms", 0) / 1000) or None,
+            "playhead": None,
+            "inputstream": use_inputstream,
+            # resolved in advance, startup time can't be measured
+            "resolved_at": None
+        })
+
+        playlist = xbmc.PlayList(xbmc.PLAYLIST_VIDEO)
+        if playlist.size() > 0 and playlist.getposition() >= 0:
+            playlist.add(stream_info.stream_url, item, playlist.getposition() + 1)
+            self.next_item = None
+        else:
+            self.next_item = (self.session.get("path"), stream_info.stream_url, item)
+
+        utils.crunchy_log(self.args, "Binge mode: prepared %s" % title, xbmc.LOGDEBUG)
+
+    def _sync_playhead(self, force: bool = False) -> None:
+        if not self.session:
+            return
+
+        # pauses, seeks and stops show up in the listings right away, before crunchyroll knows about them
+        if force:
+            store = watched.get_store(self.args)
+            duration = int(float(self.session.get("duration") or 0))
+            store.update(self.session.get("episode_id"), int(self.position),
+                         utils.is_watched(self.position, duration), local=True)
+            store.save()
+
+        if self.args.addon.getSetting("sync_playtime") != "true":
+            return
+
+        self.writer.update(self.session.get("episode_id"), self.position, force)
+
+    def _ask_resume(self) -> None:
+        """ ask if the user wants to continue playback where they left off """
+
+        playhead = self.session.get("playhead")
+        duration = float(self.session.get("duration") or 0)
+
+        # the playheads of queued and recently played episodes are usually known
+        store = watched.get_store(self.args)
+        if playhead is None:
+            entry = store.get(self.session.get("episode_id"), fresh=True)
+            playhead = entry.get("playhead") if entry else None
+
+        # fetch playhead info from api
+        if playhead is None:
+            playhead = 0
+            req_episode_data = self.api.make_request(
+                method="GET",
+                url=self.api.PLAYHEADS_ENDPOINT.format(self.api.account_data.account_id),
+                params={
+                    "locale": self.args.subtitle,
+                    "content_ids": self.session.get("episode_id")
+                }
+            )
+
+            if req_episode_data and req_episode_data["data"]:
+                playhead = int(req_episode_data["data"][0]["playhead"])
+                store.update_from_playheads(req_episode_data)
+                store.save()
+
+        if playhead and duration:
+            resume = int(int(playhead) / float(duration) * 100)
+            if 5 <= resume <= 90:
+                self.pause()
+                if xbmcgui.Dialog().yesno(self.args.addonname, self.args.addon.getLocalizedString(30065) % int(resume)):
+                    self.seekTime(float(playhead) - 5)
+                self.pause()
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+# Crunchyroll
+# Copyright (C) 2018 MrKrabat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import time
+from typing import Dict, Optional
+
+import xbmc
+import xbmcvfs
+from requests import RequestException
+
+from . import utils
+
+
+class PlayheadWriter:
+    """
+    Write-behind queue for playhead updates
+
+    Updates are coalesced per episode and only sent if the position changed noticeably and the sync interval has
+    passed, or immediately on pause, seek and stop. Pending updates are kept in a journal in the profile directory
+    until crunchyroll accepted them, so they survive network outages and restarts. Failed updates are retried with
+    exponential backoff.
+    """
+
+    # position changes below this many seconds are not worth an update (e.g. while paused)
+    MIN_CHANGE = 5
+    # backoff for failed updates, doubled on every failure up to the maximum
+    BACKOFF_BASE = 15
+    BACKOFF_MAX = 30 * 60
+    # updates rejected by the api (not network errors) are dropped after this many attempts
+    MAX_REJECTIONS = 5
+    # pending updates older than this are dropped
+    MAX_AGE = 7 * 24 * 60 * 60
+
+    def __init__(self, service):
+        self.service = service
+        self.args = service.create_args()
+        self.api = None
+        self.interval: int = max(10, int(self.args.addon.getSetting("playhead_sync_interval") or 60))
+        # episode_id => {"playhead", "updated", "attempts", "rejections", "retry_at"}
+        self.journal: Dict[str, Dict] = self._load_journal()
+        # episode_id => last playhead crunchyroll knows about
+        self.sent: Dict[str, int] = {}
+        self.last_send: float = 0
+
+    def update(self, episode_id: str, position: float, force: bool = False) -> None:
+        """ queue the playhead of an episode, force sends it right away (pause, seek, stop) """
+
+        if not episode_id:
+            return
+
+        playhead = int(position)
+        pending = self.journal.get(episode_id)
+        known = pending.get("playhead") if pending else self.sent.get(episode_id)
+
+        if known is not None and abs(playhead - known) < self.MIN_CHANGE and not force:
+            return
+
+        # coalesced updates wait for the sync interval, a failed one keeps its backoff
+        retry_at = 0 if force else self.last_send + self.interval
+        if pending and pending.get("attempts") and not force:
+            retry_at = max(retry_at, pending.get("retry_at", 0))
+
+        self.journal[episode_id] = {
+            "playhead": playhead,
+            "updated": time.time(),
+            "attempts": pending.get("attempts", 0) if pending and not force else 0,
+            "rejections": 0,
+            "retry_at": retry_at
+        }
+
+        if force or time.time() - self.last_send >= self.interval:
+            self._save_journal()
+            self.flush()
+
+    def has_pending(self) -> bool:
+        return len(self.journal) > 0
+
+    def get_retry_delay(self) -> Optional[float]:
+        """ seconds until the next pending update is due, None if nothing is pending """
+
+        if not self.journal:
+            return None
+
+        return max(0.0, min(entry.get("retry_at", 0) for entry in self.journal.values()) - time.time())
+
+    def flush(self) -> None:
+        """ send all pending updates which are due """
+
+        now = time.time()
+        changed = False
+
+        for episode_id, entry in list(self.journal.items()):
+            if entry.get("retry_at", 0) > now:
+                continue
+
+            if entry.get("updated", 0) < now - self.MAX_AGE:
+                utils.crunchy_log(self.args, "Dropping outdated playhead update for %s" % episode_id, xbmc.LOGWARNING)
+                del self.journal[episode_id]
+                changed = True
+                continue
+
+            changed = True
+            if self._send(episode_id, entry.get("playhead")):
+                # a newer update might have been queued meanwhile
+                if self.journal.get(episode_id) is entry:
+                    del self.journal[episode_id]
+                self.sent[episode_id] = entry.get("playhead")
+                continue
+
+            entry["attempts"] = entry.get("attempts", 0) + 1
+            entry["retry_at"] = now + min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** (entry["attempts"] - 1))
+
+            if entry.get("rejections", 0) >= self.MAX_REJECTIONS:
+                utils.crunchy_log(self.args, "Dropping rejected playhead update for %s" % episode_id, xbmc.LOGERROR)
+                del self.journal[episode_id]
+
+        self.last_send = now
+        if changed:
+            self._save_journal()
+
+    def _send(self, episode_id: str, playhead: int) -> bool:
+        try:
+            if not self.api:
+                self.api = self.service.create_api(self.args)
+                if not self.api:
+                    return False
+
+            r = self.api.send_request(
+                method="POST",
+                url=self.api.PLAYHEADS_ENDPOINT.format(self.api.account_data.account_id),
+                json={
+                    "playhead": playhead,
+                    "content_id": episode_id
+                },
+                headers={
+                    'Content-Type': 'application/json'
+                }
+            )
+        except RequestException:
+            # network is down, keep it for later
+            utils.crunchy_log(self.args, "Network error updating playhead of %s, will retry" % episode_id,
+                              xbmc.LOGWARNING)
+            return False
+        except Exception:
+            utils.log_error_with_trace(self.args, "Failed to update playhead of %s" % episode_id, False)
+            self._reject(episode_id)
+            return False
+
+        if r.ok:
+            return True
+
+        if r.status_code >= 500 or r.status_code == 429:
+            # crunchyroll is having trouble, keep it for later
+            utils.crunchy_log(self.args, "Server error %d updating playhead of %s, will retry" % (
+                r.status_code, episode_id), xbmc.LOGWARNING)
+        else:
+            utils.crunchy_log(self.args, "Playhead update of %s rejected with %d" % (episode_id, r.status_code),
+                              xbmc.LOGERROR)
+            self._reject(episode_id)
+
+        return False
+
+    def _reject(self, episode_id: str) -> None:
+        entry = self.journal.get(episode_id)
+        if entry:
+            entry["rejections"] = entry.get("rejections", 0) + 1
+
+    def _get_journal_file(self) -> str:
+        return xbmcvfs.translatePath(self.args.addon.getAddonInfo("profile") + "playheads_journal.json")
+
+    def _load_journal(self) -> Dict:
+        if not xbmcvfs.exists(self._get_journal_file()):
+            return {}
+
+        try:
+            with xbmcvfs.File(self._get_journal_file()) as file:
+                return json.load(file)
+        except ValueError:
+            utils.crunchy_log(self.args, "Playhead journal is corrupt, discarding it", xbmc.LOGERROR)
+            return {}
+
+    def _save_journal(self) -> None:
+        journal_file = self._get_journal_file()
+        xbmcvfs.mkdirs(os.path.dirname(journal_file))
+
+        utils.write_file(journal_file, json.dumps(self.journal))
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+# Crunchyroll
+# Copyright (C) 2018 MrKrabat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import requests
+import xbmc
+import xbmcvfs
+
+from . import utils
+from .api import API
+from .model import Args, EpisodeData, MediaData, MovieData
+from .upnext import UpNext
+from .videostream import VideoStream
+
+
+class SubtitlePrecacher:
+    """
+    Pre-download soft subtitles of episodes that are likely to be played next into the subtitle cache
+
+    Candidates are the items of the watchlist and the next unwatched episode of recently watched series. Downloads
+    are done with a limited number of threads, throttled to a maximum bandwidth and capped by a daily budget, which
+    is persisted in the profile directory. Both count every response of the run, stream lookups included, by its
+    Content-Length or, without one, its decoded size.
+    """
+
+    # number of recently watched series to look at
+    HISTORY_SERIES_LIMIT = 10
+
+    def __init__(self, args: Args, api: API, monitor: xbmc.Monitor):
+        self.args: Args = args
+        self.api: API = api
+        self.monitor: xbmc.Monitor = monitor
+        self.upnext: UpNext = UpNext(args, api)
+        self.concurrency: int = max(1, int(args.addon.getSetting("precache_concurrency") or 2))
+        # KiB/s, 0 = unlimited
+        self.bandwidth: int = int(args.addon.getSetting("precache_bandwidth") or 0) * 1024
+        # MiB per day
+        self.daily_budget: int = int(args.addon.getSetting("precache_daily_budget") or 0) * 1024 * 1024
+        self.lock = threading.Lock()
+        self.started: float = 0
+        self.downloaded: int = 0
+        self.budget: Dict = {}
+
+    def run(self) -> int:
+        """ pre-cache subtitles for all candidates, returns the number of downloaded subtitle files """
+
+        # the cache is only used for soft subtitles, hard subs are part of the stream
+        if self.args.addon.getSetting("soft_subtitles") != "true":
+            return 0
+
+        self.budget = self._load_budget()
+        if self._budget_exceeded():
+            utils.crunchy_log(self.args, "Subtitle pre-caching: daily budget exhausted", xbmc.LOGDEBUG)
+            return 0
+
+        self.started = time.time()
+        self.downloaded = 0
+        self.api.http.hooks["response"].append(self._on_response)
+
+        try:
+            stream_ids = self._get_candidate_stream_ids()
+            utils.crunchy_log(self.args, "Subtitle pre-caching: %d candidates" % len(stream_ids), xbmc.LOGDEBUG)
+
+            with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                results = list(pool.map(self._precache_stream, stream_ids))
+        finally:
+            self.api.http.hooks["response"].remove(self._on_response)
+            self._save_budget()
+
+        return sum(results)
+
+    def _precache_stream(self, stream_id: str) -> int:
+        """ download missing subtitles for a single stream """
+
+        if self.monitor.abortRequested() or self._budget_exceeded():
+            return 0
+
+        count = 0
+        try:
+            video_stream = VideoStream(self.args, self.api, stream_id)
+            api_stream_data = video_stream.get_stream_data_from_api()
+
+            for subtitle_data in video_stream.get_subtitle_descriptors(api_stream_data):
+                language = subtitle_data.get("locale", "")
+                subtitle_format = subtitle_data.get("format", "")
+                if not subtitle_data.get("url") or not language or not subtitle_format:
+                    continue
+
+                if video_stream.is_subtitle_cached(language, subtitle_format):
+                    continue
+
+                if self.monitor.abortRequested() or self._budget_exceeded():
+                    break
+
+                if video_stream.cache_subtitle(subtitle_data.get("url"), language, subtitle_format, False):
+                    count = count + 1
+        except Exception:
+            utils.log_error_with_trace(self.args, "Subtitle pre-caching failed for %s" % stream_id, False)
+
+        return count
+
+    def _on_response(self, response: requests.Response, *args, **kwargs) -> None:
+        """ response hook of the api session, runs before the caller gets the response """
+
+        size = response.headers.get("Content-Length")
+        self._account(int(size) if size and size.isdigit() else len(response.content))
+
+    def _account(self, size: int) -> None:
+        """ track downloaded bytes and throttle to the configured bandwidth """
+
+        with self.lock:
+            self.downloaded = self.downloaded + size
+            self.budget["bytes"] = self.budget.get("bytes", 0) + size
+            delay = 0
+            if self.bandwidth > 0:
+                delay = self.started + (self.downloaded / self.bandwidth) - time.time()
+
+        if delay > 0:
+            self.monitor.waitForAbort(delay)
+
+    def _get_candidate_stream_ids(self) -> List[str]:
+        """ collect stream ids from watchlist and the next episodes of recently watched series """
+
+        stream_ids = []
+
+        for stream_id in self._get_watchlist_stream_ids() + self._get_history_stream_ids():
+            if stream_id and stream_id not in stream_ids:
+                stream_ids.append(stream_id)
+
+        return stream_ids
+
+    def _get_watchlist_stream_ids(self) -> List[str]:
+        req = self.api.make_request(
+            method="GET",
+            url=self.api.WATCHLIST_LIST_ENDPOINT.format(self.api.account_data.account_id),
+            params={
+                "n": 1024,
+                "locale": self.args.subtitle
+            }
+        )
+
+        stream_ids = []
+        for item in (req or {}).get("items", []):
+            entry = self._parse_item(item)
+            if entry and not entry.playcount:
+                stream_ids.append(entry.stream_id)
+
+        return stream_ids
+
+    def _get_history_stream_ids(self) -> List[str]:
+        req = self.api.make_request(
+            method="GET",
+            url=self.api.HISTORY_ENDPOINT.format(self.api.account_data.account_id),
+            params={
+                "page_size": 50,
+                "page": 1,
+                "locale": self.args.subtitle,
+            }
+        )
+
+        stream_ids = []
+        seen_series = []
+        for item in (req or {}).get("data", []):
+            entry = self._parse_item(item)
+            if not entry or entry.series_id in seen_series:
+                continue
+
+            # history is ordered by date, so the first entry is the latest watched episode of a series
+            if entry.series_id:
+                seen_series.append(entry.series_id)
+
+            if not item.get("fully_watched") and not entry.playcount:
+                stream_ids.append(entry.stream_id)
+            elif entry.collection_id:
+                stream_ids.append(self._get_next_episode_stream_id(entry))
+
+            if len(seen_series) >= self.HISTORY_SERIES_LIMIT:
+                break
+
+        return stream_ids
+
+    def _get_next_episode_stream_id(self, entry: MediaData) -> Optional[str]:
+        """ find the episode following a history entry, in the next season if its season ended """
+
+        try:
+            episode = self.upnext.get_next_episode(entry.episode_id, entry.collection_id, entry.series_id)
+        except Exception:
+            utils.log_error_with_trace(self.args, "Subtitle pre-caching: failed to find next episode", False)
+            return None
+
+        if not episode:
+            return None
+
+        return utils.get_stream_id_from_url(episode.get("__links__", {}).get("streams", {}).get("href", ""))
+
+    def _parse_item(self, item: Dict):
+        try:
+            if item.get("panel", {}).get("type") == "episode":
+                return EpisodeData(item)
+            elif item.get("panel", {}).get("type") == "movie":
+                return MovieData(item)
+        except Exception:
+            utils.crunchy_log(self.args, "Subtitle pre-caching: skipping item", xbmc.LOGDEBUG)
+
+        return None
+
+    def _get_budget_file(self) -> str:
+        return xbmcvfs.translatePath(self.args.addon.getAddonInfo("profile") + "precache_budget.json")
+
+    def _load_budget(self) -> Dict:
+        today = time.strftime("%Y-%m-%d")
+        budget = {"date": today, "bytes": 0}
+
+        if xbmcvfs.exists(self._get_budget_file()):
+            try:
+                with xbmcvfs.File(self._get_budget_file()) as file:
+                    data = json.load(file)
+                if data.get("date") == today:
+                    budget.update(data)
+            except ValueError:
+                utils.crunchy_log(self.args, "Subtitle pre-caching: resetting invalid budget file", xbmc.LOGWARNING)
+
+        return budget
+
+    def _save_budget(self) -> None:
+        with xbmcvfs.File(self._get_budget_file(), 'w') as file:
+            file.write(json.dumps(self.budget))
+
+    def _budget_exceeded(self) -> bool:
+        return 0 < self.daily_budget <= self.budget.get("bytes", 0)
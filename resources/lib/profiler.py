@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+# Crunchyroll
+# Copyright (C) 2018 MrKrabat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Opt-in profiling of plugin invocations, to find slow paths on the hardware of users reporting them. Enabled by the
+# environment variable or the hidden setting "profiler", with one of the values in MODES: cprofile writes a .pstats
+# file, sampling a collapsed stack file for flame graph tools (flamegraph.pl, speedscope), both writes both.
+
+import cProfile
+import os
+import re
+import sys
+import threading
+import time
+import zipfile
+from collections import Counter
+from typing import Any, Callable, List, Optional
+
+import xbmc
+import xbmcaddon
+import xbmcvfs
+
+from . import utils
+
+ENV_VAR = "CRUNCHYROLL_PROFILE"
+MODES = ["cprofile", "sampling", "both"]
+
+# seconds between two samples of the sampling profiler
+SAMPLE_INTERVAL = 0.005
+# invocations kept, older profiles are deleted
+MAX_PROFILES = 20
+# invocations packaged for sharing
+PACKAGE_COUNT = 5
+
+PSTATS_SUFFIX = ".pstats"
+COLLAPSED_SUFFIX = ".collapsed"
+
+
+def get_mode(addon: xbmcaddon.Addon) -> Optional[str]:
+    """ the profiling mode, None if profiling is disabled """
+
+    mode = (os.environ.get(ENV_VAR) or addon.getSetting("profiler") or "").strip().lower()
+    if mode in ("1", "true", "yes"):
+        return "both"
+
+    return mode if mode in MODES else None
+
+
+def get_directory(addon: xbmcaddon.Addon) -> str:
+    return xbmcvfs.translatePath(addon.getAddonInfo("profile") + "profiles/")
+
+
+def run(addon: xbmcaddon.Addon, mode: str, tag: str, func: Callable, *args) -> Any:
+    """ call func with args while profiling it, the profiles are named after tag and the current time """
+
+    profile = cProfile.Profile() if mode in ("cprofile", "both") else None
+    sampler = StackSampler() if mode in ("sampling", "both") else None
+
+    started = time.time()
+    if sampler:
+        sampler.start()
+    if profile:
+        profile.enable()
+
+    try:
+        return func(*args)
+    finally:
+        if profile:
+            profile.disable()
+        if sampler:
+            sampler.stop()
+
+        try:
+            _write(addon, tag, started, profile, sampler)
+        except Exception as e:
+            utils.crunchy_log(None, "Failed to write profile: %s" % e, xbmc.LOGERROR)
+
+
+def package(addon: xbmcaddon.Addon) -> Optional[str]:
+    """ zip the profiles of the latest invocations, returns the path of the archive or None if there are none """
+
+    directory = get_directory(addon)
+    stems = _get_stems(directory)[-PACKAGE_COUNT:]
+    if not stems:
+        return None
+
+    archive = os.path.join(directory, "crunchyroll-profiles-%s.zip" % time.strftime("%Y%m%d-%H%M%S"))
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as file:
+        for stem in stems:
+            for suffix in [PSTATS_SUFFIX, COLLAPSED_SUFFIX]:
+                if os.path.exists(os.path.join(directory, stem + suffix)):
+                    file.write(os.path.join(directory, stem + suffix), stem + suffix)
+
+    # only the latest archive is kept
+    for name in os.listdir(directory):
+        if name.endswith(".zip") and os.path.join(directory, name) != archive:
+            os.remove(os.path.join(directory, name))
+
+    return archive
+
+
+class StackSampler(threading.Thread):
+    """ Sample the stacks of all other threads at a fixed interval and count them as collapsed stacks """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        super().__init__(name="crunchyroll-profiler", daemon=True)
+        self.interval: float = interval
+        self.stacks: Counter = Counter()
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self._sample()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.join()
+
+    def _sample(self) -> None:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == self.ident:
+                continue
+
+            stack = []
+            while frame is not None:
+                stack.append("%s:%s" % (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+                frame = frame.f_back
+
+            # threads of the same pool share their stacks
+            name = re.sub(r"_\d+$", "", names.get(ident, "thread"))
+            self.stacks[";".join([name] + stack[::-1])] += 1
+
+    def to_collapsed(self) -> str:
+        """ one line per stack, frames from the root separated by semicolons, then the number of samples """
+
+        return "".join("%s %d\n" % (stack, count) for stack, count in self.stacks.most_common())
+
+
+def _write(addon: xbmcaddon.Addon, tag: str, started: float, profile: Optional[cProfile.Profile],
+           sampler: Optional[StackSampler]) -> None:
+    directory = get_directory(addon)
+    xbmcvfs.mkdirs(directory)
+
+    stem = "%s_%03d_%s" % (
+        time.strftime("%Y%m%d-%H%M%S", time.localtime(started)),
+        int(started % 1 * 1000),
+        re.sub(r"[^\w-]", "", tag) or "main"
+    )
+
+    if profile:
+        profile.dump_stats(os.path.join(directory, stem + PSTATS_SUFFIX))
+    if sampler:
+        with open(os.path.join(directory, stem + COLLAPSED_SUFFIX), "w", encoding="utf-8") as file:
+            file.write(sampler.to_collapsed())
+
+    for old_stem in _get_stems(directory)[:-MAX_PROFILES]:
+        for suffix in [PSTATS_SUFFIX, COLLAPSED_SUFFIX]:
+            if os.path.exists(os.path.join(directory, old_stem + suffix)):
+                os.remove(os.path.join(directory, old_stem + suffix))
+
+    utils.crunchy_log(None, "Profiled %s in %.3fs, written to %s" % (
+        tag, time.time() - started, os.path.join(directory, stem)
+    ))
+
+
+def _get_stems(directory: str) -> List[str]:
+    """ the names of the recorded invocations without suffix, oldest first """
+
+    if not os.path.isdir(directory):
+        return []
+
+    return sorted({
+        os.path.splitext(name)[0] for name in os.listdir(directory)
+        if name.endswith(PSTATS_SUFFIX) or name.endswith(COLLAPSED_SUFFIX)
+    })
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+# Crunchyroll
+# Copyright (C) 2018 MrKrabat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Local HLS proxy prefetching segments ahead of the player. This module must not depend on kodi, so it can be used
+# and tested outside of it, e.g. against a static HLS fixture served by python's http.server.
+
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import hls
+
+try:
+    from urllib.parse import parse_qs, quote, urljoin, urlparse
+except ImportError:
+    from urlparse import parse_qs, urljoin, urlparse
+    from urllib import quote
+
+PLAYLIST_MIME_TYPE = "application/vnd.apple.mpegurl"
+
+
+class SegmentBuffer:
+    """
+    Thread safe in-memory buffer of segments, limited in size
+
+    When full, segments the player fetched already are evicted first, then the least recently used ones. Segments
+    currently being downloaded are tracked, so a request for one waits for the running download instead of starting
+    another one.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes: int = max_bytes
+        self.size: int = 0
+        self.lock = threading.Lock()
+        # url => (content type, data)
+        self.segments: "OrderedDict[str, Tuple[str, bytes]]" = OrderedDict()
+        # urls of buffered segments the player fetched already
+        self.served = set()
+        # url => event set when the download finished (or failed)
+        self.pending: Dict[str, threading.Event] = {}
+
+    def get(self, url: str) -> Optional[Tuple[str, bytes]]:
+        with self.lock:
+            segment = self.segments.get(url)
+            if segment:
+                self.segments.move_to_end(url)
+                self.served.add(url)
+
+            return segment
+
+    def put(self, url: str, content_type: str, data: bytes) -> None:
+        with self.lock:
+            if url in self.segments:
+                self._evict(url)
+
+            self.segments[url] = (content_type, data)
+            self.size = self.size + len(data)
+
+            while self.size > self.max_bytes and len(self.segments) > 1:
+                self._evict(next((key for key in self.segments if key in self.served), next(iter(self.segments))))
+
+    def _evict(self, url: str) -> None:
+        self.size = self.size - len(self.segments.pop(url)[1])
+        self.served.discard(url)
+
+    def contains(self, url: str) -> bool:
+        with self.lock:
+            return url in self.segments or url in self.pending
+
+    def start_download(self, url: str) -> bool:
+        """ mark url as being downloaded, False if it is buffered or downloaded by someone else already """
+
+        with self.lock:
+            if url in self.segments or url in self.pending:
+                return False
+
+            self.pending[url] = threading.Event()
+            return True
+
+    def finish_download(self, url: str) -> None:
+        with self.lock:
+            event = self.pending.pop(url, None)
+
+        if event:
+            event.set()
+
+    def wait_for_download(self, url: str, timeout: float) -> None:
+        with self.lock:
+            event = self.pending.get(url)
+
+        if event:
+            event.wait(timeout)
+
+    def get_metrics(self) -> Dict:
+        with self.lock:
+            return {
+                "buffer_bytes": self.size,
+                "buffer_capacity": self.max_bytes,
+                "buffer_fill": round(self.size / float(self.max_bytes), 3) if self.max_bytes else 0,
+                "buffered_segments": len(self.segments),
+                "pending_segments": len(self.pending)
+            }
+
+
+class HlsProxy:
+    """
+    HTTP proxy on localhost for HLS streams
+
+    Playlists requested through the proxy are rewritten, so all playlists and segments they reference are requested
+    through it as well. Whenever the player requests a segment, the following segments of the same media playlist
+    are downloaded in parallel into the SegmentBuffer, so short network hiccups are absorbed by the buffer instead of
+    stalling playback. Upstream connections are reused. Buffer statistics are available at /metrics.
+    """
+
+    # playlists we remember the segment order of, for prefetching
+    MAX_PLAYLISTS = 16
+    # seconds to wait for the cdn
+    TIMEOUT = 30
+
+    def __init__(
+            self,
+            prefetch: int = 3,
+            buffer_bytes: int = 64 * 1024 * 1024,
+            headers: Optional[Dict[str, str]] = None,
+            port: int = 0,
+            log: Optional[Callable[[str], None]] = None
+    ):
+        self.prefetch: int = max(1, prefetch)
+        self.buffer: SegmentBuffer = SegmentBuffer(buffer_bytes)
+        self.headers: Dict[str, str] = headers or {}
+        self.log: Callable[[str], None] = log or (lambda message: None)
+
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.prefetch + 4)
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
+
+        self.lock = threading.Lock()
+        # playlist url => segment urls in order
+        self.playlists: "OrderedDict[str, List[str]]" = OrderedDict()
+        # segment url => (playlist url, index)
+        self.positions: Dict[str, Tuple[str, int]] = {}
+        self.stats: Dict[str, int] = {"hits": 0, "misses": 0, "waits": 0, "prefetched": 0, "errors": 0}
+
+        self.executor = ThreadPoolExecutor(max_workers=self.prefetch)
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._create_handler())
+        self.server.daemon_threads = True
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def address(self) -> str:
+        return "http://127.0.0.1:%d" % self.server.server_address[1]
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.server.serve_forever, name="crunchyroll-hls-proxy")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self.executor.shutdown(wait=False)
+        self.http.close()
+
+    def get_metrics(self) -> Dict:
+        metrics = self.buffer.get_metrics()
+        with self.lock:
+            metrics.update(self.stats)
+            metrics["playlists"] = len(self.playlists)
+
+        return metrics
+
+    def get_playlist(self, url: str) -> str:
+        """ fetch a playlist and rewrite it to go through the proxy """
+
+        r = self.http.get(url, headers=self.headers, timeout=self.TIMEOUT)
+        r.raise_for_status()
+
+        master = hls.MasterPlaylist(r.text, r.url)
+        if master.is_master():
+            return master.build(lambda uri: get_proxy_url(self.address, uri))
+
+        return self._rewrite_media_playlist(r.text, r.url)
+
+    def get_segment(self, url: str) -> Tuple[str, bytes]:
+        """ get a segment, preferably from the buffer, and prefetch the ones following it """
+
+        segment = self.buffer.get(url)
+        if segment:
+            self._count("hits")
+        else:
+            if self.buffer.contains(url):
+                # a prefetch is running already, waiting for it is faster than starting over
+                self._count("waits")
+                self.buffer.wait_for_download(url, self.TIMEOUT)
+                segment = self.buffer.get(url)
+
+            if not segment:
+                self._count("misses")
+                segment = self._download(url)
+                self.buffer.put(url, *segment)
+
+        self._schedule_prefetch(url)
+
+        return segment
+
+    def _rewrite_media_playlist(self, content: str, url: str) -> str:
+        # byte ranges address several segments by the same url, which the buffer can't tell apart
+        if "#EXT-X-BYTERANGE" in content:
+            return "\n".join(
+                line if line.startswith("#") or not line.strip() else urljoin(url, line.strip())
+                for line in content.splitlines()
+            ) + "\n"
+
+        lines = []
+        segments = []
+        for line in content.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+
+            if line.startswith("#"):
+                # keys and init sections are small and requested once, but must not skip the proxy either
+                lines.append(hls.URI_ATTRIBUTE_PATTERN.sub(
+                    lambda m: 'URI="%s"' % get_proxy_url(self.address, urljoin(url, m.group(1)), "segment"),
+                    line
+                ))
+            else:
+                segment_url = urljoin(url, line)
+                segments.append(segment_url)
+                lines.append(get_proxy_url(self.address, segment_url, "segment"))
+
+        with self.lock:
+            for segment_url in self.playlists.pop(url, []):
+                self.positions.pop(segment_url, None)
+
+            self.playlists[url] = segments
+            for index, segment_url in enumerate(segments):
+                self.positions[segment_url] = (url, index)
+
+            while len(self.playlists) > self.MAX_PLAYLISTS:
+                for segment_url in self.playlists.popitem(last=False)[1]:
+                    self.positions.pop(segment_url, None)
+
+        return "\n".join(lines) + "\n"
+
+    def _schedule_prefetch(self, url: str) -> None:
+        with self.lock:
+            position = self.positions.get(url)
+            if not position:
+                return
+
+            playlist_url, index = position
+            following = self.playlists.get(playlist_url, [])[index + 1:index + 1 + self.prefetch]
+
+        for segment_url in following:
+            if self.buffer.start_download(segment_url):
+                self.executor.submit(self._prefetch, segment_url)
+
+    def _prefetch(self, url: str) -> None:
+        try:
+            self.buffer.put(url, *self._download(url))
+            self._count("prefetched")
+        except Exception as e:
+            self._count("errors")
+            self.log("Prefetching %s failed: %s" % (url, e))
+        finally:
+            self.buffer.finish_download(url)
+
+    def _download(self, url: str) -> Tuple[str, bytes]:
+        r = self.http.get(url, headers=self.headers, timeout=self.TIMEOUT)
+        r.raise_for_status()
+
+        return r.headers.get("Content-Type", "application/octet-stream"), r.content
+
+    def _count(self, stat: str) -> None:
+        with self.lock:
+            self.stats[stat] = self.stats[stat] + 1
+
+    def _create_handler(self):
+        proxy = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self) -> None:
+                request = urlparse(self.path)
+                url = parse_qs(request.query).get("url", [None])[0]
+
+                try:
+                    if request.path == "/metrics":
+                        self._respond("application/json", json.dumps(proxy.get_metrics()).encode("utf-8"))
+                    elif request.path == "/playlist" and url:
+                        self._respond(PLAYLIST_MIME_TYPE, proxy.get_playlist(url).encode("utf-8"))
+                    elif request.path == "/segment" and url:
+                        self._respond(*proxy.get_segment(url))
+                    else:
+                        self.send_error(404)
+                except requests.RequestException as e:
+                    proxy._count("errors")
+                    proxy.log("Upstream request for %s failed: %s" % (url, e))
+                    self.send_error(502)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the player went away, e.g. after seeking
+                    pass
+
+            def _respond(self, content_type: str, data: bytes) -> None:
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format: str, *args) -> None:
+                # requests are far too frequent for the log
+                pass
+
+        return Handler
+
+
+def get_proxy_url(address: str, url: str, kind: str = "playlist") -> str:
+    """ url of a playlist or segment through the proxy at address """
+
+    return "%s/%s?url=%s" % (address, kind, quote(url, safe=""))
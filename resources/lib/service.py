@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+# Crunchyroll
+# Copyright (C) 2018 MrKrabat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import threading
+import time
+from typing import Callable, List, Optional
+
+import xbmc
+import xbmcgui
+import xbmcvfs
+
+from . import artwork
+from . import cache
+from . import library
+from . import listwarmer
+from . import utils
+from . import widgets
+from .api import API
+from .crunchyroll import setup_args
+from .model import Args
+from .nextup import NextUp
+from .playback import PlaybackMonitor
+from .precache import SubtitlePrecacher
+from .proxy import HlsProxy
+from .videostream import PROXY_ADDRESS_PROPERTY
+
+# seconds between two checks for due jobs
+SERVICE_TICK = 60
+# jobs marked to run on wake are not run again if they ran less than this many seconds ago
+WAKE_MIN_AGE = 5 * 60
+# seconds to wait for running jobs when kodi shuts down, they check for the abort themselves
+SHUTDOWN_TIMEOUT = 5
+
+
+class Job:
+    """ A task of the background service that runs every interval seconds """
+
+    def __init__(
+            self,
+            name: str,
+            interval: int,
+            setting: Optional[str],
+            task: Callable[["Service"], None],
+            interval_setting: Optional[str] = None,
+            run_on_wake: bool = False
+    ):
+        self.name: str = name
+        self.interval: int = interval
+        # id of the bool setting enabling the job, None if it always runs
+        self.setting: Optional[str] = setting
+        self.task: Callable[["Service"], None] = task
+        # id of a number setting overriding the interval in minutes
+        self.interval_setting: Optional[str] = interval_setting
+        # run the job as soon as kodi wakes up from sleep or the screensaver
+        self.run_on_wake: bool = run_on_wake
+        self.last_run: float = 0
+        # jobs started on request run in their own thread, they must not overlap with the scheduled run
+        self.lock = threading.Lock()
+
+    def is_due(self) -> bool:
+        return time.time() - self.last_run >= self.interval
+
+
+class ServiceMonitor(xbmc.Monitor):
+    """ Forward notifications of the plugin to the service """
+
+    def __init__(self, service: "Service"):
+        super().__init__()
+        self.service: "Service" = service
+
+    def onNotification(self, sender: str, method: str, data: str) -> None:
+        if sender == utils.ADDON_ID and method.endswith("." + artwork.ARTWORK_MESSAGE):
+            self.service.warm_artwork()
+        elif sender == utils.ADDON_ID and method.endswith("." + widgets.REFRESH_MESSAGE):
+            self.service.run_job_now("widget refresh")
+        elif sender == utils.ADDON_ID and method.endswith("." + library.EXPORT_MESSAGE):
+            self.service.run_job_now("library export")
+        elif method == "System.OnWake":
+            self.service.on_wake()
+
+    def onScreensaverDeactivated(self) -> None:
+        self.service.on_wake()
+
+
+class Service:
+    """ Background service of the addon, running scheduled jobs while kodi is running """
+
+    def __init__(self):
+        self.monitor = ServiceMonitor(self)
+        self.player = PlaybackMonitor(self)
+        self.artwork_warmer: Optional[artwork.ArtworkWarmer] = None
+        self.proxy: Optional[HlsProxy] = None
+        # settings the running proxy was created with
+        self.proxy_config: Optional[tuple] = None
+        # thread running the due jobs one after another
+        self.worker: Optional[threading.Thread] = None
+        self.jobs: List[Job] = [
+            Job("subtitle pre-caching", 6 * 60 * 60, "precache_subtitles", precache_subtitles),
+            Job("cache cleanup", 24 * 60 * 60, None, clean_caches),
+            Job("list warming", 30 * 60, "warm_lists", warm_lists, "warm_lists_interval", True),
+            Job("widget refresh", widgets.MAX_AGE, None, refresh_widgets, None, True),
+            Job("library export", 12 * 60 * 60, "library_export", export_library),
+        ]
+
+    def run(self) -> None:
+        utils.crunchy_log(None, "Service started", xbmc.LOGDEBUG)
+
+        while not self.monitor.abortRequested():
+            self.update_proxy()
+            self.player.tick()
+            self.run_due_jobs()
+
+            # player events arrive while waiting, we only need to wake up regularly while something is monitored
+            if self.monitor.waitForAbort(self.player.get_tick_interval() or SERVICE_TICK):
+                break
+
+        if self.worker:
+            self.worker.join(SHUTDOWN_TIMEOUT)
+        self.stop_proxy()
+        if self.artwork_warmer:
+            self.artwork_warmer.stop()
+        utils.crunchy_log(None, "Service stopped", xbmc.LOGDEBUG)
+
+    def warm_artwork(self) -> None:
+        """ warm the texture cache with the artwork of the listing the plugin just published """
+
+        args = self.create_args()
+        listing = artwork.get_published()
+        if not listing or args.addon.getSetting("artwork_warmer") != "true":
+            return
+
+        budget = max(1, int(args.addon.getSetting("artwork_warmer_budget") or 32)) * 1024 * 1024
+        if not self.artwork_warmer or self.artwork_warmer.budget_bytes != budget:
+            if self.artwork_warmer:
+                self.artwork_warmer.stop()
+            self.artwork_warmer = artwork.ArtworkWarmer(
+                budget,
+                log=lambda message: utils.crunchy_log(args, message, xbmc.LOGDEBUG)
+            )
+
+        count = self.artwork_warmer.warm(listing)
+        utils.crunchy_log(args, "Artwork warmer: %d images queued for %s" % (count, listing.get("path")),
+                          xbmc.LOGDEBUG)
+
+    def update_proxy(self) -> None:
+        """ start, restart or stop the hls proxy according to the settings """
+
+        args = self.create_args()
+        config = None
+        if args.addon.getSetting("hls_proxy") == "true":
+            config = (
+                int(args.addon.getSetting("hls_proxy_prefetch") or 3),
+                max(8, int(args.addon.getSetting("hls_proxy_buffer") or 64))
+            )
+
+        # don't pull the rug out from under a running stream
+        if config == self.proxy_config or (self.proxy and xbmc.Player().isPlayingVideo()):
+            return
+
+        self.stop_proxy()
+        if not config:
+            return
+
+        try:
+            self.proxy = HlsProxy(
+                prefetch=config[0],
+                buffer_bytes=config[1] * 1024 * 1024,
+                headers={"User-Agent": utils.headers().get("User-Agent")},
+                log=lambda message: utils.crunchy_log(args, message, xbmc.LOGDEBUG)
+            )
+            self.proxy.start()
+        except OSError:
+            utils.log_error_with_trace(args, "Failed to start hls proxy", False)
+            self.proxy = None
+            return
+
+        self.proxy_config = config
+        xbmcgui.Window(10000).setProperty(PROXY_ADDRESS_PROPERTY, self.proxy.address)
+        utils.crunchy_log(args, "HLS proxy listening on %s" % self.proxy.address, xbmc.LOGDEBUG)
+
+    def stop_proxy(self) -> None:
+        xbmcgui.Window(10000).clearProperty(PROXY_ADDRESS_PROPERTY)
+        self.proxy_config = None
+
+        if self.proxy:
+            self.proxy.stop()
+            self.proxy = None
+
+    def on_wake(self) -> None:
+        """ lists are likely outdated after kodi slept, run the jobs doing the refresh soon """
+
+        for job in self.jobs:
+            if job.run_on_wake and time.time() - job.last_run >= WAKE_MIN_AGE:
+                self.request_job(job.name)
+
+    def request_job(self, name: str) -> None:
+        """ run a job with the next check for due jobs, regardless of its interval """
+
+        for job in self.jobs:
+            if job.name == name:
+                job.last_run = 0
+
+    def run_due_jobs(self) -> None:
+        """ run the due jobs in the background, so the player is still monitored while they run """
+
+        # don't compete with the stream for bandwidth
+        if xbmc.Player().isPlayingVideo():
+            return
+
+        # jobs still running from the last check are not started again, the next check picks up what got due
+        if self.worker and self.worker.is_alive():
+            return
+
+        self.worker = threading.Thread(target=self.run_jobs, name="crunchyroll-jobs")
+        self.worker.daemon = True
+        self.worker.start()
+
+    def run_jobs(self) -> None:
+        """ run the due jobs one after another, until kodi exits or playback starts """
+
+        for job in self.jobs:
+            if self.monitor.abortRequested() or xbmc.Player().isPlayingVideo():
+                return
+
+            args = self.create_args()
+            if job.interval_setting:
+                job.interval = max(1, int(args.addon.getSetting(job.interval_setting) or 0)) * 60
+
+            if not job.is_due():
+                continue
+
+            if job.setting and args.addon.getSetting(job.setting) != "true":
+                continue
+
+            self.run_job(job, args)
+
+    def run_job_now(self, name: str) -> None:
+        """ run a job right away in the background, e.g. when the plugin asks for it """
+
+        job = next((job for job in self.jobs if job.name == name), None)
+        if not job or xbmc.Player().isPlayingVideo():
+            return
+
+        thread = threading.Thread(target=self.run_job, args=(job, self.create_args()), name="crunchyroll-" + name)
+        thread.daemon = True
+        thread.start()
+
+    def run_job(self, job: Job, args: Args) -> None:
+        # a run of the job in progress covers the request as well
+        if not job.lock.acquire(blocking=False):
+            return
+
+        job.last_run = time.time()
+        try:
+            job.task(self)
+        except Exception:
+            utils.log_error_with_trace(args, "Service job '%s' failed" % job.name, False)
+        finally:
+            job.lock.release()
+
+    @staticmethod
+    def create_args() -> Args:
+        """ create a fresh args object, so changed settings are picked up """
+
+        args = utils.parse(["plugin://plugin.video.crunchyroll/", "-1", ""])
+        setup_args(args)
+
+        return args
+
+    def create_api(self, args: Args) -> Optional[API]:
+        """ create an api object with a valid session, None if the user is not logged in """
+
+        if not args.addon.getSetting("crunchyroll_username") or not args.addon.getSetting("crunchyroll_password"):
+            return None
+
+        api = API(
+            args=args,
+            locale=args.subtitle
+        )
+
+        # always restore the session from storage, the plugin might have refreshed it meanwhile
+        if not api.start():
+            return None
+
+        return api
+
+
+def precache_subtitles(service: Service) -> None:
+    args = service.create_args()
+    api = service.create_api(args)
+    if not api:
+        return
+
+    count = SubtitlePrecacher(args, api, service.monitor).run()
+    utils.crunchy_log(args, "Subtitle pre-caching: downloaded %d files" % count, xbmc.LOGDEBUG)
+
+
+def warm_lists(service: Service) -> None:
+    args = service.create_args()
+    api = service.create_api(args)
+    if not api:
+        return
+
+    job = next(job for job in service.jobs if job.task is warm_lists)
+    changed = listwarmer.ListWarmer(args, api, service.monitor, job.interval).run()
+    utils.crunchy_log(args, "List warming: changed %s" % (", ".join(changed) or "nothing"), xbmc.LOGDEBUG)
+
+    # continue watching follows the history
+    if listwarmer.HISTORY in changed or listwarmer.load(args, listwarmer.NEXT_UP) is None:
+        if not xbmc.Player().isPlayingVideo():
+            NextUp(args, api).refresh()
+
+    # the widgets are built from the warm lists
+    if changed:
+        service.request_job("widget refresh")
+
+
+def refresh_widgets(service: Service) -> None:
+    args = service.create_args()
+    api = service.create_api(args)
+    if not api:
+        return
+
+    failed = widgets.WidgetSnapshots(args, api).refresh()
+    if failed:
+        utils.crunchy_log(args, "Widgets: failed to refresh %s" % ", ".join(failed), xbmc.LOGDEBUG)
+
+
+def export_library(service: Service) -> None:
+    args = service.create_args()
+    api = service.create_api(args)
+    if not api:
+        return
+
+    started = time.time()
+    stats = library.LibraryExporter(args, api, service.monitor).run()
+    utils.crunchy_log(
+        args,
+        "Library export: %d written, %d removed, %d unchanged in %.1fs" % (
+            stats["written"], stats["removed"], stats["unchanged"], time.time() - started
+        ),
+        xbmc.LOGDEBUG
+    )
+
+
+def clean_caches(service: Service) -> None:
+    args = service.create_args()
+
+    removed = 0
+    for namespace in ["streams", "episodes", "seasons", "search", listwarmer.NAMESPACE, widgets.NAMESPACE]:
+        removed = removed + cache.clean(args, namespace)
+
+    # pre-resolved playlists are only needed to start playback
+    manifest_path = xbmcvfs.translatePath(args.addon.getAddonInfo("profile") + "cache_manifests/")
+    dirs, files = xbmcvfs.listdir(manifest_path)
+    for manifest_file in files:
+        if os.path.getmtime(manifest_path + manifest_file) < time.time() - 24 * 60 * 60:
+            xbmcvfs.delete(manifest_path + manifest_file)
+            removed = removed + 1
+    utils.crunchy_log(args, "Cache cleanup: removed %d expired entries" % removed, xbmc.LOGDEBUG)
+
+
+def run() -> None:
+    Service().run()
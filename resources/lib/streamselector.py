@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+# Crunchyroll
+# Copyright (C) 2018 MrKrabat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+from typing import Dict, List, Optional
+
+import xbmc
+import xbmcvfs
+
+from . import utils
+from .model import Args
+
+
+class StreamSelector:
+    """
+    Decide which of the stream types offered by the api to play
+
+    Startup times (from resolving the url until kodi has media) differ a lot between stream types and devices. Every
+    playback records the measured startup time or a failure per stream type in the profile directory. In automatic
+    mode the stream types are then ordered by their average startup time, penalized by their failure rate. Each type
+    is tried a few times first, so there is data to decide on.
+    """
+
+    # stream types without drm and their manifest type for inputstream adaptive
+    MANIFEST_TYPES = {
+        "multitrack_adaptive_hls_v2": "hls",
+        "adaptive_hls": "hls",
+        "adaptive_dash": "mpd",
+    }
+
+    # hard subs are only available as locale specific variant of these
+    HARDSUB_STREAM_TYPES = ["adaptive_hls", "adaptive_dash"]
+    # soft subs are downloaded separately, so every stream without burned in subs works
+    SOFTSUB_STREAM_TYPES = ["multitrack_adaptive_hls_v2", "adaptive_hls", "adaptive_dash"]
+
+    # number of measurements of a stream type before it competes on its average
+    MIN_SAMPLES = 3
+    # weight of a new measurement in the moving average
+    SMOOTHING = 0.3
+    # a stream type failing every time counts as this many times slower
+    FAILURE_PENALTY = 5
+
+    # stream_type setting values
+    MODE_AUTO = "0"
+    MODE_HLS = "1"
+    MODE_DASH = "2"
+
+    def __init__(self, args: Args):
+        self.args: Args = args
+        self.stats: Dict = self._load_stats()
+
+    def get_stream_types(self, soft_subtitles: bool, available: Optional[List[str]] = None) -> List[str]:
+        """ get stream types in order of preference, later ones are the fallback if a type is missing
+
+        available limits the result to the stream types the api offers for a stream
+        """
+
+        stream_types = [
+            stream_type for stream_type in (self.SOFTSUB_STREAM_TYPES if soft_subtitles else self.HARDSUB_STREAM_TYPES)
+            if available is None or stream_type in available
+        ]
+        mode = self.args.addon.getSetting("stream_type") or self.MODE_AUTO
+
+        if mode == self.MODE_HLS:
+            return self._prefer(stream_types, "hls")
+        elif mode == self.MODE_DASH:
+            return self._prefer(stream_types, "mpd")
+
+        # gather data for stream types we know too little about first
+        unmeasured = [stream_type for stream_type in stream_types if self._samples(stream_type) < self.MIN_SAMPLES]
+        if unmeasured:
+            first = min(unmeasured, key=self._samples)
+            stream_types.remove(first)
+            return [first] + stream_types
+
+        return sorted(stream_types, key=self._score)
+
+    @classmethod
+    def get_manifest_type(cls, stream_type: str) -> str:
+        return cls.MANIFEST_TYPES.get(stream_type, "hls")
+
+    def record_startup(self, stream_type: str, startup_time: Optional[float]) -> None:
+        """ record the startup time in seconds of a playback, None if playback did not start """
+
+        stats = self.stats.setdefault(stream_type, {"samples": 0, "failures": 0, "average": None})
+        stats["samples"] = stats["samples"] + 1
+
+        if startup_time is None:
+            stats["failures"] = stats["failures"] + 1
+        elif stats["average"] is None:
+            stats["average"] = startup_time
+        else:
+            stats["average"] = (1 - self.SMOOTHING) * stats["average"] + self.SMOOTHING * startup_time
+
+        utils.crunchy_log(
+            self.args,
+            "Stream type %s started in %s, stats: %s" % (stream_type, startup_time, json.dumps(stats)),
+            xbmc.LOGDEBUG
+        )
+
+        self._save_stats()
+
+    def _prefer(self, stream_types: List[str], manifest_type: str) -> List[str]:
+        return sorted(stream_types, key=lambda stream_type: self.get_manifest_type(stream_type) != manifest_type)
+
+    def _samples(self, stream_type: str) -> int:
+        return self.stats.get(stream_type, {}).get("samples", 0)
+
+    def _score(self, stream_type: str) -> float:
+        stats = self.stats.get(stream_type, {})
+        if stats.get("average") is None:
+            return float("inf")
+
+        failure_rate = stats.get("failures", 0) / float(max(1, stats.get("samples", 0)))
+
+        return stats.get("average") * (1 + (self.FAILURE_PENALTY - 1) * failure_rate)
+
+    def _get_stats_file(self) -> str:
+        return xbmcvfs.translatePath(self.args.addon.getAddonInfo("profile") + "stream_stats.json")
+
+    def _load_stats(self) -> Dict:
+        if not xbmcvfs.exists(self._get_stats_file()):
+            return {}
+
+        try:
+            with xbmcvfs.File(self._get_stats_file()) as file:
+                return json.load(file)
+        except ValueError:
+            return {}
+
+    def _save_stats(self) -> None:
+        with xbmcvfs.File(self._get_stats_file(), 'w') as file:
+            file.write(json.dumps(self.stats))
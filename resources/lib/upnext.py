@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# Crunchyroll
+# Copyright (C) 2018 MrKrabat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from typing import Dict, List, Optional
+
+from . import cache
+from . import utils
+from .api import API
+from .model import Args, CrunchyrollError
+
+
+class UpNext:
+    """
+    Find the episode following another one
+
+    Knows the episode order of seasons from EPISODES_ENDPOINT and the season order of a series from
+    SEASONS_ENDPOINT. When a season ends, it continues with the next season in the same audio language, that passes
+    the same subtitle/dub filter as the series view. Episode lists are cached per season. A failed request raises
+    CrunchyrollError instead of passing for an empty list, so callers can tell the two apart.
+    """
+
+    # seconds episode and season lists are cached
+    CACHE_TTL = 60 * 60
+
+    def __init__(self, args: Args, api: API):
+        self.args: Args = args
+        self.api: API = api
+
+    def get_next_episode(self, episode_id: str, season_id: str, series_id: Optional[str] = None) -> Optional[Dict]:
+        """ get the api data of the episode after episode_id, None if there is none """
+
+        episodes = self.get_season_episodes(season_id)
+        for index, episode in enumerate(episodes):
+            if episode.get("id") != episode_id:
+                continue
+
+            if index + 1 < len(episodes):
+                return episodes[index + 1]
+            break
+        else:
+            # unknown episode, don't guess
+            return None
+
+        if not series_id:
+            return None
+
+        next_season = self.get_next_season(series_id, season_id)
+        if not next_season:
+            return None
+
+        next_episodes = self.get_season_episodes(next_season.get("id"))
+
+        return next_episodes[0] if next_episodes else None
+
+    def get_season_episodes(self, season_id: str) -> List[Dict]:
+        """ get all playable episodes of a season in order """
+
+        episodes = self.get_cached_season_episodes(season_id)
+        if episodes is not None:
+            return episodes
+
+        req = self.api.make_request(
+            method="GET",
+            url=self.api.EPISODES_ENDPOINT.format(self.api.account_data.cms.bucket),
+            params={
+                "locale": self.args.subtitle,
+                "season_id": season_id
+            }
+        )
+
+        if not req or "error" in req:
+            raise CrunchyrollError("Failed to load episodes of season %s" % season_id)
+
+        episodes = [
+            episode for episode in req.get("items", [])
+            if utils.get_stream_id_from_url(episode.get("__links__", {}).get("streams", {}).get("href", ""))
+        ]
+        episodes.sort(key=lambda episode: episode.get("sequence_number") or 0)
+
+        cache.store(
+            self.args, "episodes", "%s_%s" % (season_id, self.args.subtitle), episodes, time.time() + self.CACHE_TTL
+        )
+
+        return episodes
+
+    def get_cached_season_episodes(self, season_id: str) -> Optional[List[Dict]]:
+        """ get the episodes of a season only if they are cached, None otherwise """
+
+        return cache.load(self.args, "episodes", "%s_%s" % (season_id, self.args.subtitle))
+
+    def get_seasons(self, series_id: str) -> List[Dict]:
+        """ get all seasons of a series passing the language filter in order """
+
+        cache_key = "%s_%s" % (series_id, self.args.subtitle)
+        seasons = cache.load(self.args, "seasons", cache_key)
+        if seasons is not None:
+            return seasons
+
+        req = self.api.make_request(
+            method="GET",
+            url=self.api.SEASONS_ENDPOINT.format(self.api.account_data.cms.bucket),
+            params={
+                "locale": self.args.subtitle,
+                "series_id": series_id,
+                "preferred_audio_language": self.api.account_data.default_audio_language,
+                "force_locale": ""
+            }
+        )
+
+        if not req or "error" in req:
+            raise CrunchyrollError("Failed to load seasons of series %s" % series_id)
+
+        seasons = [season for season in req.get("items", []) if utils.filter_series(self.args, season)]
+        seasons.sort(key=lambda season: (season.get("season_sequence_number") or season.get("season_number") or 0))
+
+        cache.store(self.args, "seasons", cache_key, seasons, time.time() + self.CACHE_TTL)
+
+        return seasons
+
+    def get_next_season(self, series_id: str, season_id: str) -> Optional[Dict]:
+        """ get the season after season_id with the same audio language """
+
+        seasons = self.get_seasons(series_id)
+        current = next((season for season in seasons if season.get("id") == season_id), None)
+        if not current:
+            return None
+
+        following = seasons[seasons.index(current) + 1:]
+
+        return next(
+            (season for season in following if season.get("audio_locale") == current.get("audio_locale")),
+            None
+        )
+
+    @staticmethod
+    def get_episode_title(episode: Dict) -> str:
+        """ build the title as used in the episodes view """
+
+        return "%s #%s - %s" % (episode.get("series_title"), episode.get("episode_number"), episode.get("title"))
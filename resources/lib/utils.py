@@ -15,19 +15,24 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import base64
+import json
+import os
 import re
+import tempfile
 from json import dumps
 
 import requests
 import xbmc
+import xbmcaddon
 import xbmcgui
 from requests import Response
 
 try:
-    from urlparse import parse_qs
+    from urlparse import parse_qs, urlparse
     from urllib import unquote_plus
 except ImportError:
-    from urllib.parse import parse_qs, unquote_plus
+    from urllib.parse import parse_qs, unquote_plus, urlparse
 
 from datetime import datetime
 import time
@@ -35,6 +40,10 @@ from typing import Dict, Optional, Union
 
 from .model import Args, LoginError, CrunchyrollError
 
+ADDON_ID = "plugin.video.crunchyroll"
+# suffix of the temporary files write_file creates next to their target
+TMP_SUFFIX = ".tmp"
+
 
 def parse(argv) -> Args:
     """Decode arguments
@@ -75,6 +84,28 @@ def str_to_date(string: str) -> datetime:
     return res
 
 
+def write_file(path: str, data: Union[str, bytes]) -> None:
+    """ replace the file at path with data in one step
+
+    plugin, service and its job threads write the same files, so every writer fills a temporary file of its own next
+    to the target before moving it into place. readers see the old or the new content, never a partial one.
+    """
+
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + ".", suffix=TMP_SUFFIX)
+    try:
+        if isinstance(data, bytes):
+            with os.fdopen(fd, "wb") as file:
+                file.write(data)
+        else:
+            with os.fdopen(fd, "w", encoding="utf-8") as file:
+                file.write(data)
+        os.replace(tmp_file, path)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
 def get_json_from_response(r: Response) -> Optional[Dict]:
     code: int = r.status_code
     response_type: str = r.headers.get("Content-Type")
@@ -121,29 +152,117 @@ def get_stream_id_from_url(url: str) -> Union[str, None]:
     return stream_id[1]
 
 
-def get_watched_status_from_playheads_data(playheads_data, episode_id) -> int:
-    if playheads_data and playheads_data["data"]:
-        for info in playheads_data["data"]:
-            if info["content_id"] == episode_id:
-                return 1 if (info["fully_watched"] is True) else 0
+def get_url_expiration(url: str) -> Optional[int]:
+    """ get the expiration timestamp of a signed cdn url, None if the url carries no expiration
+
+    supports cloudfront canned (Expires) and custom (Policy) signatures as well as akamai tokens (exp=...)
+    """
+    if not url:
+        return None
+
+    expirations = []
+    for key, values in parse_qs(urlparse(url).query).items():
+        for value in values:
+            if key.lower() == "expires" and value.isdigit():
+                expirations.append(int(value))
+            elif key == "Policy":
+                try:
+                    policy = json.loads(base64.b64decode(
+                        value.replace("-", "+").replace("_", "=").replace("~", "/")
+                    ))
+                    for statement in policy.get("Statement", []):
+                        epoch = statement.get("Condition", {}).get("DateLessThan", {}).get("AWS:EpochTime")
+                        if epoch:
+                            expirations.append(int(epoch))
+                except (ValueError, TypeError, AttributeError):
+                    pass
+            else:
+                expiration = re.search(r"(?:^|~)exp=(\d+)", value)
+                if expiration:
+                    expirations.append(int(expiration[1]))
+
+    return min(expirations) if expirations else None
+
+
+def is_watched(playhead: Optional[int], duration: int) -> bool:
+    """ whether a playhead counts as watched, for items crunchyroll didn't tell """
+
+    return bool(playhead and duration and int(playhead / duration * 100) > 90)
+
+
+# size an image is shown at, as fraction of the screen width and height. 0 = not limited in that direction.
+IMAGE_TARGET_SIZES = {
+    "poster_tall": (0, 0.45),
+    "poster_wide": (1.0, 0),
+    "thumbnail": (0.3, 0),
+    "background": (1.0, 0),
+}
+# image_quality setting index to factor of the target size, None = always the largest variant
+IMAGE_QUALITY_FACTORS = [1.0, 1.5, 0.5, None]
 
-    return 0
+# screen size and quality factor, looked up once per process
+_image_scale: Dict = {}
 
 
 def get_image_from_struct(item: Dict, image_type: str, depth: int = 2) -> Union[str, None]:
+    """ get the url of the smallest variant of an image that still fills its place on screen
+
+    variants without dimensions and image types without known target size fall back to the largest variant.
+    """
+
     if item.get("images") and item.get("images").get(image_type):
         src = item.get("images").get(image_type)
-        for i in range(0, depth):
+        for i in range(0, depth - 1):
             if src[-1]:
                 src = src[-1]
             else:
                 return None
-        if src.get('source'):
-            return src.get('source')
+
+        variant = _select_image_variant(src, image_type) if src else None
+        if variant and variant.get('source'):
+            return variant.get('source')
 
     return None
 
 
+def _select_image_variant(variants: list, image_type: str) -> Dict:
+    target = IMAGE_TARGET_SIZES.get(image_type)
+    if not _image_scale:
+        _image_scale.update(_get_image_scale())
+
+    if not target or _image_scale["factor"] is None:
+        return variants[-1]
+
+    min_width = target[0] * _image_scale["width"] * _image_scale["factor"]
+    min_height = target[1] * _image_scale["height"] * _image_scale["factor"]
+
+    candidates = [
+        variant for variant in variants
+        if variant.get("width") and variant.get("height")
+        and variant.get("width") >= min_width and variant.get("height") >= min_height
+    ]
+    if not candidates:
+        return variants[-1]
+
+    return min(candidates, key=lambda variant: variant.get("width") * variant.get("height"))
+
+
+def _get_image_scale() -> Dict:
+    try:
+        quality = int(xbmcaddon.Addon().getSetting("image_quality") or 0)
+    except (RuntimeError, ValueError):
+        quality = 0
+
+    width = xbmc.getInfoLabel("System.ScreenWidth")
+    height = xbmc.getInfoLabel("System.ScreenHeight")
+
+    return {
+        "width": int(width) if width.isdigit() else 1920,
+        "height": int(height) if height.isdigit() else 1080,
+        "factor": IMAGE_QUALITY_FACTORS[quality] if 0 <= quality < len(IMAGE_QUALITY_FACTORS) else 1.0
+    }
+
+
 def dump(data) -> None:
     xbmc.log(dumps(data, indent=4), xbmc.LOGINFO)
 
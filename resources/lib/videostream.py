@@ -17,23 +17,35 @@
 
 import datetime
 import os
+import time
 from typing import Union, Dict, Optional
 
 import xbmc
 import xbmcgui
-import xbmcplugin
 import xbmcvfs
 
+from resources.lib import cache
+from resources.lib import hls
+from resources.lib import proxy
 from resources.lib.api import API
 from resources.lib.model import Object, Args, CrunchyrollError
-from resources.lib.utils import log_error_with_trace, convert_language_iso_to_string, crunchy_log
+from resources.lib.streamselector import StreamSelector
+from resources.lib.utils import log_error_with_trace, convert_language_iso_to_string, crunchy_log, \
+    get_url_expiration, headers
+
+
+# window property holding the address of the hls proxy run by the service
+PROXY_ADDRESS_PROPERTY = "crunchyroll.proxy_address"
 
 
 class VideoPlayerStreamData(Object):
     """ DTO to hold all relevant data for playback """
 
     def __init__(self):
+        self.stream_id: str | None = None
         self.stream_url: str | None = None
+        self.stream_type: str | None = None
+        self.manifest_type: str = "hls"
         self.subtitle_urls: list[str] | None = None
 
 
@@ -49,9 +61,20 @@ class VideoStream(Object):
     instead of a proper label
     """
 
-    def __init__(self, args: Args, api: API):
+    # stream types kept in the stream data cache
+    CACHED_STREAM_TYPES = list(StreamSelector.MANIFEST_TYPES.keys())
+    # seconds a cache entry has to expire before its urls do, so playback can still start with them
+    STREAM_CACHE_MARGIN = 5 * 60
+    # lifetime of cache entries whose urls carry no expiration
+    STREAM_CACHE_DEFAULT_TTL = 5 * 60
+    # max resolution setting index to max height
+    MAX_RESOLUTIONS = [0, 1080, 720, 480, 360]
+
+    def __init__(self, args: Args, api: API, stream_id: Optional[str] = None):
         self.api: API = api
         self.args: Args = args
+        # allows resolving streams other than the one in args, e.g. for background jobs
+        self.stream_id: Optional[str] = stream_id or getattr(args, "stream_id", None)
         self.cache_expiration_time: int = 60 * 60 * 24 * 7  # 7 days
         # cache cleanup
         self._clean_cache_subtitles()
@@ -59,64 +82,201 @@ class VideoStream(Object):
     def get_player_stream_data(self) -> Optional[VideoPlayerStreamData]:
         """ retrieve a VideoPlayerStreamData containing stream url + subtitle urls for playback """
 
-        if not hasattr(self.args, 'stream_id') or not self.args.stream_id:
+        if not self.stream_id:
             return None
 
         video_player_stream_data = VideoPlayerStreamData()
+        video_player_stream_data.stream_id = self.stream_id
 
-        api_stream_data = self._get_stream_data_from_api()
-        if api_stream_data is False:
-            raise CrunchyrollError("Failed to fetch stream data from api")
+        api_stream_data = self.get_stream_data_from_api()
+
+        video_player_stream_data.stream_url = self._get_stream_url_from_api_data(api_stream_data,
+                                                                                 video_player_stream_data)
+        if video_player_stream_data.stream_url and video_player_stream_data.manifest_type == "hls":
+            video_player_stream_data.stream_url = self._prepare_hls_url(video_player_stream_data.stream_url)
+        video_player_stream_data.subtitle_urls = self._get_subtitles_from_api_data(api_stream_data)
+
+        return video_player_stream_data
+
+    def get_download_stream_data(self) -> Optional[VideoPlayerStreamData]:
+        """ like get_player_stream_data, but with the plain url of an hls stream, as needed to download it """
 
-        video_player_stream_data.stream_url = self._get_stream_url_from_api_data(api_stream_data)
+        if not self.stream_id:
+            return None
+
+        video_player_stream_data = VideoPlayerStreamData()
+        video_player_stream_data.stream_id = self.stream_id
+
+        api_stream_data = self.get_stream_data_from_api()
+
+        video_player_stream_data.stream_url = self._get_stream_url_from_api_data(api_stream_data,
+                                                                                 video_player_stream_data, "hls")
         video_player_stream_data.subtitle_urls = self._get_subtitles_from_api_data(api_stream_data)
 
         return video_player_stream_data
 
-    def _get_stream_data_from_api(self) -> Union[Dict, bool]:
-        """ get json stream data from cr api for given args.stream_id """
+    def get_stream_data_from_api(self) -> Dict:
+        """ get json stream data for given stream_id, either from cache or cr api """
+
+        cache_key = self._get_stream_cache_key()
+        cached = cache.load(self.args, "streams", cache_key)
+        if cached is not None:
+            crunchy_log(self.args, "Using cached stream data for %s" % self.stream_id, xbmc.LOGDEBUG)
+            return cached
+
+        req = self._request_stream_data()
+
+        stream_data = {
+            "streams": {
+                stream_type: urls
+                for stream_type, urls in (req.get("streams") or {}).items()
+                if stream_type in self.CACHED_STREAM_TYPES
+            },
+            "subtitles": req.get("subtitles") or {}
+        }
+        cache.store(self.args, "streams", cache_key, stream_data, self._get_stream_cache_expiration(stream_data))
+
+        return stream_data
+
+    def invalidate_stream_data(self) -> None:
+        """ drop cached stream data, e.g. if its urls turned out to be unusable """
+
+        cache.delete(self.args, "streams", self._get_stream_cache_key())
+
+    def _get_stream_cache_key(self) -> str:
+        return "%s_%s" % (self.stream_id, self.args.subtitle)
+
+    def _get_stream_cache_expiration(self, stream_data: Dict) -> float:
+        """ cached stream data must not outlive the signatures of any of its urls """
+
+        urls = []
+        for stream_urls in stream_data.get("streams").values():
+            urls.extend([stream.get("url") for stream in stream_urls.values()])
+        urls.extend([subtitle.get("url") for subtitle in stream_data.get("subtitles").values()])
+
+        expirations = [expiration for expiration in map(get_url_expiration, urls) if expiration]
+        if not expirations:
+            return time.time() + self.STREAM_CACHE_DEFAULT_TTL
+
+        return min(expirations) - self.STREAM_CACHE_MARGIN
+
+    def _request_stream_data(self) -> Dict:
+        """ get json stream data from cr api for given stream_id """
 
         # api request streams
         req = self.api.make_request(
             method="GET",
-            url=self.api.STREAMS_ENDPOINT.format(self.api.account_data.cms.bucket, self.args.stream_id),
+            url=self.api.STREAMS_ENDPOINT.format(self.api.account_data.cms.bucket, self.stream_id),
             params={
                 "locale": self.args.subtitle
             }
         )
 
-        # check for error
-        if "error" in req or req is None:
-            item = xbmcgui.ListItem(getattr(self.args, "title", "Title not provided"))
-            xbmcplugin.setResolvedUrl(int(self.args.argv[1]), False, item)
-            xbmcgui.Dialog().ok(self.args.addonname, self.args.addon.getLocalizedString(30064))
-            return False
+        # check for error - the caller is responsible for informing the user
+        if req is None or "error" in req:
+            raise CrunchyrollError("Failed to fetch stream data from api")
 
         return req
 
-    def _get_stream_url_from_api_data(self, api_data: Dict) -> Union[str, None]:
-        """ retrieve appropriate stream url from api data """
+    def _get_stream_url_from_api_data(
+            self,
+            api_data: Dict,
+            video_player_stream_data: VideoPlayerStreamData,
+            manifest_type: Optional[str] = None
+    ) -> Union[str, None]:
+        """ retrieve appropriate stream url from api data and set the stream type used
+
+        manifest_type limits the result to streams of that type
+        """
+
+        streams = api_data.get("streams") or {}
+
+        if self.args.addon.getSetting("soft_subtitles") == "false":
+            soft_subtitles = False
+            locales = [self.args.subtitle, self.args.subtitle_fallback, ""]
+        else:
+            # subtitles are added separately, so we need a stream without hard subs
+            soft_subtitles = True
+            locales = [""]
+
+        # stream types in order of preference, the next one is used if a type is not available. a matching hard sub
+        # locale is more important than the preferred stream type.
+        stream_types = [
+            stream_type
+            for stream_type in StreamSelector(self.args).get_stream_types(soft_subtitles, list(streams.keys()))
+            if manifest_type is None or StreamSelector.get_manifest_type(stream_type) == manifest_type
+        ]
+        for locale in locales:
+            for stream_type in stream_types:
+                urls = streams.get(stream_type) or {}
+                if locale in urls and urls[locale].get("url"):
+                    video_player_stream_data.stream_type = stream_type
+                    video_player_stream_data.manifest_type = StreamSelector.get_manifest_type(stream_type)
+                    return urls[locale]["url"]
+
+        crunchy_log(self.args, "No suitable stream found for %s" % self.stream_id, xbmc.LOGERROR)
+
+        return None
+
+    def _prepare_hls_url(self, stream_url: str) -> str:
+        """ apply pre-resolving and the prefetching proxy of the service, as configured """
+
+        proxy_address = self.get_proxy_address()
+
+        if self.args.addon.getSetting("hls_preresolve") == "true":
+            stream_url = self._pre_resolve_manifest(stream_url, proxy_address)
+
+        # a pre-resolved local copy points to the proxy already
+        if proxy_address and stream_url.startswith("http"):
+            stream_url = proxy.get_proxy_url(proxy_address, stream_url)
+
+        return stream_url
+
+    @staticmethod
+    def get_proxy_address() -> Optional[str]:
+        """ address of the hls proxy, if the service runs one """
+
+        return xbmcgui.Window(10000).getProperty(PROXY_ADDRESS_PROPERTY) or None
+
+    def _pre_resolve_manifest(self, stream_url: str, proxy_address: Optional[str] = None) -> str:
+        """ replace the master playlist by a local copy, limited to the configured resolution and bandwidth
+
+        saves the player from fetching and probing variants we don't want anyway. returns the original url if
+        anything goes wrong.
+        """
 
         try:
-            if self.args.addon.getSetting("soft_subtitles") == "false":
-                url = api_data["streams"]["adaptive_hls"]
-                if self.args.subtitle in url:
-                    url = url[self.args.subtitle]["url"]
-                elif self.args.subtitle_fallback in url:
-                    url = url[self.args.subtitle_fallback]["url"]
-                else:
-                    url = url[""]["url"]
-            else:
-                # multitrack_adaptive_hls_v2 includes soft subtitles in the stream
-                url = api_data["streams"]["multitrack_adaptive_hls_v2"][""]["url"]
-
-        except IndexError:
-            item = xbmcgui.ListItem(getattr(self.args, "title", "Title not provided"))
-            xbmcplugin.setResolvedUrl(int(self.args.argv[1]), False, item)
-            xbmcgui.Dialog().ok(self.args.addonname, self.args.addon.getLocalizedString(30064))
-            return None
+            max_height = self.MAX_RESOLUTIONS[int(self.args.addon.getSetting("hls_max_resolution") or 0)]
+            max_bandwidth = int(self.args.addon.getSetting("hls_max_bandwidth") or 0) * 1000
+
+            r = self.api.http.get(
+                stream_url,
+                headers={"User-Agent": headers().get("User-Agent")},
+                timeout=API.TIMEOUT
+            )
+            r.raise_for_status()
+
+            manifest = hls.trim_master_playlist(
+                r.text,
+                r.url,
+                max_height,
+                max_bandwidth,
+                (lambda uri: proxy.get_proxy_url(proxy_address, uri)) if proxy_address else None
+            )
+            if not manifest:
+                return stream_url
 
-        return url
+            manifest_path = self.get_manifest_path()
+            xbmcvfs.mkdirs(manifest_path)
+            manifest_file = manifest_path + self.stream_id + ".m3u8"
+            with open(manifest_file, 'w', encoding='utf-8') as file:
+                file.write(manifest)
+
+            return manifest_file
+        except Exception:
+            log_error_with_trace(self.args, "Failed to pre-resolve master playlist, using original", False)
+
+        return stream_url
 
     def _get_subtitles_from_api_data(self, api_stream_data) -> Union[str, None]:
         """ retrieve appropriate subtitle urls from api data, using local caching and renaming """
@@ -125,15 +285,9 @@ class VideoStream(Object):
         if self.args.addon.getSetting("soft_subtitles") == "false":
             return None
 
-        subtitles_data_raw = []
+        subtitles_data_raw = self.get_subtitle_descriptors(api_stream_data)
         subtitles_url_cached = []
 
-        if self.args.subtitle in api_stream_data["subtitles"]:
-            subtitles_data_raw.append(api_stream_data.get("subtitles").get(self.args.subtitle))
-
-        if self.args.subtitle_fallback and self.args.subtitle_fallback in api_stream_data["subtitles"]:
-            subtitles_data_raw.append(api_stream_data.get("subtitles").get(self.args.subtitle_fallback))
-
         if not subtitles_data_raw:
             return None
 
@@ -150,8 +304,37 @@ class VideoStream(Object):
 
         return subtitles_url_cached if subtitles_url_cached is not None else None
 
-    def _cache_subtitle(self, subtitle_url: str, subtitle_language: str, subtitle_format: str) -> bool:
-        """ cache a subtitle from the given url and rename it for kodi to label it correctly """
+    def get_subtitle_descriptors(self, api_stream_data: Dict) -> list:
+        """ get the subtitle entries of api data for the configured main and fallback language """
+
+        subtitles = api_stream_data.get("subtitles") or {}
+        descriptors = []
+
+        if self.args.subtitle in subtitles:
+            descriptors.append(subtitles.get(self.args.subtitle))
+
+        if self.args.subtitle_fallback and self.args.subtitle_fallback in subtitles:
+            descriptors.append(subtitles.get(self.args.subtitle_fallback))
+
+        return descriptors
+
+    def is_subtitle_cached(self, subtitle_language: str, subtitle_format: str) -> bool:
+        """ check if a subtitle for the current stream exists in the cache already """
+
+        return xbmcvfs.exists(self._get_cache_target() + self.get_cache_file_name(subtitle_language, subtitle_format))
+
+    def cache_subtitle(
+            self,
+            subtitle_url: str,
+            subtitle_language: str,
+            subtitle_format: str,
+            show_notification: bool = True
+    ) -> int:
+        """ cache a subtitle from the given url and rename it for kodi to label it correctly
+
+        returns the number of characters written, which is 0 if nothing was written. show_notification is off for
+        background jobs, the user didn't ask for them.
+        """
 
         try:
             # api request streams
@@ -160,7 +343,7 @@ class VideoStream(Object):
                 url=subtitle_url
             )
         except Exception:
-            log_error_with_trace(self.args, "error in requesting subtitle data from api")
+            log_error_with_trace(self.args, "error in requesting subtitle data from api", show_notification)
             raise CrunchyrollError(
                 "Failed to download subtitle for language %s from url %s" % (subtitle_language, subtitle_url)
             )
@@ -169,7 +352,7 @@ class VideoStream(Object):
             # error
             raise CrunchyrollError("Returned data is not text")
 
-        cache_target = xbmcvfs.translatePath(self.get_cache_path() + self.args.stream_id + '/')
+        cache_target = self._get_cache_target()
         xbmcvfs.mkdirs(cache_target)
 
         cache_file = self.get_cache_file_name(subtitle_language, subtitle_format)
@@ -177,7 +360,7 @@ class VideoStream(Object):
         with open(cache_target + cache_file, 'w', encoding='utf-8') as file:
             result = file.write(subtitles_req.get('data'))
 
-        return True if result > 0 else False
+        return result
 
     def _get_subtitle_from_cache(
             self,
@@ -194,19 +377,16 @@ class VideoStream(Object):
         # prepare the filename for the subtitles
         cache_file = self.get_cache_file_name(subtitle_language, subtitle_format)
 
-        # build full path to cached file
-        cache_target = xbmcvfs.translatePath(self.get_cache_path() + self.args.stream_id + '/') + cache_file
-
         # check if cached file exists
-        if not xbmcvfs.exists(cache_target):
+        if not self.is_subtitle_cached(subtitle_language, subtitle_format):
             # download and cache file
-            if not self._cache_subtitle(subtitle_url, subtitle_language, subtitle_format):
+            if not self.cache_subtitle(subtitle_url, subtitle_language, subtitle_format):
                 # log error
                 log_error_with_trace(self.args, "Failed to write subtitle to cache")
                 return None
 
         cache_file_url = ('special://userdata/addon_data/plugin.video.crunchyroll/cache_subtitles/' +
-                          self.args.stream_id +
+                          self.stream_id +
                           '/' + cache_file)
 
         return cache_file_url
@@ -235,6 +415,16 @@ class VideoStream(Object):
 
         return xbmcvfs.translatePath(self.args.addon.getAddonInfo("profile") + 'cache_subtitles/')
 
+    def get_manifest_path(self) -> str:
+        """ return base path for pre-resolved playlists """
+
+        return xbmcvfs.translatePath(self.args.addon.getAddonInfo("profile") + 'cache_manifests/')
+
+    def _get_cache_target(self) -> str:
+        """ return the subtitle cache directory of the current stream """
+
+        return xbmcvfs.translatePath(self.get_cache_path() + self.stream_id + '/')
+
     def get_cache_file_name(self, subtitle_language: str, subtitle_format: str) -> str:
         """ build a file name for the subtitles file that kodi can display with a readable label """
         # kodi ignores the first part of e.g. de-DE - split and use only first part in uppercase
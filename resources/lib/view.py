@@ -26,7 +26,10 @@ import xbmcvfs
 import xbmcgui
 import xbmcplugin
 
-from typing import Callable
+from typing import Callable, List
+
+from . import artwork
+from . import watched
 
 # keys allowed in setInfo
 types = ["count", "size", "date", "genre", "country", "year", "episode", "season", "sortepisode", "top250", "setid",
@@ -36,6 +39,10 @@ types = ["count", "size", "date", "genre", "country", "year", "episode", "season
          "tvshowtitle", "premiered", "status", "set", "setoverview", "tag", "imdbnumber", "code", "aired", "credits",
          "lastplayed", "album", "artist", "votes", "path", "trailer", "dateadded", "mediatype", "dbid"]
 
+# artwork of the current listing and of what is likely opened from it, for the service's artwork warmer
+_artwork: List[str] = []
+_extra_artwork: List[str] = []
+
 
 def end_of_directory(args):
     # sort methods are required in library mode
@@ -44,6 +51,17 @@ def end_of_directory(args):
     # let xbmc know the script is done adding items to the list
     xbmcplugin.endOfDirectory(handle=int(args.argv[1]))
 
+    if args.addon.getSetting("artwork_warmer") == "true" and (_artwork or _extra_artwork):
+        artwork.publish(args.argv[0] + args.argv[2], list(_artwork), list(_extra_artwork))
+    del _artwork[:]
+    del _extra_artwork[:]
+
+
+def add_extra_artwork(urls):
+    """Add artwork of items not in the listing, but likely to be opened from it, to the artwork warmer
+    """
+    _extra_artwork.extend(url for url in urls if url)
+
 
 def add_item(
         args,
@@ -56,6 +74,10 @@ def add_item(
     """Add item to directory listing.
     """
 
+    # watched overlays of all listings come from the same place
+    if not is_folder and info.get("episode_id"):
+        watched.get_store(args).apply(info)
+
     # create list item
     li = xbmcgui.ListItem(label=info["title"])
 
@@ -93,6 +115,8 @@ def add_item(
                "fanart": info.get("fanart", xbmcvfs.translatePath(args.addon.getAddonInfo("fanart"))),
                "icon": info.get("thumb", "DefaultFolder.png")})
 
+    _artwork.extend(url for url in [info.get("thumb"), info.get("fanart")] if url)
+
     if callback:
         callback(li)
 
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+# Crunchyroll
+# Copyright (C) 2018 MrKrabat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+import xbmc
+import xbmcvfs
+
+from . import utils
+from .model import Args
+
+# stores by file, reloaded when another process changed the file
+_stores: Dict[str, "WatchedStore"] = {}
+
+
+def get_store(args: Args) -> "WatchedStore":
+    """ get the watched state store, loaded once per process """
+
+    path = xbmcvfs.translatePath(args.addon.getAddonInfo("profile") + "watched.json")
+    store = _stores.get(path)
+    if store is None or (not store.changed and store.is_outdated()):
+        store = WatchedStore(args, path)
+        _stores[path] = store
+
+    return store
+
+
+class WatchedStore:
+    """
+    Watched state of every episode and movie seen in a response, keyed by episode_id
+
+    Fed by playheads, watchlist and history responses and by local playback. Entries are fresh for FRESH_AGE seconds,
+    listings and playback only ask the api for playheads that aren't. A local playback event wins over responses
+    received within LOCAL_GRACE seconds after it, as the playhead may not have reached crunchyroll yet. Plugin and
+    service share the file: changed entries are merged into what is on disk, the newer one wins, and the file is
+    replaced atomically. Within the service, jobs and the player share one instance.
+    """
+
+    VERSION = 1
+    FRESH_AGE = 60 * 60
+    LOCAL_GRACE = 10 * 60
+    # the least recently updated entries are dropped beyond this
+    MAX_ENTRIES = 10000
+
+    def __init__(self, args: Args, path: str):
+        self.args: Args = args
+        self.path: str = path
+        self.mtime: float = 0
+        self.lock = threading.RLock()
+        # episode_id => {"playhead", "watched", "updated", "local"}
+        self.entries: Dict[str, Dict] = self._load()
+        self.changed: Dict[str, Dict] = {}
+
+    def get(self, episode_id: str, fresh: bool = False) -> Optional[Dict]:
+        """ the entry of an episode, if fresh is set only if it was updated within FRESH_AGE """
+
+        entry = self.entries.get(episode_id)
+        if entry and fresh and entry.get("updated", 0) < time.time() - self.FRESH_AGE:
+            return None
+
+        return entry
+
+    def get_missing(self, episode_ids: Iterable[str]) -> List[str]:
+        """ the episode ids without fresh entry """
+
+        return [episode_id for episode_id in episode_ids if episode_id and not self.get(episode_id, fresh=True)]
+
+    def apply(self, info: Dict) -> Dict:
+        """ set playcount and, if fresh, playhead of an info dict from its entry """
+
+        entry = self.entries.get(info.get("episode_id"))
+        if not entry:
+            return info
+
+        info["playcount"] = 1 if entry.get("watched") else 0
+        if entry.get("updated", 0) >= time.time() - self.FRESH_AGE:
+            info["playhead"] = entry.get("playhead")
+
+        return info
+
+    def update(self, episode_id: str, playhead: Optional[int], watched: bool, local: bool = False) -> None:
+        """ record the state of an episode, local for playback events """
+
+        if not episode_id:
+            return
+
+        now = time.time()
+        entry = self.entries.get(episode_id)
+        if not local and entry and entry.get("local", 0) > now - self.LOCAL_GRACE:
+            return
+
+        entry = {"playhead": int(playhead or 0), "watched": bool(watched), "updated": now}
+        if local:
+            entry["local"] = now
+
+        with self.lock:
+            self.entries[episode_id] = entry
+            self.changed[episode_id] = entry
+
+    def update_from_playheads(self, data: Optional[Dict]) -> None:
+        """ record a response of PLAYHEADS_ENDPOINT """
+
+        for info in (data or {}).get("data") or []:
+            self.update(info.get("content_id"), info.get("playhead"), info.get("fully_watched") is True)
+
+    def update_from_items(self, items: Iterable[Dict]) -> None:
+        """ record watchlist or history items """
+
+        for item in items:
+            panel = item.get("panel") or {}
+            meta = panel.get("episode_metadata") or panel.get("movie_metadata") or {}
+            playhead = item.get("playhead")
+            watched = item.get("fully_watched")
+            if watched is None:
+                watched = utils.is_watched(playhead, int(meta.get("duration_ms", 0) / 1000))
+
+            self.update(panel.get("id"), playhead, bool(watched))
+
+    def is_outdated(self) -> bool:
+        """ whether another process changed the file since it was loaded """
+
+        return self._get_mtime() != self.mtime
+
+    def save(self) -> None:
+        with self.lock:
+            if not self.changed:
+                return
+
+            # another process may have written in the meantime, keep its newer entries
+            entries = self._load()
+            for episode_id, entry in self.changed.items():
+                if entry.get("updated", 0) >= entries.get(episode_id, {}).get("updated", 0):
+                    entries[episode_id] = entry
+
+            if len(entries) > self.MAX_ENTRIES:
+                newest = sorted(entries.items(), key=lambda item: item[1].get("updated", 0))[-self.MAX_ENTRIES:]
+                entries = dict(newest)
+
+            xbmcvfs.mkdirs(os.path.dirname(self.path))
+            utils.write_file(self.path, json.dumps(
+                {"version": self.VERSION, "entries": entries}, separators=(",", ":")
+            ))
+
+            self.entries = entries
+            self.changed = {}
+            self.mtime = self._get_mtime()
+
+    def _get_mtime(self) -> float:
+        try:
+            return os.path.getmtime(self.path)
+        except OSError:
+            return 0
+
+    def _load(self) -> Dict[str, Dict]:
+        self.mtime = self._get_mtime()
+        if not self.mtime:
+            return {}
+
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                stored = json.load(file)
+        except (OSError, ValueError):
+            utils.crunchy_log(self.args, "Watched state: resetting invalid store", xbmc.LOGWARNING)
+            return {}
+
+        if stored.get("version") != self.VERSION:
+            return {}
+
+        return stored.get("entries") or {}
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+# Crunchyroll
+# Copyright (C) 2018 MrKrabat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Snapshots of the lists skins show as widgets. The service builds them, the plugin only ever reads them, so a widget
+# never waits for the network or a login.
+
+import time
+from typing import Dict, List, Optional
+
+import xbmc
+import xbmcgui
+
+from . import cache
+from . import listwarmer
+from . import utils
+from .api import API
+from .model import Args, EpisodeData, MediaData, MovieData
+from .nextup import NextUp
+
+NAMESPACE = "widgets"
+SOURCES = ["queue", "history", "continue", "popular"]
+
+# NotifyAll message asking the service to rebuild the snapshots
+REFRESH_MESSAGE = "widgets"
+# window property with the time of the last rebuild. skins can append it to the widget path, e.g.
+# plugin://plugin.video.crunchyroll/?mode=widget&source=queue&updated=$INFO[Window(Home).Property(crunchyroll.widgets)]
+# so the widget reloads once a fresh snapshot is available
+UPDATED_PROPERTY = "crunchyroll.widgets"
+
+# snapshots older than this many seconds are served, but the service is asked for fresh ones
+MAX_AGE = 15 * 60
+# snapshots are dropped by the cache cleanup after this many seconds
+SNAPSHOT_TTL = 30 * 24 * 60 * 60
+
+# the info labels kept for widget items, everything else only makes them slower to list
+INFO_KEYS = ["title", "tvshowtitle", "episode", "duration", "playcount", "playhead", "thumb", "fanart", "episode_id",
+             "collection_id", "series_id", "stream_id", "mode"]
+
+
+def load_snapshot(args: Args, source: str) -> Optional[Dict]:
+    """ get the snapshot of a source as {"created", "items"}, None if there is none yet """
+
+    return cache.load(args, NAMESPACE, "%s_%s" % (source, args.subtitle))
+
+
+def get_limit(args: Args) -> int:
+    return max(1, int(args.addon.getSetting("widget_limit") or 20))
+
+
+def request_refresh() -> None:
+    xbmc.executebuiltin("NotifyAll(%s,%s)" % (utils.ADDON_ID, REFRESH_MESSAGE))
+
+
+class WidgetSnapshots:
+    """ Build the widget snapshots, from the warm lists where possible """
+
+    def __init__(self, args: Args, api: API):
+        self.args: Args = args
+        self.api: API = api
+        self.limit: int = get_limit(args)
+
+    def refresh(self) -> List[str]:
+        """ rebuild all snapshots, returns the sources that failed """
+
+        failed = []
+        for source in SOURCES:
+            try:
+                items = getattr(self, "_get_%s_items" % source)()
+            except Exception:
+                utils.log_error_with_trace(self.args, "Widgets: failed to build %s" % source, False)
+                items = None
+
+            if items is None:
+                failed.append(source)
+                continue
+
+            cache.store(
+                self.args,
+                NAMESPACE,
+                "%s_%s" % (source, self.args.subtitle),
+                {"created": time.time(), "items": [self._strip(item) for item in items[:self.limit]]},
+                time.time() + SNAPSHOT_TTL
+            )
+
+        xbmcgui.Window(10000).setProperty(UPDATED_PROPERTY, str(int(time.time())))
+
+        return failed
+
+    def _get_queue_items(self) -> Optional[List[Dict]]:
+        watchlist = listwarmer.load(self.args, listwarmer.WATCHLIST)
+        if watchlist is None:
+            req = self.api.make_list_request(
+                method="GET",
+                url=self.api.WATCHLIST_LIST_ENDPOINT.format(self.api.account_data.account_id),
+                items_key="items",
+                fields=MediaData.API_FIELDS,
+                params={
+                    "n": self.limit,
+                    "locale": self.args.subtitle
+                }
+            )
+            watchlist = {"items": list(req)}
+            if "error" in req.meta:
+                return None
+
+        return self._parse_items(watchlist.get("items", []))
+
+    def _get_history_items(self) -> Optional[List[Dict]]:
+        history = listwarmer.load(self.args, listwarmer.HISTORY)
+        if history is None:
+            req = self.api.make_list_request(
+                method="GET",
+                url=self.api.HISTORY_ENDPOINT.format(self.api.account_data.account_id),
+                items_key="data",
+                fields=MediaData.API_FIELDS,
+                params={
+                    "page_size": self.limit,
+                    "page": 1,
+                    "locale": self.args.subtitle
+                }
+            )
+            history = {"data": list(req)}
+            if "error" in req.meta:
+                return None
+
+        return self._parse_items(history.get("data", []))
+
+    def _get_continue_items(self) -> Optional[List[Dict]]:
+        items = NextUp(self.args, self.api).get_items()
+        for item in items:
+            item["mode"] = "videoplay"
+
+        return items
+
+    def _get_popular_items(self) -> Optional[List[Dict]]:
+        req = self.api.make_request(
+            method="GET",
+            url=self.api.BROWSE_ENDPOINT,
+            params={
+                "locale": self.args.subtitle,
+                "sort_by": "popularity",
+                "n": self.limit
+            }
+        )
+        if not req or req.get("error") is not None:
+            return None
+
+        return [
+            {
+                "title": item.get("title"),
+                "tvshowtitle": item.get("title"),
+                "series_id": item.get("id"),
+                "thumb": utils.get_image_from_struct(item, "poster_tall", 2),
+                "fanart": utils.get_image_from_struct(item, "poster_wide", 2),
+                "mode": "series"
+            }
+            for item in req.get("items", [])
+        ]
+
+    def _parse_items(self, items: List[Dict]) -> List[Dict]:
+        parsed = []
+        for item in items:
+            try:
+                if item.get("panel", {}).get("type") == "episode":
+                    info = EpisodeData(item).to_info()
+                elif item.get("panel", {}).get("type") == "movie":
+                    info = MovieData(item).to_info()
+                else:
+                    continue
+            except Exception:
+                continue
+
+            info["mode"] = "videoplay"
+            parsed.append(info)
+
+            if len(parsed) >= self.limit:
+                break
+
+        return parsed
+
+    @staticmethod
+    def _strip(item: Dict) -> Dict:
+        return {key: item.get(key) for key in INFO_KEYS if item.get(key) is not None}
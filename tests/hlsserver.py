@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# Crunchyroll
+# Copyright (C) 2018 MrKrabat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# A static HLS tree served by python's http.server on localhost: a master playlist with two variants, each a media
+# playlist of equally sized segments. Every request is recorded, so tests can tell what reached the server.
+
+import os
+import shutil
+import tempfile
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+VARIANTS = ["low", "high"]
+
+
+class StaticHlsServer:
+    """ Serve a generated HLS tree from a temporary directory until stop() """
+
+    def __init__(self, segments: int = 6, segment_size: int = 1024):
+        self.segment_size: int = segment_size
+        self.segment_count: int = segments
+        self.directory: str = tempfile.mkdtemp(prefix="crunchyroll-hls-")
+        # paths of all requests, in order
+        self.requests: List[str] = []
+        self.lock = threading.Lock()
+
+        self._write_tree()
+
+        server = self
+
+        class Handler(SimpleHTTPRequestHandler):
+            def do_GET(self) -> None:
+                with server.lock:
+                    server.requests.append(self.path)
+                super().do_GET()
+
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), partial(Handler, directory=self.directory))
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def address(self) -> str:
+        return "http://127.0.0.1:%d" % self.server.server_address[1]
+
+    def url(self, path: str) -> str:
+        return "%s/%s" % (self.address, path)
+
+    def get_segment_data(self, variant: str, index: int) -> bytes:
+        """ content of a segment, unique per variant and index """
+
+        pattern = ("%s-%04d|" % (variant, index)).encode("ascii")
+
+        return (pattern * (self.segment_size // len(pattern) + 1))[:self.segment_size]
+
+    def count_requests(self, path: str) -> int:
+        with self.lock:
+            return self.requests.count("/" + path)
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _write_tree(self) -> None:
+        master = ["#EXTM3U", "#EXT-X-VERSION:3"]
+        for number, variant in enumerate(VARIANTS, 1):
+            master.append("#EXT-X-STREAM-INF:BANDWIDTH=%d,RESOLUTION=%dx%d" % (
+                number * 1000000, number * 640, number * 360
+            ))
+            master.append("%s/index.m3u8" % variant)
+
+            os.makedirs(os.path.join(self.directory, variant))
+            playlist = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:4", "#EXT-X-MEDIA-SEQUENCE:0"]
+            for index in range(self.segment_count):
+                playlist.append("#EXTINF:4.0,")
+                playlist.append("segment%d.ts" % index)
+                with open(os.path.join(self.directory, variant, "segment%d.ts" % index), "wb") as file:
+                    file.write(self.get_segment_data(variant, index))
+            playlist.append("#EXT-X-ENDLIST")
+
+            with open(os.path.join(self.directory, variant, "index.m3u8"), "w") as file:
+                file.write("\n".join(playlist) + "\n")
+
+        with open(os.path.join(self.directory, "master.m3u8"), "w") as file:
+            file.write("\n".join(master) + "\n")
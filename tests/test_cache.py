@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Crunchyroll
+# Copyright (C) 2018 MrKrabat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import xbmcaddon
+from resources.lib import cache, utils
+
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.profile = tempfile.mkdtemp(prefix="crunchyroll-profile-") + "/"
+        patcher = mock.patch.object(xbmcaddon, "PROFILE", self.profile)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.profile, True)
+
+        self.args = utils.parse(["plugin://plugin.video.crunchyroll/", "-1", ""])
+
+    def test_concurrent_writers(self):
+        errors = []
+
+        def write(number: int) -> None:
+            try:
+                for _ in range(50):
+                    cache.store(self.args, "lists", "watchlist", {"writer": number}, time.time() + 60)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=write, args=(number,)) for number in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertIn(cache.load(self.args, "lists", "watchlist")["writer"], range(8))
+        self.assertEqual(os.listdir(cache.get_cache_dir(self.args, "lists")), ["watchlist.json"])
+
+    def test_clean_skips_files_being_written(self):
+        cache.store(self.args, "lists", "expired", {}, time.time() + 60)
+        cache_dir = cache.get_cache_dir(self.args, "lists")
+        with open(cache_dir + "watchlist.json.abc" + utils.TMP_SUFFIX, "w") as file:
+            file.write('{"expires": 0')
+        with open(cache_dir + "history.json.def" + utils.TMP_SUFFIX, "w") as file:
+            file.write('{"expires": 0')
+        # left over by a writer that crashed long ago
+        old = time.time() - cache.TMP_MAX_AGE - 1
+        os.utime(cache_dir + "history.json.def" + utils.TMP_SUFFIX, (old, old))
+
+        with mock.patch("time.time", return_value=time.time() + 120):
+            self.assertEqual(cache.clean(self.args, "lists"), 1)
+
+        self.assertEqual(sorted(os.listdir(cache_dir)), ["watchlist.json.abc" + utils.TMP_SUFFIX])
+
+
+class WriteFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="crunchyroll-write-")
+        self.addCleanup(shutil.rmtree, self.directory, True)
+
+    def test_replaces_content(self):
+        path = os.path.join(self.directory, "session_data.json")
+        utils.write_file(path, "old")
+        utils.write_file(path, b"new")
+
+        with open(path, "rb") as file:
+            self.assertEqual(file.read(), b"new")
+        self.assertEqual(os.listdir(self.directory), ["session_data.json"])
+
+    def test_removes_temporary_file_on_error(self):
+        path = os.path.join(self.directory, "missing", "file.json")
+
+        with self.assertRaises(OSError):
+            utils.write_file(path, "data")
+
+        utils.write_file(os.path.join(self.directory, "file.json"), "data")
+        with mock.patch("os.replace", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                utils.write_file(os.path.join(self.directory, "file.json"), "other")
+
+        self.assertEqual(os.listdir(self.directory), ["file.json"])
+
+
+if __name__ == "__main__":
+    unittest.main()
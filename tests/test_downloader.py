@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+# Crunchyroll
+# Copyright (C) 2018 MrKrabat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from resources.lib import downloader
+from resources.lib.downloader import DownloadCancelled, DownloadError, DownloadStore, SegmentDownloader
+from tests.hlsserver import StaticHlsServer
+
+
+class SegmentDownloaderTest(unittest.TestCase):
+    SEGMENTS = 6
+
+    def setUp(self):
+        self.server = StaticHlsServer(segments=self.SEGMENTS, segment_size=2048)
+        self.target_dir = tempfile.mkdtemp(prefix="crunchyroll-download-")
+        self.downloader = SegmentDownloader(concurrency=2)
+
+    def tearDown(self):
+        self.downloader.http.close()
+        self.server.stop()
+        shutil.rmtree(self.target_dir, ignore_errors=True)
+
+    def test_concatenates_segments(self):
+        result = self.downloader.download(self.server.url("master.m3u8"), self.target_dir)
+
+        expected = b"".join(self.server.get_segment_data("high", index) for index in range(self.SEGMENTS))
+        with open(result["file"], "rb") as file:
+            self.assertEqual(file.read(), expected)
+
+        self.assertEqual(result["file"], os.path.join(self.target_dir, "video.ts"))
+        self.assertEqual(result["size"], len(expected))
+        self.assertEqual(result["sha256"], hashlib.sha256(expected).hexdigest())
+        # nothing but the video is left behind
+        self.assertEqual(os.listdir(self.target_dir), ["video.ts"])
+
+    def test_selects_variant_within_limits(self):
+        result = self.downloader.download(self.server.url("master.m3u8"), self.target_dir, max_height=360)
+
+        with open(result["file"], "rb") as file:
+            self.assertTrue(file.read().startswith(self.server.get_segment_data("low", 0)))
+        self.assertEqual(self.server.count_requests("high/index.m3u8"), 0)
+
+    def test_resumes_interrupted_download(self):
+        downloader_1 = SegmentDownloader(concurrency=1)
+        self.addCleanup(downloader_1.http.close)
+
+        with self.assertRaises(DownloadCancelled):
+            downloader_1.download(
+                self.server.url("low/index.m3u8"),
+                self.target_dir,
+                cancelled=lambda: self._count_segment_requests("low") >= 3
+            )
+
+        # the finished parts are recorded, the rest is fetched by the next attempt
+        state = downloader_1._load_state(self.target_dir)
+        self.assertEqual(sorted(state["parts"]), ["0", "1", "2"])
+
+        self.downloader.download(self.server.url("low/index.m3u8"), self.target_dir)
+
+        for index in range(self.SEGMENTS):
+            self.assertEqual(self.server.count_requests("low/segment%d.ts" % index), 1)
+
+    def test_refetches_damaged_parts(self):
+        with self.assertRaises(DownloadCancelled):
+            self.downloader.download(
+                self.server.url("low/index.m3u8"),
+                self.target_dir,
+                cancelled=lambda: self._count_segment_requests("low") >= 3
+            )
+
+        # same size, different content
+        with open(os.path.join(self.target_dir, downloader.PARTS_DIR, "00001"), "r+b") as file:
+            file.write(b"garbage")
+
+        result = self.downloader.download(self.server.url("low/index.m3u8"), self.target_dir)
+
+        self.assertEqual(self.server.count_requests("low/segment0.ts"), 1)
+        self.assertEqual(self.server.count_requests("low/segment1.ts"), 2)
+        expected = b"".join(self.server.get_segment_data("low", index) for index in range(self.SEGMENTS))
+        self.assertEqual(result["sha256"], hashlib.sha256(expected).hexdigest())
+
+    def test_backs_off_between_retries(self):
+        os.remove(os.path.join(self.server.directory, "low", "segment2.ts"))
+
+        with mock.patch.object(SegmentDownloader, "_wait") as wait:
+            with self.assertRaises(DownloadError):
+                self.downloader.download(self.server.url("low/index.m3u8"), self.target_dir)
+
+        self.assertEqual(self.server.count_requests("low/segment2.ts"), SegmentDownloader.RETRIES)
+        self.assertEqual([call[0][0] for call in wait.call_args_list], [1.0, 2.0])
+
+    def test_cancels_while_backing_off(self):
+        with mock.patch.object(downloader.time, "sleep") as sleep:
+            with self.assertRaises(DownloadCancelled):
+                SegmentDownloader._wait(60, lambda: sleep.call_count >= 2)
+
+        self.assertEqual(sleep.call_count, 2)
+
+    def test_reports_progress(self):
+        progress = []
+        self.downloader.download(
+            self.server.url("low/index.m3u8"), self.target_dir, progress=lambda done, total: progress.append((done, total))
+        )
+
+        self.assertEqual(progress[-1], (self.SEGMENTS, self.SEGMENTS))
+        self.assertEqual(len(progress), self.SEGMENTS)
+
+    def _count_segment_requests(self, variant: str) -> int:
+        return sum(self.server.count_requests("%s/segment%d.ts" % (variant, index)) for index in range(self.SEGMENTS))
+
+
+class DownloadStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix="crunchyroll-downloads-")
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def test_evicts_least_recently_used(self):
+        store = self._create_store(quota_bytes=300, sizes={"a": 100, "b": 100, "c": 100})
+        store.index["a"]["last_used"] = 3
+        store.index["b"]["last_used"] = 1
+        store.index["c"]["last_used"] = 2
+
+        self.assertTrue(store.ensure_space(150))
+
+        self.assertEqual(sorted(store.index), ["a"])
+        self.assertFalse(os.path.exists(store.get_target_dir("b")))
+        self.assertFalse(os.path.exists(store.get_target_dir("c")))
+        self.assertIsNotNone(store.get("a"))
+        # the index on disk is updated as well
+        self.assertEqual(sorted(DownloadStore(self.path, 300).index), ["a"])
+
+    def test_keeps_download_in_progress(self):
+        store = self._create_store(quota_bytes=200, sizes={"a": 100, "b": 100})
+        store.index["a"]["last_used"] = 1
+        store.index["b"]["last_used"] = 2
+
+        self.assertFalse(store.ensure_space(150, keep="a"))
+        self.assertEqual(sorted(store.index), ["a"])
+
+    def test_refuses_more_than_quota(self):
+        store = self._create_store(quota_bytes=200, sizes={"a": 100})
+
+        self.assertFalse(store.ensure_space(250))
+        # nothing is evicted for a download that can't fit anyway
+        self.assertEqual(sorted(store.index), ["a"])
+
+    def test_without_quota(self):
+        store = self._create_store(quota_bytes=0, sizes={"a": 100})
+
+        self.assertTrue(store.ensure_space(10 ** 12))
+        self.assertEqual(sorted(store.index), ["a"])
+
+    def _create_store(self, quota_bytes: int, sizes: dict) -> DownloadStore:
+        store = DownloadStore(self.path, quota_bytes)
+        for stream_id, size in sizes.items():
+            os.makedirs(store.get_target_dir(stream_id))
+            video_file = os.path.join(store.get_target_dir(stream_id), "video.ts")
+            with open(video_file, "wb") as file:
+                file.write(b"x" * size)
+            store.add(stream_id, {"file": video_file, "size": size})
+
+        return store
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# Crunchyroll
+# Copyright (C) 2018 MrKrabat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import requests
+
+import xbmcaddon
+from resources.lib import utils
+from resources.lib.playheads import PlayheadWriter
+
+
+class FakeApi:
+    PLAYHEADS_ENDPOINT = "https://example.invalid/{}/playheads"
+
+    class account_data:
+        account_id = "account"
+
+    def __init__(self):
+        self.sent = []
+        self.status_code = 200
+
+    def send_request(self, method, url, headers=None, params=None, data=None, json=None):
+        self.sent.append(json)
+        response = requests.Response()
+        response.status_code = self.status_code
+
+        return response
+
+
+class FakeService:
+    def __init__(self, api: FakeApi):
+        self.api = api
+
+    @staticmethod
+    def create_args():
+        return utils.parse(["plugin://plugin.video.crunchyroll/", "-1", ""])
+
+    def create_api(self, args):
+        return self.api
+
+
+class PlayheadWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.profile = tempfile.mkdtemp(prefix="crunchyroll-profile-") + "/"
+        patcher = mock.patch.object(xbmcaddon, "PROFILE", self.profile)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.profile, True)
+
+        self.api = FakeApi()
+        self.writer = PlayheadWriter(FakeService(self.api))
+
+    def test_coalesces_updates_within_interval(self):
+        self.writer.update("E1", 100)
+        self.writer.update("E1", 130)
+        self.writer.update("E1", 160)
+
+        # the first update is sent, the later ones wait for the interval
+        self.assertEqual(self.api.sent, [{"playhead": 100, "content_id": "E1"}])
+        self.assertTrue(self.writer.has_pending())
+        self.assertGreater(self.writer.get_retry_delay(), self.writer.interval - 5)
+
+        self.writer.flush()
+        self.assertEqual(len(self.api.sent), 1)
+
+    def test_two_updates_within_interval_send_once(self):
+        self.writer.last_send = time.time()
+
+        self.writer.update("E1", 100)
+        self.writer.update("E1", 130)
+        self.writer.flush()
+
+        self.assertEqual(self.api.sent, [])
+
+        with mock.patch("time.time", return_value=time.time() + self.writer.interval):
+            self.assertEqual(self.writer.get_retry_delay(), 0)
+            self.writer.flush()
+
+        self.assertEqual(self.api.sent, [{"playhead": 130, "content_id": "E1"}])
+        self.assertFalse(self.writer.has_pending())
+
+    def test_forced_update_is_sent_at_once(self):
+        self.writer.last_send = time.time()
+
+        self.writer.update("E1", 100)
+        self.writer.update("E1", 130, force=True)
+
+        self.assertEqual(self.api.sent, [{"playhead": 130, "content_id": "E1"}])
+        self.assertFalse(self.writer.has_pending())
+
+    def test_failed_update_keeps_backoff(self):
+        self.api.status_code = 503
+        self.writer.update("E1", 100, force=True)
+        retry_at = self.writer.journal["E1"]["retry_at"]
+
+        self.writer.update("E1", 200)
+
+        self.assertEqual(len(self.api.sent), 1)
+        self.assertGreaterEqual(self.writer.journal["E1"]["retry_at"], retry_at)
+        self.assertEqual(self.writer.journal["E1"]["attempts"], 1)
+
+    def test_rejected_update_is_dropped(self):
+        self.api.status_code = 400
+
+        self.writer.update("E1", 100, force=True)
+        for _ in range(PlayheadWriter.MAX_REJECTIONS - 1):
+            self.writer.journal["E1"]["retry_at"] = 0
+            self.writer.flush()
+
+        self.assertEqual(len(self.api.sent), PlayheadWriter.MAX_REJECTIONS)
+        self.assertFalse(self.writer.has_pending())
+
+
+if __name__ == "__main__":
+    unittest.main()
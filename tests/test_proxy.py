@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# Crunchyroll
+# Copyright (C) 2018 MrKrabat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import time
+import unittest
+
+import requests
+
+from resources.lib import proxy
+from resources.lib.proxy import HlsProxy, SegmentBuffer
+from tests.hlsserver import StaticHlsServer
+
+
+class HlsProxyTest(unittest.TestCase):
+    PREFETCH = 2
+    SEGMENT_SIZE = 1024
+    # the buffer holds four segments
+    BUFFER_BYTES = 4 * SEGMENT_SIZE
+
+    def setUp(self):
+        self.server = StaticHlsServer(segments=8, segment_size=self.SEGMENT_SIZE)
+        self.proxy = HlsProxy(prefetch=self.PREFETCH, buffer_bytes=self.BUFFER_BYTES)
+        self.proxy.start()
+        self.http = requests.Session()
+
+    def tearDown(self):
+        self.http.close()
+        self.proxy.stop()
+        self.server.stop()
+
+    def test_rewrites_master_playlist(self):
+        playlist = self._get_playlist(self.server.url("master.m3u8"))
+
+        uris = [line for line in playlist.splitlines() if line and not line.startswith("#")]
+        self.assertEqual(uris, [
+            proxy.get_proxy_url(self.proxy.address, self.server.url("low/index.m3u8")),
+            proxy.get_proxy_url(self.proxy.address, self.server.url("high/index.m3u8"))
+        ])
+        self.assertIn("BANDWIDTH=2000000,RESOLUTION=1280x720", playlist)
+
+    def test_rewrites_media_playlist(self):
+        playlist = self._get_playlist(self.server.url("low/index.m3u8"))
+
+        uris = [line for line in playlist.splitlines() if line and not line.startswith("#")]
+        self.assertEqual(uris, [
+            proxy.get_proxy_url(self.proxy.address, self.server.url("low/segment%d.ts" % index), "segment")
+            for index in range(8)
+        ])
+        self.assertIn("#EXT-X-ENDLIST", playlist)
+
+    def test_serves_prefetched_segments_from_buffer(self):
+        uris = self._get_segment_uris("low")
+
+        self.assertEqual(self._get(uris[0]), self.server.get_segment_data("low", 0))
+        self._wait_for_prefetch()
+
+        # the following segments were fetched in the background, once
+        metrics = self.proxy.get_metrics()
+        self.assertEqual(metrics["prefetched"], self.PREFETCH)
+        for index in range(1, self.PREFETCH + 1):
+            self.assertEqual(self.server.count_requests("low/segment%d.ts" % index), 1)
+        self.assertEqual(self.server.count_requests("low/segment%d.ts" % (self.PREFETCH + 1)), 0)
+
+        # and are served from the buffer without asking the server again
+        self.assertEqual(self._get(uris[1]), self.server.get_segment_data("low", 1))
+        self.assertEqual(self.server.count_requests("low/segment1.ts"), 1)
+        self.assertEqual(self.proxy.get_metrics()["hits"], 1)
+        self.assertEqual(self.proxy.get_metrics()["misses"], 1)
+
+    def test_buffer_stays_within_bounds(self):
+        uris = self._get_segment_uris("high")
+
+        for index, uri in enumerate(uris):
+            self.assertEqual(self._get(uri), self.server.get_segment_data("high", index))
+            self._wait_for_prefetch()
+
+            metrics = self.proxy.get_metrics()
+            self.assertLessEqual(metrics["buffer_bytes"], self.BUFFER_BYTES)
+            self.assertLessEqual(metrics["buffered_segments"], self.BUFFER_BYTES // self.SEGMENT_SIZE)
+
+        # every segment reached the server once: played ones were evicted before upcoming ones
+        for index in range(len(uris)):
+            self.assertEqual(self.server.count_requests("high/segment%d.ts" % index), 1)
+
+    def test_reports_fill_metrics(self):
+        uris = self._get_segment_uris("low")
+        self._get(uris[0])
+        self._wait_for_prefetch()
+
+        metrics = self.http.get(self.proxy.address + "/metrics").json()
+        buffered = 1 + self.PREFETCH
+        self.assertEqual(metrics["buffered_segments"], buffered)
+        self.assertEqual(metrics["buffer_bytes"], buffered * self.SEGMENT_SIZE)
+        self.assertEqual(metrics["buffer_capacity"], self.BUFFER_BYTES)
+        self.assertEqual(metrics["buffer_fill"], round(buffered * self.SEGMENT_SIZE / float(self.BUFFER_BYTES), 3))
+        self.assertEqual(metrics["pending_segments"], 0)
+        self.assertEqual(metrics["playlists"], 1)
+
+    def test_reports_upstream_errors(self):
+        r = self.http.get(proxy.get_proxy_url(self.proxy.address, self.server.url("low/missing.ts"), "segment"))
+
+        self.assertEqual(r.status_code, 502)
+        self.assertEqual(self.proxy.get_metrics()["errors"], 1)
+
+    def _get(self, url: str) -> bytes:
+        r = self.http.get(url)
+        r.raise_for_status()
+
+        return r.content
+
+    def _get_playlist(self, url: str) -> str:
+        r = self.http.get(proxy.get_proxy_url(self.proxy.address, url))
+        r.raise_for_status()
+        self.assertEqual(r.headers["Content-Type"], proxy.PLAYLIST_MIME_TYPE)
+
+        return r.text
+
+    def _get_segment_uris(self, variant: str):
+        playlist = self._get_playlist(self.server.url("%s/index.m3u8" % variant))
+
+        return [line for line in playlist.splitlines() if line and not line.startswith("#")]
+
+    def _wait_for_prefetch(self, timeout: float = 5) -> None:
+        deadline = time.time() + timeout
+        while self.proxy.get_metrics()["pending_segments"] and time.time() < deadline:
+            time.sleep(0.01)
+
+
+class SegmentBufferTest(unittest.TestCase):
+    def test_evicts_served_segments_first(self):
+        buffer = SegmentBuffer(30)
+        for name in ["a", "b", "c"]:
+            buffer.put(name, "video/mp2t", b"x" * 10)
+
+        # b was played, a is still ahead of the player
+        buffer.get("b")
+        buffer.put("d", "video/mp2t", b"x" * 10)
+
+        self.assertEqual(list(buffer.segments), ["a", "c", "d"])
+        self.assertEqual(buffer.size, 30)
+
+    def test_evicts_least_recently_used_otherwise(self):
+        buffer = SegmentBuffer(20)
+        buffer.put("a", "video/mp2t", b"x" * 10)
+        buffer.put("b", "video/mp2t", b"x" * 10)
+        buffer.put("c", "video/mp2t", b"x" * 10)
+
+        self.assertEqual(list(buffer.segments), ["b", "c"])
+        self.assertEqual(buffer.get_metrics()["buffer_fill"], 1.0)
+
+    def test_keeps_single_oversized_segment(self):
+        buffer = SegmentBuffer(10)
+        buffer.put("a", "video/mp2t", b"x" * 25)
+
+        self.assertEqual(buffer.get("a"), ("video/mp2t", b"x" * 25))
+        self.assertEqual(buffer.size, 25)
+
+
+if __name__ == "__main__":
+    unittest.main()